@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Parse time of IN lists of growing size, for each compile strategy.
+
+    $ python benchmarks/in_lists.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+import django
+django.setup()
+
+from customquery import Parser
+from tests.models import TestModel
+
+SIZES = (10, 1000, 10000, 100000)
+
+STRATEGIES = {
+    'plain': {},
+    'chunks of 999': {'in_chunk_size': 999},
+    'values table': {'in_table_threshold': 999},
+}
+
+
+def main():
+    print('%-14s %8s %12s %12s' % ('strategy', 'size', 'parse ms', 'sql ms'))
+    for name, options in STRATEGIES.items():
+        parser = Parser(TestModel, cache_size=0, **options)
+        for size in SIZES:
+            query = 'numfield IN (%s)' % ', '.join(map(str, range(size)))
+            number = max(1, 10000 // size)
+            parse = timeit.timeit(lambda: parser.parse(query), number=number) / number
+            q = parser.parse(query)
+            sql = timeit.timeit(lambda: TestModel.objects.filter(q).query.sql_with_params(), number=number) / number
+            print('%-14s %8d %12.3f %12.3f' % (name, size, parse * 1000, sql * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""Benchmarks for query shapes that grow: parse time, memory allocated while
+parsing and size of the generated SQL, and optionally the time to run the
+query against a generated SQLite dataset.
+
+    $ python benchmarks/run.py                         # parse tier
+    $ python benchmarks/run.py --e2e --rows 20000      # and end to end tier
+    $ python benchmarks/run.py --save baseline.json
+    $ python benchmarks/run.py --compare baseline.json --threshold 1.25
+
+With --compare, shapes slower (or allocating more) than threshold times the
+baseline are reported and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+import django
+django.setup()
+
+from datetime import date, timedelta
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.db.models import Value as V
+from django.db.models.functions import Concat
+from customquery import Parser
+from tests.models import TestModel, RelatedModel
+
+
+def and_chain(n):
+    return ' AND '.join('numfield <> %d' % i for i in range(n))
+
+
+def or_chain(n):
+    return ' OR '.join('charfield = "value %d"' % i for i in range(n))
+
+
+def nested(depth):
+    query = 'numfield = 0'
+    for i in range(1, depth):
+        query = 'numfield = %d %s (%s)' % (i, 'OR' if i % 2 else 'AND', query)
+    return query
+
+
+def in_list(n):
+    return 'numfield IN (%s)' % ', '.join(str(i) for i in range(n))
+
+
+def between(n):
+    return ' OR '.join('numfield BETWEEN %d AND %d' % (i * 10, i * 10 + 5) for i in range(n))
+
+
+def related(n):
+    return ' OR '.join('related.name = "name %d"' % i for i in range(n))
+
+
+def annotated(n):
+    return ' OR '.join('full_name = "first %d last %d"' % (i, i) for i in range(n))
+
+
+def plain_queryset():
+    return TestModel.objects.all()
+
+
+def annotated_queryset():
+    return TestModel.objects.annotate(full_name=Concat('first_name', V(' '), 'last_name'))
+
+
+def shapes():
+    for n in (10, 100, 1000):
+        yield 'and_chain_%d' % n, plain_queryset, and_chain(n)
+        yield 'or_chain_%d' % n, plain_queryset, or_chain(n)
+        yield 'between_%d' % n, plain_queryset, between(n)
+        yield 'related_%d' % n, plain_queryset, related(n)
+        yield 'annotated_%d' % n, annotated_queryset, annotated(n)
+    for depth in (10, 50, 90):
+        yield 'nested_%d' % depth, plain_queryset, nested(depth)
+    for n in (10, 1000, 10000, 100000):
+        yield 'in_list_%d' % n, plain_queryset, in_list(n)
+
+
+def measure_parse(parser, query):
+    timer = timeit.Timer(lambda: parser.parse(query))
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=3, number=number)) / number
+
+    tracemalloc.start()
+    parser.parse(query)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def measure_sql(queryset, q):
+    sql, params = queryset.filter(q).query.sql_with_params()
+    return len(sql), len(params)
+
+
+def measure_e2e(queryset, q):
+    qs = queryset.filter(q)
+    timer = timeit.Timer(lambda: list(qs.values_list('pk', flat=True)))
+    try:
+        number, _ = timer.autorange()
+    except DatabaseError as e:
+        # SQLite rejects expression trees deeper than 1000, for example
+        print('  %s' % e)
+        return None
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def create_dataset(rows):
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    rng = random.Random(0)
+    related = RelatedModel.objects.bulk_create(
+        [RelatedModel(name='name %d' % i) for i in range(max(1, rows // 10))])
+    start = date(2000, 1, 1)
+    TestModel.objects.bulk_create([
+        TestModel(
+            charfield='value %d' % rng.randrange(1000),
+            numfield=rng.randrange(100000) if i % 20 else None,
+            datefield=start + timedelta(days=rng.randrange(10000)),
+            related=rng.choice(related),
+            first_name='first %d' % i,
+            last_name='last %d' % rng.randrange(rows),
+        ) for i in range(rows)
+    ], batch_size=1000)
+
+
+def run(e2e=False, rows=10000, only=None):
+    if e2e:
+        create_dataset(rows)
+    results = {}
+    for name, queryset, query in shapes():
+        if only and only not in name:
+            continue
+        parser = Parser(queryset(), cache_size=0)
+        parse_time, allocated = measure_parse(parser, query)
+        q = parser.parse(query)
+        sql_size, params = measure_sql(queryset(), q)
+        result = {
+            'parse': parse_time,
+            'allocated': allocated,
+            'sql_size': sql_size,
+            'params': params,
+        }
+        if e2e:
+            result['e2e'] = measure_e2e(queryset(), q)
+        results[name] = result
+        print('%-18s parse %10.3f ms  allocated %10d B  sql %9d chars %7d params%s' % (
+            name, parse_time * 1000, allocated, sql_size, params,
+            '  e2e %10.3f ms' % (result['e2e'] * 1000) if result.get('e2e') is not None else
+            '  e2e     failed' if e2e else ''))
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric in ('parse', 'allocated', 'e2e'):
+            if result.get(metric) is not None and previous.get(metric) and result[metric] > previous[metric] * threshold:
+                regressions.append('%s %s: %.6g -> %.6g (x%.2f)' % (
+                    name, metric, previous[metric], result[metric], result[metric] / previous[metric]))
+    return regressions
+
+
+def main():
+    options = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    options.add_argument('--e2e', action='store_true', help='also run queries against a generated dataset')
+    options.add_argument('--rows', type=int, default=10000, help='rows in the generated dataset')
+    options.add_argument('--only', help='run shapes whose name contains this')
+    options.add_argument('--save', metavar='FILE', help='write results to FILE')
+    options.add_argument('--compare', metavar='FILE', help='compare results with a saved baseline')
+    options.add_argument('--threshold', type=float, default=1.25, help='ratio to baseline reported as regression')
+    args = options.parse_args()
+
+    results = run(args.e2e, args.rows, args.only)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
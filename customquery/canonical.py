@@ -0,0 +1,101 @@
+"""Canonical text of parsed queries, equal for queries that only differ in form.
+
+    >>> canonicalize(grammar.parse('(numfield=1) and charfield="foo"'))
+    "charfield = 'foo' AND numfield = 1"
+    >>> canonicalize(grammar.parse("numfield = 1 and charfield = foo"), strip_literals=True)
+    'charfield = ? AND numfield = ?'
+
+Keywords are upper case, strings and words are single quoted with quotes
+doubled, whitespace is one space, parenthesis are only kept where needed,
+nested AND/OR are flattened and their operands, like IN values, are sorted.
+The canonical text parses back to an equivalent query. With strip_literals
+every value is ?, and IN lists are (?), so queries group by shape.
+
+Given relation, a function returning the to-many relation a condition goes
+through (None for none), operands with negations or IS NULL next to other
+conditions through one relation keep their order, after the sorted ones: Q
+objects check those on the joined row only once a condition joined it.
+"""
+import hashlib
+from . import nodes
+from .lexer import NUMBER, PARAMETER
+
+
+def canonicalize(node, strip_literals=False, relation=None):
+    """Return the canonical text of a syntax tree"""
+    return Canonicalizer(strip_literals, relation).text(node)
+
+
+def fingerprint(node, strip_literals=False, relation=None):
+    """Return a hex digest of the canonical text of a syntax tree"""
+    return hashlib.sha1(canonicalize(node, strip_literals, relation).encode()).hexdigest()
+
+
+class Canonicalizer:
+
+    def __init__(self, strip_literals=False, relation=None):
+        self.strip_literals = strip_literals
+        self.relation = relation
+        self.fixed = set()
+
+    def text(self, node):
+        if self.relation is not None:
+            uses = nodes.relation_conditions(node, self.relation)
+            self.fixed = {prefix for prefix, kinds in uses.items() if nodes.order_dependent(kinds)}
+        return self._text(node)
+
+    def _text(self, node):
+        if isinstance(node, nodes.BoolOp):
+            operands = []
+            fixed = []
+            for operand in self._flatten(node.connector, node.operands):
+                text = self._text(operand)
+                if isinstance(operand, nodes.BoolOp) and operand.connector == 'OR':
+                    # AND binds tighter than OR, only OR inside AND needs them
+                    text = '(%s)' % text
+                (fixed if self._fixed(operand) else operands).append(text)
+            return (' %s ' % node.connector).join(sorted(operands) + fixed)
+        if isinstance(node, nodes.Not):
+            operand = self._text(node.operand)
+            if isinstance(node.operand, nodes.BoolOp):
+                operand = '(%s)' % operand
+            return 'NOT ' + operand
+        path = node.path.replace('__', '.')
+        if isinstance(node, nodes.Comparison):
+            return '%s %s %s' % (path, node.op, self._literal(node.value))
+        if isinstance(node, nodes.In):
+            return '%s %sIN %s' % (path, 'NOT ' if node.negated else '', self._list(node.values))
+        if isinstance(node, nodes.Between):
+            return '%s %sBETWEEN %s AND %s' % (path, 'NOT ' if node.negated else '',
+                                               self._literal(node.low), self._literal(node.high))
+        if isinstance(node, nodes.IsNull):
+            return '%s IS %sNULL' % (path, '' if node.isnull else 'NOT ')
+        raise TypeError("Not a syntax tree node: %r" % (node,))
+
+    def _fixed(self, node):
+        # Whether node goes through a relation whose conditions keep their order
+        return bool(self.fixed) and any(self.relation(child) in self.fixed for child in nodes.walk(node)
+                                        if not isinstance(child, (nodes.BoolOp, nodes.Not)))
+
+    def _flatten(self, connector, operands):
+        for operand in operands:
+            if isinstance(operand, nodes.BoolOp) and operand.connector == connector:
+                yield from self._flatten(connector, operand.operands)
+            else:
+                yield operand
+
+    def _literal(self, literal):
+        if literal.kind == PARAMETER:
+            return ':' + literal.value
+        if self.strip_literals:
+            return '?'
+        if literal.kind == NUMBER:
+            return literal.value
+        return "'%s'" % literal.value.replace("'", "''")
+
+    def _list(self, values):
+        if isinstance(values, nodes.Literal):
+            return self._literal(values)
+        if self.strip_literals:
+            return '(?)'
+        return '(%s)' % ', '.join(sorted(self._literal(value) for value in values))
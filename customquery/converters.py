@@ -0,0 +1,207 @@
+"""Conversion of query literals to Python values, chosen by model field class.
+
+A converter factory is called once per field path with the parser and the
+field, and returns a function converting the text of a literal:
+
+    >>> from customquery import converters
+    >>> @converters.register(MyPointField)
+    ... def point(parser, field):
+    ...     return lambda value: Point(*map(float, value.split(';')))
+
+Factories are looked up along the field class MRO, so subclasses of a
+registered field use its converter unless they have their own. A Parser can
+override them with Parser(converters={FieldClass: factory}).
+"""
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
+from django.db.models import fields
+from django.db.models.fields.related import ForeignObject
+from django.db.models.fields.reverse_related import ForeignObjectRel
+from django.utils import dateparse, timezone
+from . import exceptions
+from .lexer import NUMBER
+
+_registry = {}
+
+
+def register(field_class, factory=None):
+    """Register factory(parser, field) for field_class, can be used as a decorator"""
+    if factory is None:
+        def decorator(factory):
+            register(field_class, factory)
+            return factory
+        return decorator
+    _registry[field_class] = factory
+    return factory
+
+
+def unregister(field_class):
+    _registry.pop(field_class, None)
+
+
+def find_factory(field, registry=None):
+    """Return the factory for the closest class of field, or None"""
+    for cls in type(field).__mro__:
+        if registry and cls in registry:
+            return registry[cls]
+        if cls in _registry:
+            return _registry[cls]
+    return None
+
+
+def get_converter(parser, field, registry=None):
+    """Return the Converter for field, falling back to LiteralConverter"""
+    factory = find_factory(field, registry) if field is not None else None
+    if factory is not None:
+        function = factory(parser, field)
+        if function is not None:
+            return Converter(function, field)
+    return LiteralConverter(field)
+
+
+class Converter:
+    """Converts literals for one field, one at a time or a whole list at once"""
+
+    __slots__ = ('function', 'field')
+
+    def __init__(self, function, field=None):
+        self.function = function
+        self.field = field
+
+    def __call__(self, literal):
+        try:
+            return self.function(literal.value)
+        except (ValueError, TypeError, ArithmeticError) as e:
+            raise exceptions.InvalidValue(literal.value, self.field, literal.pos) from e
+
+    def many(self, literals):
+        function = self.function
+        try:
+            return [function(literal.value) for literal in literals]
+        except (ValueError, TypeError, ArithmeticError):
+            # Convert them again one by one to report the first bad value
+            for literal in literals:
+                self(literal)
+            raise
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, getattr(self.function, '__name__', self.function))
+
+
+class LiteralConverter(Converter):
+    """Numbers become int and anything else is passed as text, for fields
+    without a registered converter and annotations"""
+
+    __slots__ = ()
+
+    def __init__(self, field=None):
+        super().__init__(None, field)
+
+    def __call__(self, literal):
+        if literal.kind == NUMBER:
+            return int(literal.value)
+        return literal.value
+
+    def many(self, literals):
+        return [int(literal.value) if literal.kind == NUMBER else literal.value for literal in literals]
+
+
+def _text(parser, field):
+    return str
+
+
+def _integer(parser, field):
+    return int
+
+
+def _float(parser, field):
+    return float
+
+
+def _decimal(parser, field):
+    def convert(value):
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            raise ValueError(value)
+    return convert
+
+
+BOOLEANS = {
+    'true': True, 't': True, 'yes': True, 'y': True, 'on': True, '1': True,
+    'false': False, 'f': False, 'no': False, 'n': False, 'off': False, '0': False,
+}
+
+
+def _boolean(parser, field):
+    def convert(value):
+        try:
+            return BOOLEANS[value.lower()]
+        except KeyError:
+            raise ValueError(value)
+    return convert
+
+
+def _date(parser, field):
+    date_format = parser.date_format
+
+    def convert(value):
+        return datetime.strptime(value, date_format).date()
+    return convert
+
+
+def _datetime(parser, field):
+    date_format = parser.date_format
+    use_tz = settings.USE_TZ
+
+    def convert(value):
+        result = dateparse.parse_datetime(value)
+        if result is None:
+            # A date alone is midnight
+            result = datetime.strptime(value, date_format)
+        if use_tz and timezone.is_naive(result):
+            result = timezone.make_aware(result)
+        return result
+    return convert
+
+
+def _strict(parse):
+    def factory(parser, field):
+        def convert(value):
+            result = parse(value)
+            if result is None:
+                raise ValueError(value)
+            return result
+        return convert
+    return factory
+
+
+def _uuid(parser, field):
+    return uuid.UUID
+
+
+def _related(parser, field):
+    # Relations are compared by the value of the field they point to
+    try:
+        target = field.target_field
+    except Exception:
+        return None
+    factory = find_factory(target, getattr(parser, 'converters', None))
+    return factory(parser, target) if factory is not None else None
+
+
+register(fields.CharField, _text)
+register(fields.TextField, _text)
+register(fields.IntegerField, _integer)
+register(fields.FloatField, _float)
+register(fields.DecimalField, _decimal)
+register(fields.BooleanField, _boolean)
+register(fields.DateField, _date)
+register(fields.DateTimeField, _datetime)
+register(fields.TimeField, _strict(dateparse.parse_time))
+register(fields.DurationField, _strict(dateparse.parse_duration))
+register(fields.UUIDField, _uuid)
+register(ForeignObject, _related)
+register(ForeignObjectRel, _related)
@@ -0,0 +1,106 @@
+"""Approximate counts of filtered querysets, for pagination of broad queries.
+
+    >>> estimate_count(MyModel.objects.filter(q))
+    Estimate(count=120400, error=2900, exact=False, method='sample')
+
+The true count is within count +/- error (at about 95% confidence for
+samples). Strategies are tried in order:
+
+- exact, counting at most threshold + 1 rows, when there are no more than
+  threshold of them
+- planner, the row estimate of EXPLAIN on PostgreSQL, without an error bound
+- sample, counting the matching rows in random windows of an integer primary
+  key, one in each of a number of equal strata of the pk range
+- exact, a full COUNT when nothing else applies
+"""
+import json
+import math
+import random
+from collections import namedtuple
+from django.db import connections
+from django.db.models import Case, Count, IntegerField, Max, Min, Q, Value, When
+
+Estimate = namedtuple('Estimate', ['count', 'error', 'exact', 'method'])
+
+# Two sided 95% confidence
+Z = 1.96
+
+
+def estimate_count(queryset, threshold=1000, windows=20, sample_fraction=0.01, planner=True, seed=None):
+    """Return an Estimate of queryset.count()"""
+
+    queryset = queryset.order_by()
+    bounded = queryset.values('pk')[:threshold + 1].count()
+    if bounded <= threshold:
+        return Estimate(bounded, 0, True, 'exact')
+
+    if planner:
+        rows = _planner_rows(queryset)
+        if rows is not None:
+            return Estimate(max(rows, threshold + 1), None, False, 'planner')
+
+    pk = queryset.model._meta.pk
+    if pk.get_internal_type() in ('AutoField', 'BigAutoField', 'SmallAutoField', 'IntegerField',
+                                  'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField'):
+        result = _sample(queryset, windows, sample_fraction, random.Random(seed))
+        if result is not None:
+            count, error = result
+            # The bounded count already saw more than threshold rows
+            return Estimate(max(count, threshold + 1), error, False, 'sample')
+
+    return Estimate(queryset.count(), 0, True, 'exact')
+
+
+def _planner_rows(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.values('pk').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def _sample(queryset, windows, sample_fraction, rng):
+    bounds = queryset.model._default_manager.using(queryset.db).aggregate(low=Min('pk'), high=Max('pk'))
+    low, high = bounds['low'], bounds['high']
+    if low is None:
+        return None
+    span = high - low + 1
+    windows = max(1, min(windows, span))
+    stratum = span / windows
+    width = max(1, min(int(stratum), int(span * sample_fraction / windows)))
+
+    ranges = []
+    for i in range(windows):
+        start = low + int(i * stratum)
+        end = low + int((i + 1) * stratum) - 1
+        first = rng.randint(start, max(start, end - width + 1))
+        ranges.append((first, first + width - 1, end - start + 1))
+
+    condition = Q()
+    whens = []
+    for i, (first, last, _) in enumerate(ranges):
+        condition |= Q(pk__range=(first, last))
+        whens.append(When(pk__range=(first, last), then=Value(i)))
+    rows = (queryset.filter(condition)
+            .annotate(customquery_window=Case(*whens, output_field=IntegerField()))
+            .values('customquery_window')
+            .annotate(rows=Count('pk')))
+    counts = {row['customquery_window']: row['rows'] for row in rows}
+
+    # Each window stands for its whole stratum
+    estimates = [counts.get(i, 0) * size / width for i, (_, _, size) in enumerate(ranges)]
+    count = sum(estimates)
+    if len(estimates) > 1:
+        # Successive differences between neighbouring strata, which unlike the
+        # plain sample variance don't count density changing along the pk range
+        k = len(estimates)
+        differences = sum((estimates[i + 1] - estimates[i]) ** 2 for i in range(k - 1))
+        error = Z * math.sqrt(k * differences / (2 * (k - 1)))
+    else:
+        error = count
+    return int(round(count)), int(math.ceil(error))
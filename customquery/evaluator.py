@@ -0,0 +1,300 @@
+"""Evaluates a parsed query in memory, without the database.
+
+Predicate builds a function telling whether a model instance or a dict
+matches, and Mask builds one computing a boolean NumPy array over columns:
+
+    >>> matches = parser.predicate("numfield > 1 and related.name = foo")
+    >>> [obj for obj in objects if matches(obj)]
+    >>> parser.mask("numfield > 1", {'numfield': numpy.array([1, 2, 3])})
+
+Values are converted like in Q objects, and NULLs follow the same rules: every
+condition is false on NULL, so NOT of a condition is true on NULL. Conditions
+ANDed together through a to-many relation must match one related object, as
+with the join of a Q object, and negations any of them on their own. Related
+objects are read with all(), one query per object and condition unless they
+were prefetched.
+"""
+import operator
+from itertools import product
+from datetime import timezone
+from django.db.models import ForeignObject
+from . import exceptions, nodes
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+
+class Many(list):
+    """Values found through a to-many relation"""
+
+
+class Predicate:
+
+    def __init__(self, parser, params=None):
+        self.parser = parser
+        self.params = params
+        # Getters of the related rows of the to-many relations whose
+        # conditions hold on one related row, by relation
+        self.shared = {}
+
+    def compile(self, node):
+        """Return a function of a row, a model instance or a dict, returning a bool"""
+
+        uses = nodes.relation_conditions(node, lambda leaf: self.parser._to_many_prefix(leaf.path))
+        for prefix, kinds in uses.items():
+            if not nodes.shares_row(kinds) and set(kinds) != {nodes.NEGATIVE}:
+                # Checked on the joined row in an order only a join follows
+                raise exceptions.UnsupportedField(prefix)
+        self.shared = {prefix: self._getter(prefix) for prefix, kinds in uses.items()
+                       if len(kinds) > 1 and nodes.NEGATIVE not in kinds}
+        test = self._compile(node, False)
+        if not self.shared:
+            return lambda row: test(row, {})
+        prefixes = list(self.shared)
+        getters = list(self.shared.values())
+
+        def matches(row):
+            choices = []
+            for get in getters:
+                related = get(row)
+                # A dict from values() is already one joined row
+                choices.append(related if type(related) is Many else [_JOINED])
+            return any(test(row, dict(zip(prefixes, bound))) for bound in product(*choices))
+        return matches
+
+    def _compile(self, node, negated):
+        # Functions of a row and of the related rows bound for self.shared
+        if isinstance(node, nodes.BoolOp):
+            operands = [self._compile(operand, negated) for operand in node.operands]
+            if node.connector == 'AND':
+                return lambda row, bound: all(operand(row, bound) for operand in operands)
+            return lambda row, bound: any(operand(row, bound) for operand in operands)
+        if isinstance(node, nodes.Not):
+            node = nodes.fold_not(node)
+            if not isinstance(node, nodes.Not):
+                return self._compile(node, negated)
+            operand = self._compile(node.operand, True)
+            return lambda row, bound: not operand(row, bound)
+        if isinstance(node, nodes.Comparison):
+            compare = OPERATORS[node.op]
+            value = self.parser._get_value(node.path, node.value, self.params)
+            test = lambda found: found is not None and compare(found, value)
+            return self._leaf(node.path, test, node.op == '!=')
+        if isinstance(node, nodes.In):
+            values = self.parser._get_list(node.path, node.values, self.params)
+            try:
+                values = frozenset(values)
+            except TypeError:
+                pass
+            test = lambda found: found is not None and found in values
+            return self._leaf(node.path, test, node.negated)
+        if isinstance(node, nodes.Between):
+            low, high = self.parser._get_list(node.path, [node.low, node.high], self.params)
+            if (node.negated or negated) and self.parser._to_many_prefix(node.path) is not None:
+                # Like Q objects, each bound of a negated BETWEEN on its own related row
+                above = self._leaf(node.path, lambda found: found is not None and found >= low, False)
+                below = self._leaf(node.path, lambda found: found is not None and found <= high, False)
+                if node.negated:
+                    return lambda row, bound: not (above(row, bound) and below(row, bound))
+                return lambda row, bound: above(row, bound) and below(row, bound)
+            test = lambda found: found is not None and low <= found <= high
+            return self._leaf(node.path, test, node.negated)
+        if isinstance(node, nodes.IsNull):
+            isnull = node.isnull
+            test = lambda found: (found is None) == isnull
+            return self._leaf(node.path, test, False)
+        raise exceptions.InvalidQuery()
+
+    def _leaf(self, path, test, negated):
+        get = self._getter(path)
+        prefix = self.parser._to_many_prefix(path)
+        if prefix in self.shared:
+            get_related = self._getter(path, prefix)
+
+            def get_bound(row, bound):
+                related = bound[prefix]
+                if related is _JOINED:
+                    return get(row)
+                return get_related(related)
+        else:
+            get_bound = lambda row, bound: get(row)
+
+        def leaf(row, bound):
+            found = get_bound(row, bound)
+            if type(found) is Many:
+                return any(test(value) for value in found)
+            return test(found)
+        if negated:
+            return lambda row, bound: not leaf(row, bound)
+        return leaf
+
+    def _getter(self, path, prefix=None):
+        # Values of path, from a related row of prefix when given
+        info = self.parser._get_field_info(path)
+        parts = path.split('__')
+        attributes = list(parts)
+        for i in range(len(parts)):
+            field = self.parser._get_field_info('__'.join(parts[:i + 1])).field
+            if field is not None and field.is_relation and field.auto_created and not field.concrete:
+                # Instances reach reverse relations through their accessor, mymodel_set
+                attributes[i] = field.get_accessor_name()
+        if isinstance(info.field, ForeignObject) and info.field.concrete:
+            # Instances keep the key of a relation in related_id, dicts from values() in related
+            attributes[-1] = info.field.attname
+        if prefix is not None:
+            skip = len(prefix.split('__'))
+            parts, attributes = parts[skip:], attributes[skip:]
+
+        def get(row):
+            if isinstance(row, dict):
+                if path in row:
+                    return row[path]
+                return _follow(row, parts)
+            return _follow(row, attributes)
+        return get
+
+
+# Bound in place of a related row for dicts already holding one
+_JOINED = object()
+
+
+def _follow(value, parts):
+    for i, part in enumerate(parts):
+        if value is None:
+            return None
+        if isinstance(value, dict):
+            value = value.get(part)
+        else:
+            value = getattr(value, part, None)
+        if hasattr(value, 'all') and callable(value.all):
+            # A related manager, queried unless prefetch_related() filled its cache
+            value = list(value.all())
+        if isinstance(value, (list, tuple)):
+            rest = parts[i + 1:]
+            found = Many()
+            for item in value:
+                item = _follow(item, rest) if rest else item
+                if type(item) is Many:
+                    found.extend(item)
+                else:
+                    found.append(item)
+            # No related objects is like a NULL, as with a LEFT JOIN
+            return found or Many([None])
+    return value
+
+
+class Mask:
+
+    def __init__(self, parser, params=None):
+        if numpy is None:
+            raise ImportError("numpy is required for vectorized evaluation")
+        self.parser = parser
+        self.params = params
+
+    def compile(self, node):
+        """Return a function of a mapping of field paths to arrays, returning
+        a boolean array"""
+
+        if isinstance(node, nodes.BoolOp):
+            operands = [self.compile(operand) for operand in node.operands]
+            combine = numpy.logical_and if node.connector == 'AND' else numpy.logical_or
+
+            def boolop(columns):
+                result = operands[0](columns)
+                for operand in operands[1:]:
+                    result = combine(result, operand(columns))
+                return result
+            return boolop
+        if isinstance(node, nodes.Not):
+            operand = self.compile(node.operand)
+            return lambda columns: ~operand(columns)
+        if isinstance(node, nodes.Comparison):
+            compare = OPERATORS[node.op]
+            value = self.parser._get_value(node.path, node.value, self.params)
+            return self._leaf(node.path, lambda data: compare(data, _scalar(data, value)), node.op == '!=')
+        if isinstance(node, nodes.In):
+            values = self.parser._get_list(node.path, node.values, self.params)
+            return self._leaf(node.path, lambda data: numpy.isin(data, _array(data, values)), node.negated)
+        if isinstance(node, nodes.Between):
+            low, high = self.parser._get_list(node.path, [node.low, node.high], self.params)
+
+            def between(data):
+                return (data >= _scalar(data, low)) & (data <= _scalar(data, high))
+            return self._leaf(node.path, between, node.negated)
+        if isinstance(node, nodes.IsNull):
+            get = self._getter(node.path)
+            if node.isnull:
+                return lambda columns: _nulls(get(columns))
+            return lambda columns: ~_nulls(get(columns))
+        raise exceptions.InvalidQuery()
+
+    def _leaf(self, path, test, negated):
+        get = self._getter(path)
+
+        def leaf(columns):
+            column = get(columns)
+            nulls = _nulls(column)
+            data = numpy.ma.getdata(column)
+            if nulls.any():
+                # Objects can't be compared to None, only test the others
+                result = numpy.zeros(len(data), dtype=bool)
+                result[~nulls] = test(data[~nulls])
+            else:
+                result = numpy.asarray(test(data), dtype=bool)
+            return result
+        if negated:
+            return lambda columns: ~leaf(columns)
+        return leaf
+
+    def _getter(self, path):
+        info = self.parser._get_field_info(path)
+        names = [path]
+        if isinstance(info.field, ForeignObject) and info.field.concrete:
+            names.append(path[:-len(info.field.name)] + info.field.attname)
+
+        def get(columns):
+            for name in names:
+                if name in columns:
+                    return columns[name]
+            raise KeyError("No column for field '%s'" % path)
+        return get
+
+
+def _nulls(column):
+    if numpy.ma.isMaskedArray(column):
+        return numpy.ma.getmaskarray(column)
+    kind = column.dtype.kind
+    if kind == 'f':
+        return numpy.isnan(column)
+    if kind in 'mM':
+        return numpy.isnat(column)
+    if kind == 'O':
+        return numpy.equal(column, None)
+    return numpy.zeros(len(column), dtype=bool)
+
+
+def _scalar(data, value):
+    kind = data.dtype.kind
+    if kind == 'M':
+        if getattr(value, 'tzinfo', None) is not None:
+            # datetime64 has no time zone, columns are expected in UTC
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return numpy.datetime64(value)
+    if kind == 'f':
+        return float(value)
+    return value
+
+
+def _array(data, values):
+    return numpy.array([_scalar(data, value) for value in values])
@@ -1,29 +1,119 @@
-class FieldDoesNotExist(Exception):
+def _rebuild(cls, args, state):
+    error = cls.__new__(cls)
+    error.args = args
+    error.__dict__.update(state)
+    return error
+
+class CustomQueryError(Exception):
+    """Base class of the errors raised for queries"""
+
+    # Offset in the query where the error is, when known, and for syntax
+    # errors what could have been there instead
+    position = None
+    expected = None
+
+    def __reduce__(self):
+        # Subclasses take other arguments than their message, so they are not
+        # pickled by calling them with args like other exceptions
+        return _rebuild, (type(self), self.args, self.__dict__)
+
+class FieldDoesNotExist(CustomQueryError):
     def __init__(self, field):
         self.field = field
         super().__init__("Field '%s' does not exist" % field)
 
-class ParenthesisDontMatch(Exception):
+class ParenthesisDontMatch(CustomQueryError):
     def __init__(self):
         super().__init__("Parenthesis do not match")
 
-class ParenthesisExpected(Exception):
+class ParenthesisExpected(CustomQueryError):
     def __init__(self, previous):
         super().__init__("Excepted opening parenthesis after %s" % previous)
 
-class MalformedList(Exception):
+class MalformedList(CustomQueryError):
     def __init__(self, previous):
         super().__init__("Values inside parenthesis are not a valid list")
 
-class UnknownOperator(Exception):
+class UnknownOperator(CustomQueryError):
     def __init__(self, operator):
         self.operator = operator
         super().__init__("Operator '%s' is invalid" % operator)
 
-class InvalidIsParameter(Exception):
+class InvalidIsParameter(CustomQueryError):
     def __init__(self, value):
         super().__init__("'%s' is not a valid value for IS" % value)
 
-class InvalidQuery(Exception):
+class InvalidQuery(CustomQueryError):
     def __init__(self):
         super().__init__("Invalid query")
+
+class UnterminatedString(InvalidQuery):
+    def __init__(self, quote):
+        self.quote = quote
+        CustomQueryError.__init__(self, "String is missing its closing %s" % quote)
+
+class MissingParameter(CustomQueryError):
+    def __init__(self, name):
+        self.name = name
+        super().__init__("No value given for parameter ':%s'" % name)
+
+class UnsupportedField(CustomQueryError):
+    def __init__(self, field):
+        self.field = field
+        super().__init__("Field '%s' can not be compiled to SQL" % field)
+
+class IncompatibleIR(CustomQueryError, ValueError):
+    def __init__(self, data):
+        super().__init__("Can not read serialized query %.50r" % (data,))
+
+class QueryTooComplex(CustomQueryError):
+    def __init__(self, message, position):
+        self.position = position
+        super().__init__("%s (at position %d)" % (message, position))
+
+class QueryTooDeep(QueryTooComplex):
+    def __init__(self, limit, position):
+        self.limit = limit
+        super().__init__("Query is nested more than %d levels deep" % limit, position)
+
+class TooManyPredicates(QueryTooComplex):
+    def __init__(self, limit, position):
+        self.limit = limit
+        super().__init__("Query has more than %d conditions" % limit, position)
+
+class ListTooLong(QueryTooComplex):
+    def __init__(self, limit, position):
+        self.limit = limit
+        super().__init__("List has more than %d values" % limit, position)
+
+class TooManyRelations(QueryTooComplex):
+    def __init__(self, field, limit, position):
+        self.field = field
+        self.limit = limit
+        super().__init__("Field '%s' follows more than %d relations" % (field, limit), position)
+
+class FieldNotAllowed(CustomQueryError):
+    def __init__(self, field, position):
+        self.field = field
+        self.position = position
+        super().__init__("Field '%s' can not be used in queries (at position %d)" % (field, position))
+
+class UnindexedField(CustomQueryError):
+    def __init__(self, field, position):
+        self.field = field
+        self.position = position
+        super().__init__("Field '%s' is not indexed (at position %d)" % (field, position))
+
+class UnindexedFieldWarning(UserWarning):
+    pass
+
+class InvalidValue(CustomQueryError, ValueError):
+    def __init__(self, value, field, position):
+        self.value = value
+        self.field = field
+        self.position = position
+        name = getattr(field, 'name', field)
+        if position is None:
+            super().__init__("Invalid value %r for field '%s'" % (value, name))
+        else:
+            super().__init__("Invalid value %r for field '%s' (at position %d)" % (value, name, position))
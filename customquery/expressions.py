@@ -0,0 +1,29 @@
+import json
+from django.db.models import Expression
+
+
+class ValuesTable(Expression):
+    """Subquery over a list of values passed as a single query parameter, for
+    IN lists too long for one placeholder per value. Backends without a table
+    function for it get a regular list of placeholders."""
+
+    def __init__(self, values, output_field):
+        super().__init__(output_field=output_field)
+        self.values = tuple(values)
+
+    def _db_values(self, connection):
+        field = self.output_field
+        return [field.get_db_prep_value(value, connection, prepared=False) for value in self.values]
+
+    def as_sql(self, compiler, connection):
+        return '(%s)' % ', '.join(['%s'] * len(self.values)), self._db_values(connection)
+
+    def as_sqlite(self, compiler, connection):
+        return 'SELECT value FROM json_each(%s)', [json.dumps(self._db_values(connection), default=str)]
+
+    def as_postgresql(self, compiler, connection):
+        db_type = self.output_field.db_type(connection)
+        return 'SELECT unnest(%%s::%s[])' % db_type, [self._db_values(connection)]
+
+    def __repr__(self):
+        return '%s(<%d values>)' % (self.__class__.__name__, len(self.values))
@@ -0,0 +1,173 @@
+"""Runs one parsed query on several databases at once, for sharded data.
+
+    >>> shards = FanOut(parser, ['shard1', 'shard2', 'shard3'])
+    >>> for obj in shards.iterator('numfield > 1', ordering=['-datefield', 'pk'], limit=50):
+    ...     pass
+    >>> shards.count('numfield > 1')
+
+The query is parsed once. Every database is read by its own thread, a chunk
+ahead of the consumer, and ordered results are merged with a heap, so only a
+chunk per database is held in memory. NULLs are merged where the databases
+sort them, which must be the same for all of them. Other values are compared
+in Python, so text is merged in code point order: with a collation sorting
+text differently, case-insensitive or by locale, the rows of each database
+keep their order but are interleaved by Python's. The merge needs every
+database read at once, so it starts one thread per database whatever
+max_workers, which only limits unordered reads and counts.
+"""
+import heapq
+import queue
+import threading
+from concurrent import futures
+from copy import deepcopy
+from itertools import islice
+from django.db import connections
+from . import stream
+
+_END = object()
+
+
+class FanOut:
+
+    def __init__(self, parser, aliases, max_workers=None):
+        self.parser = parser
+        self.aliases = list(aliases)
+        self.max_workers = max_workers or len(self.aliases)
+
+    def iterator(self, query, queryset=None, ordering=None, offset=0, limit=None, chunk_size=1000):
+        """Yield the objects matching query in every database, merged in the
+        given ordering, or as they arrive without one. offset and limit apply
+        to the merged results."""
+
+        q = self.parser.parse(query)
+        ordering = list(ordering) if ordering else None
+        if ordering:
+            nulls_largest = {connections[alias].features.nulls_order_largest for alias in self.aliases}
+            if len(nulls_largest) > 1:
+                raise ValueError("Databases %s sort NULLs differently, their rows can't be merged in order"
+                                 % ', '.join(self.aliases))
+            nulls_largest = nulls_largest.pop()
+        querysets = []
+        for alias in self.aliases:
+            queryset_for = self.parser._filter(deepcopy(q), self._using(queryset, alias))
+            if ordering:
+                queryset_for = queryset_for.order_by(*ordering)
+            if limit is not None:
+                # No database can give more than offset + limit of the merged rows
+                queryset_for = queryset_for[:offset + limit]
+            querysets.append((alias, queryset_for))
+
+        stop = threading.Event()
+        # Each source of the merge must be read to fill its queue, fewer
+        # threads would wait on queues nobody reads
+        executor = futures.ThreadPoolExecutor(len(querysets) if ordering else self.max_workers)
+        try:
+            if ordering:
+                names = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+                sources = []
+                for alias, queryset_for in querysets:
+                    rows = queue.Queue(maxsize=chunk_size)
+                    executor.submit(_read, alias, queryset_for, chunk_size, rows, stop)
+                    sources.append(_drain(rows, 1))
+                merged = heapq.merge(*sources, key=lambda row: _OrderKey(names, row, nulls_largest))
+            else:
+                rows = queue.Queue(maxsize=chunk_size * len(querysets))
+                for alias, queryset_for in querysets:
+                    executor.submit(_read, alias, queryset_for, chunk_size, rows, stop)
+                merged = _drain(rows, len(querysets))
+            end = None if limit is None else offset + limit
+            yield from islice(merged, offset, end)
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
+
+    def list(self, query, queryset=None, **options):
+        return list(self.iterator(query, queryset, **options))
+
+    def counts(self, query, queryset=None):
+        """Return the number of objects matching query in each database"""
+        q = self.parser.parse(query)
+        with futures.ThreadPoolExecutor(self.max_workers) as executor:
+            results = {
+                alias: executor.submit(_count, alias, self.parser._filter(deepcopy(q), self._using(queryset, alias)))
+                for alias in self.aliases
+            }
+            return {alias: result.result() for alias, result in results.items()}
+
+    def count(self, query, queryset=None):
+        """Return the number of objects matching query in all databases"""
+        return sum(self.counts(query, queryset).values())
+
+    def _using(self, queryset, alias):
+        return self.parser._get_queryset(queryset).using(alias)
+
+
+def _read(alias, queryset, chunk_size, output, stop):
+    try:
+        for row in queryset.iterator(chunk_size=chunk_size):
+            if not _put(output, row, stop):
+                return
+        _put(output, _END, stop)
+    except BaseException as e:
+        _put(output, _Failure(e), stop)
+    finally:
+        # Threads have their own connections, they would be left open
+        connections[alias].close()
+
+
+def _put(output, item, stop):
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _count(alias, queryset):
+    try:
+        return queryset.count()
+    finally:
+        connections[alias].close()
+
+
+def _drain(rows, sources):
+    # Rows from a queue, until every source has ended
+    while sources:
+        row = rows.get()
+        if row is _END:
+            sources -= 1
+        elif isinstance(row, _Failure):
+            raise row.error
+        else:
+            yield row
+
+
+class _Failure:
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _OrderKey:
+    """Compares rows like ORDER BY, with NULL smaller than any value, or
+    larger with nulls_largest"""
+    __slots__ = ('names', 'values', 'nulls_largest')
+
+    def __init__(self, names, row, nulls_largest=False):
+        self.names = names
+        self.values = [stream._get(row, name) for name, _ in names]
+        self.nulls_largest = nulls_largest
+
+    def __lt__(self, other):
+        for (name, descending), mine, theirs in zip(self.names, self.values, other.values):
+            if mine == theirs:
+                continue
+            if mine is None or theirs is None:
+                less = (theirs if self.nulls_largest else mine) is None
+            else:
+                less = mine < theirs
+            return not less if descending else less
+        return False
@@ -0,0 +1,187 @@
+"""Recursive descent parser for the customquery grammar:
+
+    expression := conjunction (OR conjunction)*
+    conjunction := negation (AND negation)*
+    negation   := NOT negation | '(' expression ')' | predicate
+    predicate  := path operator value
+                | path NOT value
+                | path [NOT] IN '(' value (',' value)* ')'
+                | path [NOT] IN :parameter
+                | path IS [NOT] NULL
+                | path (= | != | <> | NOT) NULL
+                | path [NOT] BETWEEN value AND value
+    value      := string | number | word | :parameter
+"""
+from . import exceptions, nodes
+from .lexer import tokenize, STRING, NUMBER, WORD, KEYWORD, OPERATOR, PUNCTUATION, PARAMETER, END
+
+OPERATORS = {
+    '=': '=',
+    '!=': '!=',
+    '<>': '!=',
+    '>': '>',
+    '>=': '>=',
+    '<': '<',
+    '<=': '<=',
+}
+
+VALUES = (STRING, NUMBER, WORD, PARAMETER)
+
+# What syntax errors tell was expected, field and value standing for any of them
+FIELD = 'field'
+VALUE = 'value'
+EXPECT_OPERATOR = tuple(OPERATORS) + ('NOT', 'IN', 'IS', 'BETWEEN')
+EXPECT_CONNECTOR = ('AND', 'OR')
+EXPECT_CONDITION = (FIELD, 'NOT', '(')
+
+
+def parse(query, max_depth=None):
+    """Parse a query string into a syntax tree, nested at most max_depth
+    levels of parenthesis and NOT"""
+    return Grammar(tokenize(query), max_depth).parse()
+
+
+class Grammar:
+
+    def __init__(self, tokens, max_depth=None):
+        self.tokens = tokens
+        self.index = 0
+        self.max_depth = max_depth
+        self.depth = 0
+
+    def parse(self):
+        node = self._expression()
+        token = self._peek()
+        if token.match(PUNCTUATION, ')'):
+            raise _error(exceptions.ParenthesisDontMatch(), token, EXPECT_CONNECTOR)
+        if token.kind != END:
+            raise _error(exceptions.InvalidQuery(), token, EXPECT_CONNECTOR)
+        return node
+
+    def _peek(self):
+        return self.tokens[self.index]
+
+    def _next(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def _accept(self, kind, value=None):
+        token = self.tokens[self.index]
+        if token.match(kind, value):
+            self.index += 1
+            return token
+        return None
+
+    def _expression(self):
+        return self._chain('OR', self._conjunction)
+
+    def _conjunction(self):
+        return self._chain('AND', self._negation)
+
+    def _chain(self, connector, operand):
+        first = operand()
+        if not self._peek().match(KEYWORD, connector):
+            return first
+        operands = [first]
+        while self._accept(KEYWORD, connector):
+            operands.append(operand())
+        return nodes.BoolOp(connector, operands, first.pos)
+
+    def _negation(self):
+        token = self._peek()
+        if self._accept(KEYWORD, 'NOT'):
+            self._enter(token)
+            node = nodes.Not(self._negation(), token.pos)
+            self.depth -= 1
+            return node
+        if self._accept(PUNCTUATION, '('):
+            self._enter(token)
+            node = self._expression()
+            if not self._accept(PUNCTUATION, ')'):
+                raise _error(exceptions.ParenthesisDontMatch(), self._peek(), (')',) + EXPECT_CONNECTOR)
+            self.depth -= 1
+            return node
+        return self._predicate()
+
+    def _enter(self, token):
+        self.depth += 1
+        if self.max_depth is not None and self.depth > self.max_depth:
+            raise exceptions.QueryTooDeep(self.max_depth, token.pos)
+
+    def _predicate(self):
+        subject = self._next()
+        if subject.kind != WORD:
+            raise _error(exceptions.InvalidQuery(), subject, EXPECT_CONDITION)
+        path = subject.value.replace('.', '__')
+        pos = subject.pos
+
+        token = self._next()
+        if token.kind == OPERATOR:
+            op = OPERATORS[token.value]
+            if op in ('=', '!=') and self._accept(KEYWORD, 'NULL'):
+                # Like Q(field=None)
+                return nodes.IsNull(path, op == '=', pos)
+            return nodes.Comparison(path, op, self._value(), pos)
+        if token.kind != KEYWORD:
+            raise _error(exceptions.UnknownOperator(token.text), token, EXPECT_OPERATOR)
+
+        negated = False
+        if token.value == 'NOT':
+            negated = True
+            following = self._peek()
+            if not (following.match(KEYWORD, 'IN') or following.match(KEYWORD, 'BETWEEN')):
+                if self._accept(KEYWORD, 'NULL'):
+                    return nodes.IsNull(path, False, pos)
+                return nodes.Comparison(path, '!=', self._value(), pos)
+            token = self._next()
+
+        if token.value == 'IN':
+            return nodes.In(path, self._list(), negated, pos)
+        if token.value == 'BETWEEN':
+            low = self._value()
+            if not self._accept(KEYWORD, 'AND'):
+                raise _error(exceptions.InvalidQuery(), self._peek(), ('AND',))
+            return nodes.Between(path, low, self._value(), negated, pos)
+        if token.value == 'IS':
+            isnull = not self._accept(KEYWORD, 'NOT')
+            value = self._next()
+            if not value.match(KEYWORD, 'NULL'):
+                raise _error(exceptions.InvalidIsParameter(value.text), value, ('NOT', 'NULL') if isnull else ('NULL',))
+            return nodes.IsNull(path, isnull, pos)
+        raise _error(exceptions.UnknownOperator(token.text), token, EXPECT_OPERATOR)
+
+    def _value(self):
+        token = self._next()
+        if token.kind not in VALUES:
+            raise _error(exceptions.InvalidQuery(), token, (VALUE,))
+        return nodes.Literal(token.kind, token.value, token.pos)
+
+    def _list(self):
+        parameter = self._accept(PARAMETER)
+        if parameter:
+            return nodes.Literal(PARAMETER, parameter.value, parameter.pos)
+        if not self._accept(PUNCTUATION, '('):
+            raise _error(exceptions.ParenthesisExpected('IN'), self._peek(), ('(', ':parameter'))
+        tokens = self.tokens
+        index = self.index
+        values = []
+        append = values.append
+        while True:
+            token = tokens[index]
+            if token.kind not in VALUES:
+                raise _error(exceptions.MalformedList('IN'), token, (VALUE,))
+            append(nodes.Literal(token.kind, token.value, token.pos))
+            separator = tokens[index + 1]
+            index += 2
+            if separator.kind != PUNCTUATION or separator.value == '(':
+                raise _error(exceptions.MalformedList('IN'), separator, (',', ')'))
+            if separator.value == ')':
+                self.index = index
+                return values
+
+
+def _error(error, token, expected):
+    error.position = token.pos
+    error.expected = expected
+    return error
@@ -0,0 +1,183 @@
+"""Validation of a query as it is typed, one edit at a time.
+
+    >>> editor = IncrementalParser(parser)
+    >>> result = editor.update("numfield > 1 and rel")
+    >>> result.diagnostics  # [Diagnostic('Query is incomplete, expected = or ...', 20, 20, ('=', ...), error)]
+    >>> result.completions  # ['related', 'related_id']
+    >>> editor.update("numfield > 1 and related.name = foo").diagnostics  # []
+
+Each update keeps the tokens of the previous query that end before the first
+changed character, and the conditions made only of those tokens with their
+diagnostics, so only what follows the edit is tokenized, parsed and checked.
+Diagnostics have the span of the query they are about, and syntax errors the
+tokens that were expected there. Field paths are completed from the field
+index of the parser.
+"""
+from collections import namedtuple
+from os.path import commonprefix
+from . import exceptions, grammar, lexer, nodes
+
+Diagnostic = namedtuple('Diagnostic', ['message', 'start', 'end', 'expected', 'error'])
+
+Validation = namedtuple('Validation', ['query', 'node', 'diagnostics', 'completions'])
+
+# Characters after a token that decide where it ends, like = after ! in a!=b
+_LOOKAHEAD = 2
+
+
+class IncrementalParser:
+
+    def __init__(self, parser, max_completions=20):
+        self.parser = parser
+        self.max_completions = max_completions
+        self._query = ''
+        self._tokens = []
+        self._conditions = {}
+        # Tokens and conditions taken from the previous query by the last update
+        self.reused_tokens = 0
+        self.reused_conditions = 0
+
+    def update(self, query):
+        """Validate query, the previous one after an edit, and return a
+        Validation with the syntax tree, or None on syntax errors, the
+        diagnostics and the completions of the field path being typed"""
+
+        changed = len(commonprefix([self._query, query]))
+        kept = 0
+        for token in self._tokens:
+            end = token.pos + len(token.text)
+            # Whitespace ends any token, like the end of the previous query did
+            if end + _LOOKAHEAD > changed and not (end <= changed and query[end:end + 1].isspace()):
+                break
+            kept += 1
+        tokens = self._tokens[:kept]
+        resume = tokens[-1].pos + len(tokens[-1].text) if tokens else 0
+        self.reused_tokens = kept
+
+        diagnostics = []
+        node = None
+        try:
+            lexer.tokenize(query, resume, tokens)
+        except exceptions.CustomQueryError as e:
+            diagnostics.append(_diagnostic(e, query, tokens))
+            # The conditions before the error are still checked
+            tokens.append(lexer.Token(lexer.END, None, '', e.position))
+            lexed = False
+        else:
+            lexed = True
+
+        parse = _Grammar(self, tokens, kept)
+        try:
+            node = parse.parse()
+        except exceptions.CustomQueryError as e:
+            if lexed:
+                diagnostics.append(_diagnostic(e, query, tokens))
+            node = None
+        if not lexed:
+            node = None
+        for start in sorted(parse.conditions):
+            diagnostics.extend(parse.conditions[start][2])
+        if node is not None and self.parser.max_predicates is not None and len(parse.conditions) > self.parser.max_predicates:
+            error = exceptions.TooManyPredicates(self.parser.max_predicates, tokens[max(parse.conditions)].pos)
+            diagnostics.append(_diagnostic(error, query, tokens))
+        diagnostics.sort(key=lambda diagnostic: diagnostic.start)
+
+        self._query = query
+        self._tokens = tokens[:-1]
+        self._conditions = parse.conditions
+        self.reused_conditions = parse.reused
+        return Validation(query, node, diagnostics, self._completions(query, tokens, parse, diagnostics))
+
+    def completions(self, prefix):
+        """Return the field paths starting with prefix, up to the next dot"""
+
+        prefix = prefix.replace('.', '__')
+        depth = prefix.count('__')
+        parser = self.parser
+        found = []
+        for path in parser._fields:
+            if path.startswith(prefix) and path.count('__') == depth:
+                if parser.denied_fields and parser._path_matches(path, parser.denied_fields):
+                    continue
+                if parser.allowed_fields is not None and not parser._path_matches(path, parser.allowed_fields):
+                    continue
+                found.append(path.replace('__', '.'))
+        found.sort()
+        return found[:self.max_completions]
+
+    def _completions(self, query, tokens, parse, diagnostics):
+        last = len(tokens) - 2
+        if last >= 0 and last in parse.subjects and not query[-1:].isspace():
+            return self.completions(tokens[last].text)
+        for diagnostic in diagnostics:
+            if diagnostic.expected and grammar.FIELD in diagnostic.expected and diagnostic.start >= len(query.rstrip()):
+                return self.completions('')
+        return []
+
+    def _check(self, node, tokens, start, end):
+        # Diagnostics of one condition, made of tokens[start:end]
+        diagnostics = []
+        subject = tokens[start]
+        try:
+            info = self.parser._get_field_info(node.path)
+            self.parser._check_field(node.path, node.pos)
+        except exceptions.CustomQueryError as e:
+            diagnostics.append(Diagnostic(str(e), subject.pos, subject.pos + len(subject.text), None, e))
+            return diagnostics
+        if isinstance(node, nodes.Comparison):
+            literals = [node.value]
+        elif isinstance(node, nodes.Between):
+            literals = [node.low, node.high]
+        elif isinstance(node, nodes.In) and isinstance(node.values, list):
+            literals = node.values
+        else:
+            literals = []
+        texts = {token.pos: token.text for token in tokens[start:end]}
+        for literal in literals:
+            if literal.kind == lexer.PARAMETER:
+                continue
+            try:
+                info.converter(literal)
+            except exceptions.CustomQueryError as e:
+                diagnostics.append(Diagnostic(str(e), literal.pos, literal.pos + len(texts[literal.pos]), None, e))
+        return diagnostics
+
+
+class _Grammar(grammar.Grammar):
+    """Grammar taking the conditions made of reused tokens from the previous parse"""
+
+    def __init__(self, editor, tokens, reusable):
+        super().__init__(tokens, editor.parser.max_depth)
+        self.editor = editor
+        self.reusable = reusable
+        self.conditions = {}
+        self.subjects = set()
+        self.reused = 0
+
+    def _predicate(self):
+        start = self.index
+        self.subjects.add(start)
+        previous = self.editor._conditions.get(start)
+        if previous is not None and previous[1] <= self.reusable:
+            self.index = previous[1]
+            self.conditions[start] = previous
+            self.reused += 1
+            return previous[0]
+        node = super()._predicate()
+        diagnostics = self.editor._check(node, self.tokens, start, self.index)
+        self.conditions[start] = (node, self.index, diagnostics)
+        return node
+
+
+def _diagnostic(error, query, tokens):
+    start = error.position if error.position is not None else 0
+    end = len(query)
+    # Errors are usually near the end
+    for token in reversed(tokens):
+        if token.pos == start and token.text:
+            end = start + len(token.text)
+            break
+    message = str(error)
+    if error.expected and start >= len(query.rstrip()):
+        message = "Query is incomplete, expected %s" % ' or '.join(error.expected)
+    return Diagnostic(message, start, end, error.expected, error)
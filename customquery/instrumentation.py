@@ -0,0 +1,233 @@
+"""Opt-in timing and counters for Parser.parse().
+
+Instrumented parses send one ParseRecord through the query_parsed signal.
+Parsers are instrumented with Parser(instrument=True), or all of them while
+a collect() block is running:
+
+    >>> with collect() as stats:
+    ...     parser.parse("numfield = 1")
+    >>> stats.as_dict()
+
+collect() gets the parses of every thread, those of parse_many() workers
+included, or only the ones of its own thread with all_threads=False. Parsers
+that are not instrumented run no extra code.
+"""
+from contextlib import contextmanager
+from copy import copy
+from threading import Lock, get_ident
+from time import perf_counter
+from django.dispatch import Signal
+from . import canonical, nodes
+
+# Sent with sender=Parser class, parser and record arguments
+query_parsed = Signal()
+
+PHASES = ('tokenize', 'grammar', 'check', 'optimize', 'resolve', 'fields', 'values')
+
+# Number of running collect() blocks
+active = 0
+_active_lock = Lock()
+
+
+class ParseRecord:
+    """Timings in seconds, exclusive of nested phases, and counters of one parse"""
+
+    def __init__(self, parser, query):
+        self.query = query
+        self.model = parser._get_model()._meta.label
+        # Whether the compiled query cache had the query
+        self.cached = False
+        self.thread = get_ident()
+        self.error = None
+        self.total = 0.0
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.calls = dict.fromkeys(PHASES, 0)
+        self.predicates = 0
+        self.in_values = 0
+        self.relations = 0
+        # Canonical text without literals, grouping queries of the same form
+        self.shape = None
+        self._stack = []
+
+    def timed(self, phase, function):
+        def timed(*args, **kwargs):
+            stack = self._stack
+            stack.append(0.0)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                self.timings[phase] += elapsed - stack.pop()
+                self.calls[phase] += 1
+                if stack:
+                    stack[-1] += elapsed
+        return timed
+
+    def count(self, node):
+        for child in nodes.walk(node):
+            path = getattr(child, 'path', None)
+            if path is None:
+                continue
+            self.predicates += 1
+            if isinstance(child, nodes.In) and isinstance(child.values, list):
+                self.in_values += len(child.values)
+            self.relations += path.count('__')
+
+    def as_dict(self):
+        return {
+            'query': self.query,
+            'model': self.model,
+            'cached': self.cached,
+            'error': self.error,
+            'total': self.total,
+            'timings': dict(self.timings),
+            'predicates': self.predicates,
+            'in_values': self.in_values,
+            'relations': self.relations,
+            'field_lookups': self.calls['fields'],
+            'shape': self.shape,
+        }
+
+    def __repr__(self):
+        return '<ParseRecord %r %.6fs>' % (self.query, self.total)
+
+
+def parse(parser, query):
+    """Run parser.parse(query) timing each phase, and send its ParseRecord"""
+
+    record = ParseRecord(parser, query)
+    # A shallow copy shares caches and the field index, but gets its own timed methods
+    probe = copy(parser)
+    for phase, method in (('tokenize', '_tokenize'), ('grammar', '_grammar'), ('optimize', '_optimize'),
+                          ('resolve', '_resolve_query'), ('fields', '_get_field_info'),
+                          ('values', '_get_value'), ('values', '_get_list')):
+        setattr(probe, method, record.timed(phase, getattr(probe, method)))
+    probe._cache = _CacheProbe(parser._cache, record)
+    check = probe._check
+
+    def counted_check(node):
+        record.count(node)
+        record.shape = canonical.canonicalize(node, strip_literals=True)
+        return check(node)
+    probe._check = record.timed('check', counted_check)
+
+    start = perf_counter()
+    try:
+        return probe._parse(query)
+    except Exception as e:
+        record.error = repr(e)
+        raise
+    finally:
+        record.total = perf_counter() - start
+        if record.shape is None and record.error is None:
+            # Cached parses skip the check, the parser caches the shape as well
+            record.shape = parser.canonical(query, strip_literals=True)
+        query_parsed.send(sender=type(parser), parser=parser, record=record)
+
+
+class _CacheProbe:
+    """The compiled query cache of a parser, telling the record whether the
+    query was found in it"""
+
+    def __init__(self, cache, record):
+        self._cache = cache
+        self._record = record
+
+    def get(self, key, default=None):
+        result = self._cache.get(key, default)
+        self._record.cached = result is not default
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+
+class Stats:
+    """Aggregated ParseRecords"""
+
+    def __init__(self, slowest=10):
+        self.parses = 0
+        self.cached = 0
+        self.errors = 0
+        self.total = 0.0
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.predicates = 0
+        self.in_values = 0
+        self.relations = 0
+        self.field_lookups = 0
+        self.slowest = []
+        self.shapes = {}
+        self._keep = slowest
+        self._lock = Lock()
+
+    def add(self, record, **kwargs):
+        with self._lock:
+            self.parses += 1
+            self.cached += record.cached
+            self.errors += record.error is not None
+            self.total += record.total
+            for phase, elapsed in record.timings.items():
+                self.timings[phase] += elapsed
+            self.predicates += record.predicates
+            self.in_values += record.in_values
+            self.relations += record.relations
+            self.field_lookups += record.calls['fields']
+            if record.shape is not None:
+                shape = self.shapes.setdefault(record.shape, {'shape': record.shape, 'parses': 0, 'total': 0.0})
+                shape['parses'] += 1
+                shape['total'] += record.total
+            if self._keep:
+                self.slowest.append(record)
+                self.slowest.sort(key=lambda record: record.total, reverse=True)
+                del self.slowest[self._keep:]
+
+    def as_dict(self):
+        return {
+            'parses': self.parses,
+            'cached': self.cached,
+            'errors': self.errors,
+            'total': self.total,
+            'timings': dict(self.timings),
+            'predicates': self.predicates,
+            'in_values': self.in_values,
+            'relations': self.relations,
+            'field_lookups': self.field_lookups,
+            'slowest': [record.as_dict() for record in self.slowest],
+            'shapes': self.top_shapes(),
+        }
+
+    def top_shapes(self, count=None):
+        """Return the query shapes by decreasing total parse time, with their
+        number of parses, at most count of them or slowest by default"""
+        with self._lock:
+            shapes = sorted((dict(shape) for shape in self.shapes.values()),
+                            key=lambda shape: shape['total'], reverse=True)
+        return shapes[:self._keep if count is None else count]
+
+
+@contextmanager
+def collect(slowest=10, all_threads=True):
+    """Instrument every parser while the block runs, and aggregate their
+    records, from every thread or only the current one"""
+
+    global active
+    stats = Stats(slowest)
+    thread = get_ident()
+
+    def receiver(sender, record, **kwargs):
+        if all_threads or record.thread == thread:
+            stats.add(record)
+
+    query_parsed.connect(receiver, weak=False)
+    with _active_lock:
+        active += 1
+    try:
+        yield stats
+    finally:
+        with _active_lock:
+            active -= 1
+        query_parsed.disconnect(receiver)
@@ -0,0 +1,112 @@
+"""Compact, versioned representation of a syntax tree made of lists, strings
+and numbers, so parsed queries can be stored as JSON or msgpack and shared
+between processes.
+
+    ['c', path, op, literal, pos]               Comparison
+    ['i', path, negated, [literal, ...], pos]   In, or a single parameter literal
+    ['z', path, isnull, pos]                    IsNull
+    ['b', path, negated, low, high, pos]        Between
+    ['!', operand, pos]                         Not
+    ['&', [operand, ...], pos]                  AND
+    ['|', [operand, ...], pos]                  OR
+    [kind, value, pos]                          Literal, kind is one of s n w p
+"""
+import json
+from . import exceptions, nodes
+from .lexer import STRING, NUMBER, WORD, PARAMETER
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+VERSION = 1
+
+KINDS = {STRING: 's', NUMBER: 'n', WORD: 'w', PARAMETER: 'p'}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+
+CONNECTORS = {'AND': '&', 'OR': '|'}
+
+
+def dump(node):
+    """Return [VERSION, tree] for a syntax tree"""
+    return [VERSION, _dump(node)]
+
+
+def load(data):
+    """Return the syntax tree for data created by dump()"""
+    if not isinstance(data, (list, tuple)) or len(data) != 2 or data[0] != VERSION:
+        raise exceptions.IncompatibleIR(data)
+    return _load(data[1])
+
+
+def to_json(node):
+    return json.dumps(dump(node), separators=(',', ':'))
+
+
+def from_json(data):
+    return load(json.loads(data))
+
+
+def to_msgpack(node):
+    if msgpack is None:
+        raise ImportError("msgpack is required for msgpack serialization")
+    return msgpack.packb(dump(node))
+
+
+def from_msgpack(data):
+    if msgpack is None:
+        raise ImportError("msgpack is required for msgpack serialization")
+    return load(msgpack.unpackb(data))
+
+
+def _literal(literal):
+    return [KINDS[literal.kind], literal.value, literal.pos]
+
+
+def _dump(node):
+    if isinstance(node, nodes.Comparison):
+        return ['c', node.path, node.op, _literal(node.value), node.pos]
+    if isinstance(node, nodes.In):
+        if isinstance(node.values, nodes.Literal):
+            values = _literal(node.values)
+        else:
+            values = [_literal(value) for value in node.values]
+        return ['i', node.path, int(node.negated), values, node.pos]
+    if isinstance(node, nodes.IsNull):
+        return ['z', node.path, int(node.isnull), node.pos]
+    if isinstance(node, nodes.Between):
+        return ['b', node.path, int(node.negated), _literal(node.low), _literal(node.high), node.pos]
+    if isinstance(node, nodes.Not):
+        return ['!', _dump(node.operand), node.pos]
+    if isinstance(node, nodes.BoolOp):
+        return [CONNECTORS[node.connector], [_dump(operand) for operand in node.operands], node.pos]
+    raise exceptions.IncompatibleIR(node)
+
+
+def _load_literal(data):
+    return nodes.Literal(KIND_NAMES[data[0]], data[1], data[2])
+
+
+def _load(data):
+    code = data[0]
+    if code == 'c':
+        return nodes.Comparison(data[1], data[2], _load_literal(data[3]), data[4])
+    if code == 'i':
+        values = data[3]
+        if values and isinstance(values[0], (list, tuple)):
+            values = [_load_literal(value) for value in values]
+        else:
+            values = _load_literal(values)
+        return nodes.In(data[1], values, bool(data[2]), data[4])
+    if code == 'z':
+        return nodes.IsNull(data[1], bool(data[2]), data[3])
+    if code == 'b':
+        return nodes.Between(data[1], _load_literal(data[3]), _load_literal(data[4]), bool(data[2]), data[5])
+    if code == '!':
+        return nodes.Not(_load(data[1]), data[2])
+    if code == '&':
+        return nodes.BoolOp('AND', [_load(operand) for operand in data[1]], data[2])
+    if code == '|':
+        return nodes.BoolOp('OR', [_load(operand) for operand in data[1]], data[2])
+    raise exceptions.IncompatibleIR(data)
@@ -0,0 +1,94 @@
+import re
+from . import exceptions
+
+KEYWORDS = frozenset(['AND', 'OR', 'NOT', 'IN', 'IS', 'NULL', 'BETWEEN'])
+
+STRING = 'STRING'
+NUMBER = 'NUMBER'
+WORD = 'WORD'
+KEYWORD = 'KEYWORD'
+OPERATOR = 'OPERATOR'
+PUNCTUATION = 'PUNCTUATION'
+PARAMETER = 'PARAMETER'
+END = 'END'
+
+# A word ends at whitespace, punctuation, an operator, a quote or the end of the query
+_boundary = r"""(?=[\s()=<>,'"]|!=|\Z)"""
+
+_token_re = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")
+  | (?P<operator><>|!=|>=|<=|=|<|>)
+  | (?P<punctuation>[(),])
+  | (?P<number>-?\d+)%(boundary)s
+  | (?P<keyword>(?i:AND|OR|NOT|IN|IS|NULL|BETWEEN))%(boundary)s
+  | (?P<parameter>:[A-Za-z_]\w*)%(boundary)s
+  | (?P<word>(?:[^\s()=<>!,'"]|!(?!=))+)
+  | (?P<end>\Z)
+)""" % {'boundary': _boundary}, re.VERBOSE)
+
+
+class Token:
+    __slots__ = ('kind', 'value', 'text', 'pos')
+
+    def __init__(self, kind, value, text, pos):
+        self.kind = kind
+        self.value = value
+        self.text = text
+        self.pos = pos
+
+    def match(self, kind, value=None):
+        return self.kind == kind and (value is None or self.value == value)
+
+    def __repr__(self):
+        return '<Token %s %r at %d>' % (self.kind, self.text, self.pos)
+
+
+def tokenize(query, pos=0, tokens=None):
+    """Split a query into a list of tokens, always terminated by an END token.
+
+    Tokens are appended to tokens when given, starting at offset pos, so on
+    an error it holds the tokens found before it."""
+
+    if tokens is None:
+        tokens = []
+    append = tokens.append
+    match = _token_re.match
+    while True:
+        m = match(query, pos)
+        if m is None:
+            raise _error(query, pos)
+        kind = m.lastgroup
+        start = m.start(kind)
+        text = m.group(kind)
+        if kind == 'number':
+            append(Token(NUMBER, text, text, start))
+        elif kind == 'word':
+            append(Token(WORD, text, text, start))
+        elif kind == 'punctuation':
+            append(Token(PUNCTUATION, text, text, start))
+        elif kind == 'string':
+            quote = text[0]
+            append(Token(STRING, text[1:-1].replace(quote * 2, quote), text, start))
+        elif kind == 'operator':
+            append(Token(OPERATOR, text, text, start))
+        elif kind == 'keyword':
+            append(Token(KEYWORD, text.upper(), text, start))
+        elif kind == 'parameter':
+            append(Token(PARAMETER, text[1:], text, start))
+        else:
+            append(Token(END, None, '', start))
+            return tokens
+        pos = m.end()
+
+
+def _error(query, pos):
+    # Only an unclosed quote matches no token
+    start = len(query) - len(query[pos:].lstrip())
+    quote = query[start:start + 1]
+    if quote in ('"', "'"):
+        error = exceptions.UnterminatedString(quote)
+        error.expected = (quote,)
+    else:
+        error = exceptions.InvalidQuery()
+    error.position = start
+    return error
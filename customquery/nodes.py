@@ -0,0 +1,209 @@
+"""Syntax tree built by the grammar and resolved by Parser into Q objects"""
+
+
+class Node:
+    __slots__ = ('pos',)
+
+    def key(self):
+        """Hashable tuple describing the node, equal for structurally equal nodes"""
+        raise NotImplementedError
+
+
+class Literal(Node):
+    __slots__ = ('kind', 'value')
+
+    def __init__(self, kind, value, pos):
+        self.kind = kind
+        self.value = value
+        self.pos = pos
+
+    def key(self):
+        return (self.kind, self.value)
+
+    def __repr__(self):
+        return 'Literal(%s, %r)' % (self.kind, self.value)
+
+
+class Comparison(Node):
+    """path <op> value, where op is one of = != > >= < <="""
+    __slots__ = ('path', 'op', 'value')
+
+    def __init__(self, path, op, value, pos):
+        self.path = path
+        self.op = op
+        self.value = value
+        self.pos = pos
+
+    def key(self):
+        return ('COMPARISON', self.path, self.op, self.value.key())
+
+    def __repr__(self):
+        return 'Comparison(%s %s %r)' % (self.path, self.op, self.value)
+
+
+class In(Node):
+    """values is a list of literals, or a single parameter literal bound to a sequence"""
+    __slots__ = ('path', 'values', 'negated')
+
+    def __init__(self, path, values, negated, pos):
+        self.path = path
+        self.values = values
+        self.negated = negated
+        self.pos = pos
+
+    def key(self):
+        if isinstance(self.values, Literal):
+            values = self.values.key()
+        else:
+            values = tuple(value.key() for value in self.values)
+        return ('IN', self.path, self.negated, values)
+
+    def __repr__(self):
+        return 'In(%s%s %r)' % (self.path, ' NOT' if self.negated else '', self.values)
+
+
+class IsNull(Node):
+    __slots__ = ('path', 'isnull')
+
+    def __init__(self, path, isnull, pos):
+        self.path = path
+        self.isnull = isnull
+        self.pos = pos
+
+    def key(self):
+        return ('ISNULL', self.path, self.isnull)
+
+    def __repr__(self):
+        return 'IsNull(%s, %s)' % (self.path, self.isnull)
+
+
+class Between(Node):
+    __slots__ = ('path', 'low', 'high', 'negated')
+
+    def __init__(self, path, low, high, negated, pos):
+        self.path = path
+        self.low = low
+        self.high = high
+        self.negated = negated
+        self.pos = pos
+
+    def key(self):
+        return ('BETWEEN', self.path, self.negated, self.low.key(), self.high.key())
+
+    def __repr__(self):
+        return 'Between(%s%s %r %r)' % (self.path, ' NOT' if self.negated else '', self.low, self.high)
+
+
+class Not(Node):
+    __slots__ = ('operand',)
+
+    def __init__(self, operand, pos):
+        self.operand = operand
+        self.pos = pos
+
+    def key(self):
+        return ('NOT', self.operand.key())
+
+    def __repr__(self):
+        return 'Not(%r)' % (self.operand,)
+
+
+class BoolOp(Node):
+    """AND / OR over two or more operands"""
+    __slots__ = ('connector', 'operands')
+
+    def __init__(self, connector, operands, pos):
+        self.connector = connector
+        self.operands = operands
+        self.pos = pos
+
+    def key(self):
+        return (self.connector, tuple(operand.key() for operand in self.operands))
+
+    def __repr__(self):
+        return 'BoolOp(%s, %r)' % (self.connector, self.operands)
+
+
+def walk(node):
+    """Yield node and all its descendants, depth first"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, BoolOp):
+            stack.extend(reversed(node.operands))
+        elif isinstance(node, Not):
+            stack.append(node.operand)
+
+
+# Kinds of conditions through a to-many relation, see relation_conditions()
+POSITIVE = 'positive'
+NEGATIVE = 'negative'
+ISNULL = 'isnull'
+
+
+def fold_not(node):
+    """Return node without the NOTs that cancel out, like ~Q does: NOT NOT x
+    is x, and NOT of a negated condition is the condition"""
+
+    negated = False
+    while isinstance(node, Not):
+        node = node.operand
+        negated = not negated
+    if not negated:
+        return node
+    if isinstance(node, Comparison) and node.op == '!=':
+        return Comparison(node.path, '=', node.value, node.pos)
+    if isinstance(node, In) and node.negated:
+        return In(node.path, node.values, False, node.pos)
+    if isinstance(node, Between) and node.negated:
+        return Between(node.path, node.low, node.high, False, node.pos)
+    return Not(node, node.pos)
+
+
+def relation_conditions(node, relation):
+    """Return the kinds of the conditions through each to-many relation, in
+    query order, by the relation relation(condition) returns (None for none).
+
+    In one filter() call Django checks the POSITIVE conditions and IS NULL
+    through a relation on one joined row. NEGATIVE ones, negated or under
+    NOT, are subqueries of their own until the relation is joined, and then
+    checked on the joined row. NOT BETWEEN is two of them, one per bound."""
+
+    found = {}
+
+    def visit(node, negated):
+        node = fold_not(node)
+        if isinstance(node, Not):
+            visit(node.operand, True)
+        elif isinstance(node, BoolOp):
+            for operand in node.operands:
+                visit(operand, negated)
+        else:
+            prefix = relation(node)
+            if prefix is None:
+                return
+            kinds = found.setdefault(prefix, [])
+            negated = negated or getattr(node, 'negated', False) or getattr(node, 'op', None) == '!='
+            if isinstance(node, Between) and negated:
+                kinds.extend([NEGATIVE, NEGATIVE])
+            elif negated:
+                kinds.append(NEGATIVE)
+            elif isinstance(node, IsNull):
+                kinds.append(ISNULL)
+            else:
+                kinds.append(POSITIVE)
+    visit(node, False)
+    return found
+
+
+def shares_row(kinds):
+    """Whether conditions of these kinds through one relation all hold on one
+    related row, an EXISTS of their conditions"""
+    return len(kinds) == 1 or set(kinds) == {POSITIVE}
+
+
+def order_dependent(kinds):
+    """Whether conditions of these kinds through one relation match other rows
+    when reordered: negations and IS NULL along with other conditions"""
+    return len(kinds) > 1 and set(kinds) not in ({POSITIVE}, {NEGATIVE})
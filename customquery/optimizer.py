@@ -0,0 +1,170 @@
+"""Rewrites a syntax tree into an equivalent, smaller one before it becomes Q objects:
+
+- nested AND/OR of the same connector are flattened into a single node
+- duplicate operands of AND/OR are removed
+- double negations are folded, and NOT is pushed into IN, BETWEEN and !=
+- ORed equalities on a field become a single IN
+- ANDed ranges (>, >=, <, <=, BETWEEN) on a field are reduced to the tightest bounds
+"""
+from datetime import date, datetime, time
+from decimal import Decimal
+from . import nodes
+from .lexer import PARAMETER
+
+# Ranges are only merged when Python and the database agree on ordering
+ORDERED_TYPES = (int, float, Decimal, date, datetime, time)
+
+NEGATED_OPERATORS = {'=': '!=', '!=': '='}
+
+
+def optimize(node, convert):
+    """Return an optimized copy of node, where convert(path, literal) gives the
+    Python value a literal has for the field at path"""
+    return Optimizer(convert).optimize(node)
+
+
+class Optimizer:
+
+    def __init__(self, convert):
+        self.convert = convert
+
+    def optimize(self, node):
+        if isinstance(node, nodes.Not):
+            return self._negate(self.optimize(node.operand), node.pos)
+        if isinstance(node, nodes.BoolOp):
+            return self._operate(node)
+        return node
+
+    def _negate(self, operand, pos):
+        if isinstance(operand, nodes.Not):
+            return operand.operand
+        if isinstance(operand, nodes.In):
+            return nodes.In(operand.path, operand.values, not operand.negated, operand.pos)
+        if isinstance(operand, nodes.Between):
+            return nodes.Between(operand.path, operand.low, operand.high, not operand.negated, operand.pos)
+        if isinstance(operand, nodes.Comparison) and operand.op in NEGATED_OPERATORS:
+            return nodes.Comparison(operand.path, NEGATED_OPERATORS[operand.op], operand.value, operand.pos)
+        return nodes.Not(operand, pos)
+
+    def _operate(self, node):
+        operands = []
+        seen = set()
+        for operand in self._flatten(node.connector, node.operands):
+            key = operand.key()
+            if key not in seen:
+                seen.add(key)
+                operands.append(operand)
+
+        if node.connector == 'OR':
+            operands = self._merge_equalities(operands)
+        else:
+            operands = self._merge_ranges(operands)
+
+        if len(operands) == 1:
+            return operands[0]
+        return nodes.BoolOp(node.connector, operands, node.pos)
+
+    def _flatten(self, connector, operands):
+        for operand in operands:
+            operand = self.optimize(operand)
+            if isinstance(operand, nodes.BoolOp) and operand.connector == connector:
+                yield from operand.operands
+            else:
+                yield operand
+
+    def _merge_equalities(self, operands):
+        groups = {}
+        for operand in operands:
+            values = self._equality_values(operand)
+            if values is not None:
+                groups.setdefault(operand.path, []).append((operand, values))
+
+        merged = {}
+        for path, group in groups.items():
+            if len(group) < 2:
+                continue
+            values = {}
+            for operand, literals in group:
+                for literal in literals:
+                    values.setdefault(literal.key(), literal)
+                merged[id(operand)] = None
+            first = group[0][0]
+            merged[id(first)] = nodes.In(path, list(values.values()), False, first.pos)
+
+        if not merged:
+            return operands
+        return [merged.get(id(operand), operand) for operand in operands
+                if merged.get(id(operand), operand) is not None]
+
+    def _equality_values(self, operand):
+        if isinstance(operand, nodes.Comparison) and operand.op == '=':
+            values = [operand.value]
+        elif isinstance(operand, nodes.In) and not operand.negated and isinstance(operand.values, list):
+            values = operand.values
+        else:
+            return None
+        if any(value.kind == PARAMETER for value in values):
+            return None
+        return values
+
+    def _merge_ranges(self, operands):
+        groups = {}
+        for operand in operands:
+            bounds = self._bounds(operand)
+            if bounds is not None:
+                groups.setdefault(operand.path, []).append((operand, bounds))
+
+        merged = {}
+        for path, group in groups.items():
+            if len(group) < 2:
+                continue
+            try:
+                replacement = self._tightest(path, [bound for operand, bounds in group for bound in bounds])
+            except TypeError:
+                # Values of different types can't be ordered, leave them alone
+                continue
+            for operand, bounds in group:
+                merged[id(operand)] = None
+            merged[id(group[0][0])] = replacement
+
+        if not merged:
+            return operands
+        result = []
+        for operand in operands:
+            replacement = merged.get(id(operand), operand)
+            if replacement is None:
+                continue
+            if isinstance(replacement, list):
+                result.extend(replacement)
+            else:
+                result.append(replacement)
+        return result
+
+    def _bounds(self, operand):
+        if isinstance(operand, nodes.Comparison) and operand.op in ('>', '>=', '<', '<='):
+            bounds = [(operand.op, operand.value)]
+        elif isinstance(operand, nodes.Between) and not operand.negated:
+            bounds = [('>=', operand.low), ('<=', operand.high)]
+        else:
+            return None
+        result = []
+        for op, literal in bounds:
+            if literal.kind == PARAMETER:
+                return None
+            value = self.convert(operand.path, literal)
+            if not isinstance(value, ORDERED_TYPES):
+                return None
+            result.append((op, value, literal))
+        return result
+
+    def _tightest(self, path, bounds):
+        lower = upper = None
+        for op, value, literal in bounds:
+            if op in ('>', '>='):
+                if lower is None or value > lower[1] or value == lower[1] and op == '>':
+                    lower = (op, value, literal)
+            else:
+                if upper is None or value < upper[1] or value == upper[1] and op == '<':
+                    upper = (op, value, literal)
+        return [nodes.Comparison(path, bound[0], bound[2], bound[2].pos)
+                for bound in (lower, upper) if bound is not None]
@@ -1,179 +1,960 @@
-from sqlparse import parse, tokens as t, sql
-from datetime import datetime, date
+import asyncio
+from collections import namedtuple
+from concurrent import futures
+from copy import copy, deepcopy
+import hashlib
+import warnings
+import weakref
+from asgiref.sync import sync_to_async
 from django.core import exceptions as django_exceptions
-from . import exceptions
-from django.db.models import fields, Q, QuerySet
+from . import canonical, converters as converter_registry, estimate, evaluator, exceptions, grammar, instrumentation, ir, lexer, nodes, optimizer, stream
+from .cache import LRUCache
+from .expressions import ValuesTable
+from .sql import SQLCompiler
+from .lexer import STRING, PARAMETER
+from django.core.cache import caches
+from django.db.models import fields, Exists, F, OuterRef, Q, QuerySet
+
+FieldInfo = namedtuple('FieldInfo', ['path', 'field', 'hops', 'converter'])
+
+ParseResult = namedtuple('ParseResult', ['query', 'q', 'error'])
+
+Relation = namedtuple('Relation', ['path', 'many', 'lookup'])
+
+# Kinds of results built from a query besides its Q object
+_DERIVED = ('relations', 'canonical text', 'sql', 'predicate', 'mask')
+
 
 class Parser:
 
-    def __init__(self, model, date_format='%Y-%m-%d'):
+    def __init__(self, model, date_format='%Y-%m-%d', cache_size=128, relation_depth=1,
+                 optimize=False, in_chunk_size=None, in_table_threshold=None,
+                 max_depth=100, max_predicates=None, max_in_size=None, max_relations=None,
+                 allowed_fields=None, denied_fields=None, require_index=None, shared_cache=None,
+                 instrument=False, converters=None, to_many='join', to_many_strategies=None,
+                 annotations=None):
         self.model = model
+        self.annotations = dict(annotations or {})
         self.date_format = date_format
+        self.converters = dict(converters) if converters else None
+        self.relation_depth = relation_depth
+        self.optimize = optimize
+        self.in_chunk_size = in_chunk_size
+        self.in_table_threshold = in_table_threshold
+        self.max_depth = max_depth
+        self.max_predicates = max_predicates
+        self.max_in_size = max_in_size
+        self.max_relations = max_relations
+        self.allowed_fields = self._normalize_paths(allowed_fields)
+        self.denied_fields = self._normalize_paths(denied_fields)
+        if require_index not in (None, 'warn', 'error'):
+            raise ValueError("require_index must be None, 'warn' or 'error'")
+        self.require_index = require_index
+        strategies = dict(to_many_strategies or {})
+        for strategy in [to_many] + list(strategies.values()):
+            if strategy not in ('join', 'exists'):
+                raise ValueError("to_many strategies must be 'join' or 'exists'")
+        self.to_many = to_many
+        self.to_many_strategies = {path.replace('.', '__'): strategy for path, strategy in strategies.items()}
+        self._exists_prefixes = {}
+        self._cache = LRUCache(cache_size)
+        # What else is built from a query, each kind in its own cache
+        self._derived = {kind: LRUCache(cache_size) for kind in _DERIVED}
+        self._fields = self._index_fields()
+        self._shared_alias = None
+        if isinstance(shared_cache, str):
+            self._shared_alias = shared_cache
+            shared_cache = caches[shared_cache]
+        self.shared_cache = shared_cache
+        self._shared_prefix = None
+        self.instrument = instrument
+        self._pending = weakref.WeakKeyDictionary()
 
     def parse(self, query):
         """Parse SQL-like condition statements and return Django Q objects"""
 
-        result = Q()
-        parsed = parse(query)[0]
-        return self._resolve(parsed.tokens)
-
-    def _resolve(self, tokens):
-        tokens = self._strip_whitespaces(tokens)
-        if len(tokens) == 1:
-            return self._resolve(tokens[0])
-        if tokens[0].match(t.Token.Punctuation, '('):
-            tokens = self._get_group(tokens)
-        operator = tokens[1]
-        if operator.ttype is t.Token.Keyword:
-            if operator.match(t.Token.Keyword, 'BETWEEN'):
-                assert(len(tokens) == 5)
-                return self._between(tokens[0], tokens[2], tokens[4])
-            elif operator.match(t.Token.Keyword, 'NOT'):
-                if len(tokens) == 3:
-                    return self._compare(*tokens)
-                if len(tokens) == 4 and tokens[2].match(t.Token.Keyword, 'IN'):
-                    return ~self._in(tokens[0], tokens[3])
-                raise exceptions.InvalidQuery()
-            if operator.match(t.Token.Keyword, 'IN'):
-                return self._in(tokens[0], tokens[2])
-            if operator.match(t.Token.Keyword, 'IS'):
-                return self._is(tokens[0], tokens[2])
+        if self.instrument or instrumentation.active:
+            return instrumentation.parse(self, query)
+        return self._parse(query)
+
+    def parse_many(self, queries, executor=None, workers=None, chunk_size=None):
+        """Parse a batch of queries, returning a ParseResult(query, q, error) for
+        each of them in order. Errors are collected instead of raised.
+
+        executor can be 'thread' or 'process' to run on a pool of workers, or
+        any concurrent.futures.Executor. Queries are sent to it in chunks."""
+
+        queries = list(queries)
+        # Repeated queries are parsed once
+        unique = list(dict.fromkeys(queries))
+        if executor is None:
+            parsed = _parse_chunk(self, unique)
+        else:
+            own = isinstance(executor, str)
+            if own:
+                executor = self._make_executor(executor, workers)
+            try:
+                if chunk_size is None:
+                    chunk_size = max(1, -(-len(unique) // ((workers or 4) * 4)))
+                chunks = [unique[i:i + chunk_size] for i in range(0, len(unique), chunk_size)]
+                parsed = []
+                for result in executor.map(_parse_chunk, [self] * len(chunks), chunks):
+                    parsed.extend(result)
+            finally:
+                if own:
+                    executor.shutdown()
+
+        results = dict(zip(unique, parsed))
+        output = []
+        seen = set()
+        for query in queries:
+            q, error = results[query]
+            if query in seen and q is not None:
+                q = deepcopy(q)
+            seen.add(query)
+            output.append(ParseResult(query, q, error))
+        return output
+
+    def _make_executor(self, kind, workers):
+        if kind == 'thread':
+            return futures.ThreadPoolExecutor(workers)
+        if kind == 'process':
+            return futures.ProcessPoolExecutor(workers)
+        raise ValueError("executor must be 'thread', 'process' or an Executor")
+
+    def __copy__(self):
+        # Shallow copies share the caches and the field index
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        return clone
+
+    def __getstate__(self):
+        # The cache holds a lock and converters are closures, both are rebuilt
+        state = self.__dict__.copy()
+        del state['_cache'], state['_derived'], state['_fields'], state['_pending']
+        state['cache_size'] = self._cache.maxsize
+        if isinstance(self.model, QuerySet):
+            # Pickling a QuerySet would run it
+            state['model'] = (self.model.model, self.model.query)
+        if self.shared_cache is not None:
+            state['shared_cache'] = self._shared_alias
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        self._cache = LRUCache(state['cache_size'])
+        self._derived = {kind: LRUCache(state['cache_size']) for kind in _DERIVED}
+        del state['cache_size']
+        if isinstance(state['model'], tuple):
+            model, query = state['model']
+            state['model'] = QuerySet(model=model, query=query)
+        if isinstance(state['shared_cache'], str):
+            state['shared_cache'] = caches[state['shared_cache']]
+        self.__dict__.update(state)
+        self._fields = self._index_fields()
+        self._pending = weakref.WeakKeyDictionary()
+
+    async def aparse(self, query):
+        """Async parse(): cached queries are returned right away, others are
+        parsed in a worker thread. Concurrent calls for the same query on an
+        event loop share a single parse."""
+
+        if self._cache.maxsize and query in self._cache:
+            return self.parse(query)
+        loop = asyncio.get_running_loop()
+        pending = self._pending.setdefault(loop, {})
+        task = pending.get(query)
+        if task is None:
+            task = pending[query] = loop.create_task(sync_to_async(self.parse, thread_sensitive=False)(query))
+            task.add_done_callback(lambda task: pending.pop(query, None))
+        # A cancelled caller does not cancel the parse the others are waiting for
+        result = await asyncio.shield(task)
+        return deepcopy(result)
+
+    async def afilter(self, query, queryset=None):
+        """Return queryset, or all objects of the parser model, filtered by query"""
+        return self._filter(await self.aparse(query), queryset)
+
+    async def aiterator(self, query, queryset=None, chunk_size=2000):
+        """Iterate asynchronously over the objects matching query"""
+        queryset = await self.afilter(query, queryset)
+        async for obj in queryset.aiterator(chunk_size=chunk_size):
+            yield obj
+
+    async def acount(self, query, queryset=None):
+        return await (await self.afilter(query, queryset)).acount()
+
+    async def aexists(self, query, queryset=None):
+        return await (await self.afilter(query, queryset)).aexists()
+
+    def stream(self, query, queryset=None, fields=None, ordering=('pk',), chunk_size=1000):
+        """Yield the objects matching query in keyset order, chunk_size rows
+        at a time, or dicts of fields when fields are given"""
+
+        queryset = self.filter(query, queryset)
+        if fields is None:
+            yield from stream.keyset(queryset, ordering, chunk_size)
+            return
+        fields = list(fields)
+        # The values of the ordering are needed to find the next chunk
+        keys = [name.lstrip('-') for name in stream._unique_ordering(ordering)]
+        extra = [name for name in keys if name not in fields]
+        for row in stream.keyset(queryset.values(*fields, *extra), ordering, chunk_size):
+            yield {name: row[name] for name in fields} if extra else row
+
+    def filter(self, query, queryset=None, load_related=False):
+        """Return queryset, or all objects of the parser model, filtered by
+        query and annotated with the registered annotations it uses. With
+        load_related, the relations it uses are loaded too."""
+        result = self._filter(self.parse(query), queryset)
+        if load_related:
+            result = self.load_related(result, query)
+        return result
+
+    def estimate_count(self, query, queryset=None, **options):
+        """Return an Estimate of the number of objects matching query, see
+        customquery.estimate.estimate_count() for options"""
+        return estimate.estimate_count(self.filter(query, queryset), **options)
+
+    def relations(self, query):
+        """Return the relations query goes through, as Relation(path, many,
+        lookup) where many is true when the path goes through a to-many
+        relation, and lookup is the path for prefetch_related()"""
+
+        cache = self._derived['relations']
+        result = cache.get(query)
+        if result is None:
+            found = {}
+            for child in nodes.walk(self._parse_tree(query)):
+                path = getattr(child, 'path', None)
+                if path is None:
+                    continue
+                parts = path.split('__')
+                many = False
+                lookup = []
+                for i in range(1, len(parts) + 1):
+                    prefix = '__'.join(parts[:i])
+                    field = self._get_field_info(prefix).field
+                    if field is None or not field.is_relation:
+                        break
+                    many = many or field.one_to_many or field.many_to_many
+                    # Reverse relations are reached through their accessor, mymodel_set
+                    lookup.append(field.get_accessor_name() if field.auto_created and not field.concrete
+                                  else field.name)
+                    found[prefix] = Relation(prefix, many, '__'.join(lookup))
+            result = tuple(sorted(found.values()))
+            cache.set(query, result)
+        return result
+
+    def load_related(self, queryset, query):
+        """Return queryset with select_related() for the to-one relations query
+        goes through and prefetch_related() for the to-many ones"""
+
+        relations = self.relations(query)
+        single = [relation.path for relation in relations if not relation.many]
+        many = [relation.lookup for relation in relations if relation.many]
+        # Prefetching a__b prefetches a as well, and selecting a__b selects a
+        single = [path for path in single if not any(other.startswith(path + '__') for other in single)]
+        many = [lookup for lookup in many if not any(other.startswith(lookup + '__') for other in many)]
+        if single:
+            queryset = queryset.select_related(*single)
+        if many:
+            queryset = queryset.prefetch_related(*many)
+        return queryset
+
+    def _filter(self, q, queryset=None):
+        queryset = self._get_queryset(queryset)
+        if self.annotations:
+            names = [name for name in self._referenced_annotations(q) if name not in queryset.query.annotations]
+            if names:
+                queryset = queryset.annotate(**{name: self.annotations[name] for name in names})
+        return queryset.filter(q)
+
+    def _referenced_annotations(self, q):
+        # Registered annotations used by q, after the ones they use themselves
+        names = []
+
+        def add(name):
+            if name in names:
+                return
+            for expression in self.annotations[name].flatten():
+                if isinstance(expression, F) and expression.name in self.annotations:
+                    add(expression.name)
+            names.append(name)
+
+        stack = [q]
+        while stack:
+            for child in stack.pop().children:
+                if isinstance(child, Q):
+                    stack.append(child)
+                elif isinstance(child, tuple):
+                    name = child[0].split('__', 1)[0]
+                    if name in self.annotations:
+                        add(name)
+        return names
+
+    def _get_queryset(self, queryset=None):
+        if queryset is not None:
+            return queryset
+        if isinstance(self.model, QuerySet):
+            return self.model.all()
+        return self.model._default_manager.all()
+
+    def _parse(self, query):
+        if not self._cache.maxsize:
+            return self._resolve_query(self._parse_tree(query))
+        result = self._cache.get(query)
+        if result is None:
+            result = self._resolve_query(self._parse_tree(query))
+            self._cache.set(query, result)
+        # Q objects are mutable, never hand out the cached instance
+        return deepcopy(result)
+
+    def cache_info(self):
+        """Return hits, misses, maxsize and currsize of the compiled query cache"""
+        return self._cache.info()
+
+    def cache_clear(self):
+        self._cache.clear()
+        for cache in self._derived.values():
+            cache.clear()
+
+    def canonical(self, query, strip_literals=False):
+        """Return the canonical text of query, equal for queries that only
+        differ in keyword case, quoting, whitespace, parenthesis and the order
+        of AND/OR operands, with every value replaced by ? if strip_literals.
+        Operands whose order changes the rows through a to-many relation keep it."""
+
+        cache = self._derived['canonical text']
+        key = (strip_literals, query)
+        result = cache.get(key)
+        if result is None:
+            result = canonical.canonicalize(self._parse_tree(query), strip_literals,
+                                            lambda leaf: self._to_many_prefix(leaf.path))
+            cache.set(key, result)
+        return result
+
+    def fingerprint(self, query, strip_literals=False):
+        """Return a hex digest of the canonical text of query"""
+        return hashlib.sha1(self.canonical(query, strip_literals).encode()).hexdigest()
+
+    def parse_sql(self, query, using='default'):
+        """Parse SQL-like condition statements into a WhereClause with the SQL
+        and parameters for the database alias using, bypassing Q objects"""
+
+        cache = self._derived['sql']
+        key = (using, query)
+        result = cache.get(key)
+        if result is None:
+            result = SQLCompiler(self, using).compile(self._parse_tree(query))
+            cache.set(key, result)
+        return result
+
+    def predicate(self, query):
+        """Return a function telling whether a model instance or a dict matches
+        query, evaluated in memory"""
+
+        cache = self._derived['predicate']
+        result = cache.get(query)
+        if result is None:
+            result = evaluator.Predicate(self).compile(self._parse_tree(query))
+            cache.set(query, result)
+        return result
+
+    def mask(self, query, columns):
+        """Return a boolean NumPy array of the rows of columns, a mapping of
+        field paths to arrays, matching query"""
+
+        cache = self._derived['mask']
+        result = cache.get(query)
+        if result is None:
+            result = evaluator.Mask(self).compile(self._parse_tree(query))
+            cache.set(query, result)
+        return result(columns)
+
+    def compile(self, template):
+        """Parse and validate a query with :name placeholders for values once,
+        returning a CompiledQuery that builds Q objects from bound values"""
+
+        node = self._parse_tree(template)
+        parameters = set()
+        for child in nodes.walk(node):
+            path = getattr(child, 'path', None)
+            if path is None:
+                continue
+            # Raise exception if field does not exist
+            self._get_field_info(path)
+            for literal in self._literals(child):
+                if literal.kind == PARAMETER:
+                    parameters.add(literal.value)
+        return CompiledQuery(self, node, frozenset(parameters))
+
+    def _parse_tree(self, query):
+        if self.shared_cache is not None:
+            key = self._shared_key(query)
+            data = self.shared_cache.get(key)
+            if data is not None:
+                try:
+                    node = ir.load(data)
+                except exceptions.IncompatibleIR:
+                    pass
+                else:
+                    self._check(node)
+                    return node
+
+        node = self._grammar(self._tokenize(query))
+        self._check(node)
+        if self.optimize:
+            node = self._optimize(node)
+
+        if self.shared_cache is not None:
+            self.shared_cache.set(key, ir.dump(node))
+        return node
+
+    def _tokenize(self, query):
+        return lexer.tokenize(query)
+
+    def _grammar(self, tokens):
+        return grammar.Grammar(tokens, self.max_depth).parse()
+
+    def _optimize(self, node):
+        return optimizer.optimize(node, self._get_value)
+
+    def _shared_key(self, query):
+        if self._shared_prefix is None:
+            model = self._get_model()._meta.label
+            settings = repr((self.schema_fingerprint(), self.date_format, self.optimize, self.max_depth))
+            self._shared_prefix = 'customquery:%d:%s:%s:' % (
+                ir.VERSION, model, hashlib.sha1(settings.encode()).hexdigest()[:16])
+        return self._shared_prefix + hashlib.sha1(query.encode()).hexdigest()
+
+    def schema_fingerprint(self):
+        """Hash of the fields and annotations queries can use, which changes
+        whenever the model or the annotated QuerySet change"""
+        parts = []
+        for path, info in sorted(self._index_fields().items()):
+            field = info.field
+            if field is None:
+                parts.append('%s:annotation' % path)
+            else:
+                parts.append('%s:%s:%s' % (path, type(field).__name__, getattr(field, 'column', '')))
+        return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+    def _check(self, node):
+        predicates = 0
+        for child in nodes.walk(node):
+            path = getattr(child, 'path', None)
+            if path is None:
+                continue
+            predicates += 1
+            if self.max_predicates is not None and predicates > self.max_predicates:
+                raise exceptions.TooManyPredicates(self.max_predicates, child.pos)
+            if isinstance(child, nodes.In) and isinstance(child.values, list):
+                self._check_list_size(child.values, child.pos)
+            self._check_field(path, child.pos)
+
+    def _check_list_size(self, values, position):
+        if self.max_in_size is not None and len(values) > self.max_in_size:
+            raise exceptions.ListTooLong(self.max_in_size, position)
+
+    def _check_field(self, path, position):
+        if self.denied_fields and self._path_matches(path, self.denied_fields):
+            raise exceptions.FieldNotAllowed(path, position)
+        if self.allowed_fields is not None and not self._path_matches(path, self.allowed_fields):
+            raise exceptions.FieldNotAllowed(path, position)
+        if self.max_relations is None and self.require_index is None:
+            return
+        info = self._get_field_info(path)
+        if self.max_relations is not None and info.hops > self.max_relations:
+            raise exceptions.TooManyRelations(path, self.max_relations, position)
+        if self.require_index is not None and not self._is_indexed(info.field):
+            if self.require_index == 'error':
+                raise exceptions.UnindexedField(path, position)
+            warnings.warn(str(exceptions.UnindexedField(path, position)), exceptions.UnindexedFieldWarning)
+
+    def _normalize_paths(self, paths):
+        if paths is None:
+            return None
+        return frozenset(path.replace('.', '__') for path in paths)
+
+    def _path_matches(self, path, paths):
+        # A listed relation covers every path through it
+        if path in paths:
+            return True
+        parts = path.split('__')
+        return any('__'.join(parts[:i]) in paths for i in range(1, len(parts)))
+
+    def _is_indexed(self, field):
+        if field is None:
+            # Annotations are computed, they can't be indexed
+            return False
+        if field.is_relation and not field.concrete:
+            # Reverse relations are followed through the foreign key on the other side
+            return True
+        if field.primary_key or field.unique or field.db_index:
+            return True
+        meta = field.model._meta
+        for index in meta.indexes:
+            if index.fields and index.fields[0].lstrip('-') == field.name:
+                return True
+        for together in meta.unique_together:
+            if together and together[0] == field.name:
+                return True
+        for constraint in meta.constraints:
+            constrained = getattr(constraint, 'fields', None)
+            if constrained and constrained[0] == field.name:
+                return True
+        return False
+
+    def _literals(self, node):
+        if isinstance(node, nodes.Comparison):
+            return [node.value]
+        if isinstance(node, nodes.Between):
+            return [node.low, node.high]
+        if isinstance(node, nodes.In):
+            return node.values if isinstance(node.values, list) else [node.values]
+        return []
+
+    def _resolve_query(self, node, params=None):
+        if self.to_many != 'join' or self.to_many_strategies:
+            uses = nodes.relation_conditions(node, self._exists_prefix)
+            negated = set()
+            for child in nodes.walk(node):
+                if isinstance(child, nodes.Not):
+                    negated.update(nodes.relation_conditions(child.operand, self._exists_prefix))
+            if any(not nodes.shares_row(kinds) or len(kinds) > 1 and prefix in negated
+                   for prefix, kinds in uses.items()):
+                # Negations and IS NULL next to other conditions through a
+                # relation depend on the joined row, which only a join gives,
+                # and so do conditions under NOT, which may cancel out.
+                # It runs in a subquery, so rows still come once.
+                joined = copy(self)
+                joined.to_many, joined.to_many_strategies, joined._exists_prefixes = 'join', {}, {}
+                return Q(pk__in=self._filter(joined._resolve(node, params)).values('pk'))
+        return self._resolve(node, params)
+
+    def _resolve(self, node, params=None):
+        if isinstance(node, nodes.BoolOp):
+            return self._operate(node.connector, self._resolve_operands(node.connector, node.operands, params))
+        if isinstance(node, nodes.Not):
+            return ~self._resolve(node.operand, params)
+        prefix = self._exists_prefix(node)
+        if prefix is not None:
+            return self._exists(prefix, Q.AND, [node], params)
+        return self._resolve_predicate(node, params)
+
+    def _resolve_operands(self, connector, operands, params):
+        if self.to_many == 'join' and not self.to_many_strategies:
+            return [self._resolve(operand, params) for operand in operands]
+        # (a AND b) AND c is one chain, whose conditions share a join
+        operands = list(_flatten(connector, operands))
+        # Conditions through the same to-many relation share one EXISTS subquery
+        groups = {}
+        for operand in operands:
+            prefix = self._member_prefix(connector, operand)
+            if prefix is not None:
+                groups.setdefault(prefix, []).append(operand)
+        bundles = {}
+        for prefix, members in groups.items():
+            if len(members) > 1 and any(isinstance(member, nodes.BoolOp) for member in members):
+                bundles[prefix] = members
+        result = []
+        for operand in operands:
+            prefix = self._member_prefix(connector, operand)
+            if prefix in bundles:
+                if bundles[prefix] is not None:
+                    result.append(self._bundle(prefix, bundles[prefix], params))
+                    bundles[prefix] = None
+            elif prefix is None or not self._groupable(operand):
+                result.append(self._resolve(operand, params))
+            elif prefix in groups:
+                # In place of the first condition of the group
+                result.append(self._exists(prefix, connector, [member for member in groups.pop(prefix)
+                                                               if not isinstance(member, nodes.BoolOp)
+                                                               and self._groupable(member)], params))
+        return result
+
+    def _member_prefix(self, connector, node):
+        # The relation node can share a subquery through, in a chain of connector
+        if isinstance(node, nodes.BoolOp):
+            # Only AND needs the ORs below it in its subquery, EXISTS distributes over OR
+            return self._bundle_prefix(node) if connector == 'AND' else None
+        prefix = self._exists_prefix(node)
+        if prefix is None:
+            return None
+        if self._groupable(node) or connector == 'AND' and isinstance(node, nodes.IsNull) and node.path != prefix:
+            return prefix
+        return None
+
+    def _bundle_prefix(self, node):
+        # The to-many relation a tree of AND and OR goes through, when all its
+        # other conditions are on the model itself
+        prefixes = set()
+        for child in nodes.walk(node):
+            if isinstance(child, nodes.Not):
+                return None
+            if isinstance(child, nodes.BoolOp):
+                continue
+            prefix = self._exists_prefix(child)
+            if prefix is None:
+                if self._crosses_to_many(child.path):
+                    return None
+            elif prefix == child.path or not (self._groupable(child) or isinstance(child, nodes.IsNull)):
+                return None
             else:
-                a = self._resolve(tokens[0])
-                b = self._resolve(tokens[2])
-                return self._operate(a, tokens[1], b)
+                prefixes.add(prefix)
+        if len(prefixes) != 1:
+            return None
+        prefix = prefixes.pop()
+        # Conditions on the model are reached back from the related one
+        return prefix if '__' not in prefix else None
+
+    def _crosses_to_many(self, path):
+        return self._to_many_prefix(path) is not None
+
+    def _to_many_prefix(self, path):
+        # The path up to the first to-many relation, whatever its strategy
+        parts = path.split('__')
+        for i in range(1, len(parts) + 1):
+            try:
+                field = self._get_field_info('__'.join(parts[:i])).field
+            except exceptions.FieldDoesNotExist:
+                return None
+            if field is None or not field.is_relation:
+                return None
+            if field.one_to_many or field.many_to_many:
+                return '__'.join(parts[:i])
+        return None
+
+    def _bundle(self, prefix, operands, params=None):
+        # AND of conditions through prefix, some of them in ORs with conditions
+        # on the model: a related row must match all of them, as with a join,
+        # or without related rows the conditions must hold on the NULL row
+        field = self._get_field_info(prefix).field
+        if field.auto_created and not field.concrete:
+            back, outer = field.field.name, field.field.target_field.attname
         else:
-            if len(tokens) > 3:
-                #import ipdb; ipdb.set_trace()
-                raise Exception("Invalid query")
-            return self._compare(*tokens)
-
-    def _between(self, subject, floor, ceil):
-        gte = parse('a>=1')[0].tokens[0].tokens[1]
-        lte = parse('a<=1')[0].tokens[0].tokens[1]
-        first = self._resolve([subject, gte, floor])
-        second = self._resolve([subject, lte, ceil])
-        return first & second
-
-    def _in(self, subject, values):
-        tokens = values.tokens
-        if tokens[0].value == '(':
-            tokens = self._get_group(tokens)
+            back, outer = field.related_query_name(), 'pk'
+        node = nodes.BoolOp('AND', operands, operands[0].pos)
+        manager = field.related_model._default_manager
+        # One filter() call, so a many to many back to the model is joined once
+        result = Q(Exists(manager.filter(Q(**{back: OuterRef(outer)}) & self._inner(node, prefix, back, params))))
+        without = self._without_related(node, prefix, params)
+        if without is False:
+            return result
+        none = ~Q(Exists(manager.filter(**{back: OuterRef(outer)})))
+        return result | (none if without is True else none & without)
+
+    def _inner(self, node, prefix, back, params):
+        # node in the subquery on the related model
+        if isinstance(node, nodes.BoolOp):
+            return self._operate(node.connector, [self._inner(operand, prefix, back, params)
+                                                  for operand in node.operands])
+        q = self._resolve_predicate(node, params)
+        if self._exists_prefix(node) == prefix:
+            return self._relative(q, len(prefix) + 2)
+        return self._renamed(q, lambda key: back + '__' + key)
+
+    def _without_related(self, node, prefix, params):
+        # node on a row without related rows: True, False or a Q on the model
+        if isinstance(node, nodes.BoolOp):
+            operands = [self._without_related(operand, prefix, params) for operand in node.operands]
+            absorbing = node.connector == 'OR'
+            if absorbing in operands:
+                return absorbing
+            operands = [operand for operand in operands if operand is not (not absorbing)]
+            if not operands:
+                return not absorbing
+            return self._operate(node.connector, operands)
+        if self._exists_prefix(node) == prefix:
+            # Every condition on the NULL row is false, but IS NULL
+            return isinstance(node, nodes.IsNull) and node.isnull
+        return self._resolve_predicate(node, params)
+
+    def _groupable(self, node):
+        # Negated conditions are NOT EXISTS, and IS NULL is true without related rows
+        if isinstance(node, nodes.Comparison):
+            return node.op != '!='
+        if isinstance(node, (nodes.In, nodes.Between)):
+            return not node.negated
+        return False
+
+    def _exists_prefix(self, node):
+        # The path up to the first to-many relation, when it uses EXISTS
+        path = getattr(node, 'path', None)
+        if path is None or (self.to_many == 'join' and not self.to_many_strategies):
+            return None
+        try:
+            return self._exists_prefixes[path]
+        except KeyError:
+            pass
+        prefix = None
+        parts = path.split('__')
+        for i in range(1, len(parts) + 1):
+            field = self._fields.get('__'.join(parts[:i]))
+            if field is None:
+                try:
+                    field = self._get_field_info('__'.join(parts[:i]))
+                except exceptions.FieldDoesNotExist:
+                    break
+            field = field.field
+            if field is None or not field.is_relation:
+                break
+            if field.one_to_many or field.many_to_many:
+                candidate = '__'.join(parts[:i])
+                if self.to_many_strategies.get(candidate, self.to_many) == 'exists':
+                    prefix = candidate
+                break
+        self._exists_prefixes[path] = prefix
+        return prefix
+
+    def _exists(self, prefix, connector, operands, params=None):
+        field = self._get_field_info(prefix).field
+        if field.auto_created and not field.concrete:
+            # Reverse relation, back through the field pointing here
+            back, outer = field.field.name, field.field.target_field.attname
         else:
-            raise exceptions.ParenthesisExpected('IN')
+            back, outer = field.related_query_name(), 'pk'
+        if '__' in prefix:
+            outer = prefix.rsplit('__', 1)[0] + '__' + outer
+        related = field.related_model._default_manager.filter(**{back: OuterRef(outer)})
+
+        if len(operands) == 1 and isinstance(operands[0], nodes.IsNull):
+            node = operands[0]
+            # Without related rows the relation is NULL, like with a LEFT JOIN
+            if node.path == prefix:
+                return ~Q(Exists(related)) if node.isnull else Q(Exists(related))
+            inner = Q(**{node.path[len(prefix) + 2:] + '__isnull': node.isnull})
+            if node.isnull:
+                return Q(Exists(related.filter(inner))) | ~Q(Exists(related))
+            return Q(Exists(related.filter(inner)))
+        if len(operands) == 1 and not self._groupable(operands[0]):
+            # No related row matches, like ~Q() on a to-many relation
+            node = operands[0]
+            if isinstance(node, nodes.Comparison):
+                node = nodes.Comparison(node.path, '=', node.value, node.pos)
+            elif isinstance(node, nodes.In):
+                node = nodes.In(node.path, node.values, False, node.pos)
+            else:
+                node = nodes.Between(node.path, node.low, node.high, False, node.pos)
+            return ~self._exists(prefix, connector, [node], params)
+
+        inner = self._operate(connector, [self._resolve_predicate(operand, params) for operand in operands])
+        return Q(Exists(related.filter(self._relative(inner, len(prefix) + 2))))
+
+    def _relative(self, q, cut):
+        return self._renamed(q, lambda key: key[cut:])
+
+    def _renamed(self, q, rename):
+        result = Q(_connector=q.connector, _negated=q.negated)
+        for child in q.children:
+            if isinstance(child, Q):
+                result.children.append(self._renamed(child, rename))
+            else:
+                result.children.append((rename(child[0]), child[1]))
+        return result
+
+    def _resolve_predicate(self, node, params=None):
+        if isinstance(node, nodes.Comparison):
+            return self._compare(node.path, node.op, node.value, params)
+        if isinstance(node, nodes.In):
+            result = self._in(node.path, node.values, params)
+            return ~result if node.negated else result
+        if isinstance(node, nodes.IsNull):
+            return self._is(node.path, node.isnull)
+        if isinstance(node, nodes.Between):
+            result = self._between(node.path, node.low, node.high, params)
+            return ~result if node.negated else result
+        raise exceptions.InvalidQuery()
+
+    def _between(self, subject, floor, ceil, params=None):
+        # Both bounds are converted in one pass
+        low, high = self._get_list(subject, [floor, ceil], params)
+        return Q(**{subject + '__gte': low}) & Q(**{subject + '__lte': high})
+
+    def _in(self, subject, values, params=None):
+        key = '%s__in' % subject
+        values = self._get_list(subject, values, params)
 
-        if not len(tokens) == 1:
-            raise exceptions.MalformedList
+        if self.in_table_threshold is not None and len(values) > self.in_table_threshold:
+            field = self._get_field(subject)
+            if isinstance(field, fields.Field):
+                return Q(**{key: ValuesTable(values, output_field=field)})
+        size = self.in_chunk_size
+        if size and len(values) > size:
+            return self._operate(Q.OR, [Q(**{key: values[i:i + size]}) for i in range(0, len(values), size)])
 
         kwargs = {
-            '%s__in' % subject.value: self._get_list(subject.value, tokens[0].tokens),
+            key: values,
         }
 
         return Q(**kwargs)
 
-    def _is(self, subject, values):
-        if values.match(t.Token.Keyword, 'NULL'):
-            kwargs = {
-                '%s__isnull' % subject.value: True,
-            }
-        elif values.match(t.Token.Keyword, 'NOT NULL'):
-            kwargs = {
-                '%s__isnull' % subject.value: False,
-            }
-        else:
-            raise exceptions.InvalidIsParameter(values.value)
+    def _is(self, subject, isnull):
+        # Raise exception if field does not exist
+        self._get_field(subject)
+        kwargs = {
+            '%s__isnull' % subject: isnull,
+        }
         return Q(**kwargs)
 
-    def _operate(self, a, operator, b):
-        if operator.match(t.Token.Keyword, 'OR'):
-            return a | b
-        if operator.match(t.Token.Keyword, 'AND'):
-            return a & b
+    def _operate(self, connector, operands):
+        if connector not in (Q.OR, Q.AND):
+            raise exceptions.UnknownOperator(connector)
+        # Same tree as chaining a | b | c, without copying it on every step
+        result = Q(_connector=connector)
+        for operand in operands:
+            result.add(operand, connector)
+        return result
 
-    def _compare(self, subject, operator, predicate):
+    def _compare(self, subject, operator, predicate, params=None):
         # Raise exception if field does not exist
-        key, cond = self._make_key(operator, subject.value)
+        key, cond = self._make_key(operator, subject)
         kwargs = {}
-        kwargs[key] = self._get_value(subject.value, predicate)
+        kwargs[key] = self._get_value(subject, predicate, params)
 
         result = Q(**kwargs)
         if not cond:
             result = ~result
         return result
 
-    def _get_list(self, key, tokens):
-        tokens = self._strip_whitespaces(tokens)
-        objects = []
-        while len(tokens) > 0:
-            next_object = tokens.pop(0)
-            objects.append(self._get_value(key, next_object))
-            if len(tokens) > 0:
-                punctuation = tokens.pop(0)
-                if not punctuation.ttype is t.Token.Punctuation or not punctuation.value == ',':
-                    raise exceptions.MalformedList()
-        return tuple(objects)
-
-    def _get_value(self, key, predicate):
-        v = predicate.value
-        if v.startswith("'") and v.endswith("'"):
-            v = v[1:-1]
-        elif v.startswith('"') and v.endswith('"'):
-            v = v[1:-1]
-
-        field = self._get_field(key)
-        if isinstance(field, fields.DateField):
-            return datetime.strptime(str(v), self.date_format).date()
-        if predicate.ttype is t.Token.Literal.Number.Integer:
-            return int(v)
-        if isinstance(predicate, sql.Identifier):
-            return predicate.get_name()
-        if predicate.ttype is t.Token.Literal.String.Single:
-            return v
+    def _get_list(self, key, values, params=None):
+        converter = self._get_field_info(key).converter
+        if isinstance(values, nodes.Literal):
+            bound = self._get_param(values, params)
+            self._check_list_size(bound, values.pos)
+            return tuple([self._bind_value(converter, value) for value in bound])
+        for value in values:
+            if value.kind == PARAMETER:
+                break
+        else:
+            # No parameters, the whole list is converted in one pass
+            return tuple(converter.many(values))
+        return tuple([self._bind_value(converter, self._get_param(value, params))
+                      if value.kind == PARAMETER else converter(value) for value in values])
+
+    def _get_value(self, key, predicate, params=None):
+        converter = self._get_field_info(key).converter
+        if predicate.kind == PARAMETER:
+            return self._bind_value(converter, self._get_param(predicate, params))
+        return converter(predicate)
+
+    def _get_param(self, predicate, params):
+        try:
+            return params[predicate.value]
+        except (KeyError, TypeError):
+            raise exceptions.MissingParameter(predicate.value)
+
+    def _bind_value(self, converter, value):
+        # Strings are converted like literals typed in a query, other values are used as given
+        if isinstance(value, str):
+            return converter(nodes.Literal(STRING, value, None))
+        return value
+
+    def _get_converter(self, field):
+        return converter_registry.get_converter(self, field, self.converters)
 
     def _make_key(self, op, key):
-        comp = t.Token.Operator.Comparison
-        key = key.replace('.', '__')
-        if op.match(comp, '='):
+        if op == '=':
             return [key, True]
-        if op.match(comp, '>'):
+        if op == '>':
             return [key + '__gt', True]
-        if op.match(comp, '>='):
+        if op == '>=':
             return [key + '__gte', True]
-        if op.match(comp, '<'):
+        if op == '<':
             return [key + '__lt', True]
-        if op.match(comp, '<='):
+        if op == '<=':
             return [key + '__lte', True]
-        if op.match(comp, '<>'):
-            return [key, False]
-        if op.match(comp, '!='):
+        if op == '!=':
             return [key, False]
-        if op.value == 'NOT':
-            return [key, False]
-        raise exceptions.UnknownOperator(op.normalized)
+        raise exceptions.UnknownOperator(op)
 
     def _get_field(self, key):
-        model = self.model
+        return self._get_field_info(key).field
 
-        if isinstance(model, QuerySet):
-            qs = model
-            if qs.query.annotations.get(key):
-                return None
-            model = qs.model
+    def _get_field_info(self, key):
+        info = self._fields.get(key)
+        if info is None:
+            # Paths deeper than relation_depth are resolved once and then indexed
+            info = self._fields[key] = self._walk_field(key)
+        return info
+
+    def _get_model(self):
+        if isinstance(self.model, QuerySet):
+            return self.model.model
+        return self.model
+
+    def _index_fields(self):
+        index = {}
+        self._index_model(index, self._get_model(), '', 0)
+        if isinstance(self.model, QuerySet):
+            for name in self.model.query.annotations:
+                index[name] = FieldInfo(name, None, 0, converter_registry.LiteralConverter())
+        for name in self.annotations:
+            index[name] = FieldInfo(name, None, 0, converter_registry.LiteralConverter())
+        return index
 
-        key = key.replace('.', '__')
+    def _index_model(self, index, model, prefix, hops):
+        for field in model._meta.get_fields():
+            path = prefix + field.name
+            index[path] = FieldInfo(path, field, hops, self._get_converter(field))
+            attname = getattr(field, 'attname', None)
+            if attname and attname != field.name:
+                index[prefix + attname] = index[path]
+            if field.related_model is not None and hops < self.relation_depth:
+                self._index_model(index, field.related_model, path + '__', hops + 1)
+
+    def _walk_field(self, key):
+        model = self._get_model()
         path = key.split('__')
-        while len(path) > 1:
-            model = model._meta.get_field(path.pop(0)).related_model
+        hops = len(path) - 1
         try:
-            return model._meta.get_field(path[0])
-        except django_exceptions.FieldDoesNotExist:
+            while len(path) > 1:
+                model = model._meta.get_field(path.pop(0)).related_model
+            field = model._meta.get_field(path[0])
+        except (AttributeError, django_exceptions.FieldDoesNotExist):
             raise exceptions.FieldDoesNotExist(key)
+        return FieldInfo(key, field, hops, self._get_converter(field))
+
 
-    def _get_group(self, tokens):
-        if tokens[-1].match(t.Token.Punctuation, ')'):
-            return tokens[1:-1]
+def _flatten(connector, operands):
+    for operand in operands:
+        if isinstance(operand, nodes.BoolOp) and operand.connector == connector:
+            yield from _flatten(connector, operand.operands)
         else:
-            raise exceptions.ParenthesisDontMatch()
+            yield operand
+
+
+def _parse_chunk(parser, queries):
+    results = []
+    for query in queries:
+        try:
+            results.append((parser.parse(query), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+class CompiledQuery:
+    """A parsed and validated query template, see Parser.compile()"""
+
+    def __init__(self, parser, node, parameters):
+        self.parser = parser
+        self.node = node
+        self.parameters = parameters
+
+    def bind(self, **values):
+        """Return the Q object for the given parameter values"""
+        return self.parser._resolve_query(self.node, values)
+
+    def bind_sql(self, using='default', **values):
+        """Return the WhereClause for the given parameter values"""
+        return SQLCompiler(self.parser, using).compile(self.node, values)
+
+    def predicate(self, **values):
+        """Return the in-memory predicate for the given parameter values"""
+        return evaluator.Predicate(self.parser, values).compile(self.node)
 
-    def _strip_whitespaces(self, tokens):
-        return [ tok for tok in tokens if not tok.ttype is t.Token.Text.Whitespace ]
+    def mask(self, columns, **values):
+        """Return the boolean array of columns for the given parameter values"""
+        return evaluator.Mask(self.parser, values).compile(self.node)(columns)
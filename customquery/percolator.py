@@ -0,0 +1,344 @@
+"""Reverse matching: find which of many saved queries match an object.
+
+Each saved query is indexed by conditions at least one of which holds on every
+object it matches: equalities and IN lists in hash maps, ranges in sorted
+lists, by field. Only the queries found through the index are evaluated, plus
+the few that have no such conditions (only NOT, != or IS NULL for example).
+Queries are evaluated by Predicate, and add() raises the UnsupportedField it
+raises for some conditions through to-many relations:
+
+    >>> percolator = Percolator(parser)
+    >>> percolator.add(alert.id, alert.query)
+    >>> percolator.match(obj)            # {ids of the matching queries}
+    >>> percolator.match_many(objects)   # [{ids}, ...]
+"""
+from bisect import bisect_left, bisect_right
+from . import evaluator, nodes
+
+
+class Equal:
+    __slots__ = ('path', 'value')
+
+    def __init__(self, path, value):
+        self.path = path
+        self.value = value
+
+
+class Range:
+    """low < value < high, including the bounds when low_closed or high_closed,
+    and None for no bound"""
+    __slots__ = ('path', 'low', 'low_closed', 'high', 'high_closed')
+
+    def __init__(self, path, low, low_closed, high, high_closed):
+        self.path = path
+        self.low = low
+        self.low_closed = low_closed
+        self.high = high
+        self.high_closed = high_closed
+
+    def empty(self):
+        """Whether no value is in the range, like with low > high"""
+        if self.low is None or self.high is None:
+            return False
+        try:
+            return self.low > self.high or self.low == self.high and not (self.low_closed and self.high_closed)
+        except TypeError:
+            return False
+
+    def contains(self, value):
+        try:
+            if self.low is not None and not (self.low < value or self.low_closed and self.low == value):
+                return False
+            if self.high is not None and not (value < self.high or self.high_closed and value == self.high):
+                return False
+        except TypeError:
+            return False
+        return True
+
+
+class RangeIndex:
+    """Ranges of one field, finding those that contain a value.
+
+    Ranges with only a lower bound are sorted by it, and those with only an
+    upper bound by it, so the ones containing a value are a slice found by
+    bisection. Ranges with both bounds are kept in a centered interval tree.
+    Both are rebuilt on the first lookup after a change."""
+
+    def __init__(self):
+        self._ranges = []
+        self._dirty = True
+
+    def add(self, query_id, interval):
+        # Empty ranges contain nothing, and would split the interval tree forever
+        if not interval.empty():
+            self._ranges.append((query_id, interval))
+            self._dirty = True
+
+    def remove(self, query_id):
+        self._ranges = [entry for entry in self._ranges if entry[0] != query_id]
+        self._dirty = True
+
+    def _build(self):
+        above = sorted((entry for entry in self._ranges if entry[1].high is None and entry[1].low is not None),
+                       key=lambda entry: entry[1].low)
+        self._lows = [interval.low for _, interval in above]
+        self._above = above
+        below = sorted((entry for entry in self._ranges if entry[1].low is None and entry[1].high is not None),
+                       key=lambda entry: entry[1].high)
+        self._highs = [interval.high for _, interval in below]
+        self._below = below
+        self._unbounded = {query_id for query_id, interval in self._ranges
+                           if interval.low is None and interval.high is None}
+        self._tree = _IntervalTree.build([entry for entry in self._ranges
+                                          if entry[1].low is not None and entry[1].high is not None])
+        self._dirty = False
+
+    def find(self, value):
+        if self._dirty:
+            self._build()
+        found = set(self._unbounded)
+        try:
+            end = bisect_right(self._lows, value)
+            start = bisect_left(self._highs, value)
+            for query_id, interval in self._above[:end]:
+                if interval.contains(value):
+                    found.add(query_id)
+            for query_id, interval in self._below[start:]:
+                if interval.contains(value):
+                    found.add(query_id)
+            if self._tree is not None:
+                self._tree.find(value, found)
+        except TypeError:
+            pass
+        return found
+
+    def __len__(self):
+        return len(self._ranges)
+
+
+class _IntervalTree:
+    """Ranges containing center sorted by both bounds, and subtrees of the
+    ranges entirely below and above it"""
+    __slots__ = ('center', 'by_low', 'by_high', 'left', 'right')
+
+    @classmethod
+    def build(cls, entries):
+        if not entries:
+            return None
+        lows = sorted(interval.low for _, interval in entries)
+        node = cls()
+        node.center = center = lows[len(lows) // 2]
+        here, left, right = [], [], []
+        for entry in entries:
+            interval = entry[1]
+            if interval.high < center:
+                left.append(entry)
+            elif interval.low > center:
+                right.append(entry)
+            else:
+                here.append(entry)
+        node.by_low = sorted(here, key=lambda entry: entry[1].low)
+        node.by_high = sorted(here, key=lambda entry: entry[1].high, reverse=True)
+        node.left = cls.build(left)
+        node.right = cls.build(right)
+        return node
+
+    def find(self, value, found):
+        node = self
+        while node is not None:
+            if value < node.center:
+                for query_id, interval in node.by_low:
+                    if interval.low > value:
+                        break
+                    if interval.contains(value):
+                        found.add(query_id)
+                node = node.left
+            elif value > node.center:
+                for query_id, interval in node.by_high:
+                    if interval.high < value:
+                        break
+                    if interval.contains(value):
+                        found.add(query_id)
+                node = node.right
+            else:
+                for query_id, interval in node.by_low:
+                    if interval.contains(value):
+                        found.add(query_id)
+                return
+
+
+class Percolator:
+
+    def __init__(self, parser):
+        self.parser = parser
+        self._predicates = {}
+        self._anchors = {}
+        self._equal = {}
+        self._ranges = {}
+        self._unanchored = set()
+        self._getters = {}
+
+    def add(self, query_id, query):
+        """Index query under query_id, replacing the query it had"""
+
+        if query_id in self._predicates:
+            self.remove(query_id)
+        node = self.parser._parse_tree(query)
+        predicate = evaluator.Predicate(self.parser).compile(node)
+        anchors = self._find_anchors(node)
+        self._predicates[query_id] = predicate
+        self._anchors[query_id] = anchors
+        if anchors is None:
+            self._unanchored.add(query_id)
+            return
+        for anchor in anchors:
+            self._getter(anchor.path)
+            if isinstance(anchor, Equal):
+                self._equal.setdefault(anchor.path, {}).setdefault(anchor.value, set()).add(query_id)
+            else:
+                self._ranges.setdefault(anchor.path, RangeIndex()).add(query_id, anchor)
+
+    def remove(self, query_id):
+        self._predicates.pop(query_id)
+        anchors = self._anchors.pop(query_id)
+        if anchors is None:
+            self._unanchored.discard(query_id)
+            return
+        for anchor in anchors:
+            if isinstance(anchor, Equal):
+                ids = self._equal[anchor.path][anchor.value]
+                ids.discard(query_id)
+                if not ids:
+                    del self._equal[anchor.path][anchor.value]
+            else:
+                self._ranges[anchor.path].remove(query_id)
+
+    def candidates(self, obj):
+        """Return the ids of the queries that may match obj"""
+        return self._candidates(obj, {})
+
+    def _candidates(self, obj, found_ranges):
+        # found_ranges keeps the ranges containing each (path, value) looked up
+        found = set(self._unanchored)
+        for path, values in self._equal.items():
+            for value in self._values(obj, path):
+                try:
+                    ids = values.get(value)
+                except TypeError:
+                    continue
+                if ids:
+                    found |= ids
+        for path, ranges in self._ranges.items():
+            for value in self._values(obj, path):
+                if value is None:
+                    continue
+                try:
+                    ids = found_ranges.get((path, value))
+                except TypeError:
+                    found |= ranges.find(value)
+                    continue
+                if ids is None:
+                    ids = found_ranges[path, value] = ranges.find(value)
+                found |= ids
+        return found
+
+    def match(self, obj):
+        """Return the ids of the queries matching obj, a model instance or a dict"""
+        predicates = self._predicates
+        return {query_id for query_id in self.candidates(obj) if predicates[query_id](obj)}
+
+    def match_many(self, objects):
+        """Return the ids of the matching queries for each object.
+
+        The ranges are searched once for each distinct value of the objects,
+        which share the results."""
+        predicates = self._predicates
+        found_ranges = {}
+        return [{query_id for query_id in self._candidates(obj, found_ranges) if predicates[query_id](obj)}
+                for obj in objects]
+
+    def _getter(self, path):
+        getter = self._getters.get(path)
+        if getter is None:
+            getter = self._getters[path] = evaluator.Predicate(self.parser)._getter(path)
+        return getter
+
+    def _values(self, obj, path):
+        value = self._getters[path](obj)
+        return value if type(value) is evaluator.Many else (value,)
+
+    def _find_anchors(self, node):
+        # Conditions at least one of which holds on every match, or None
+        if isinstance(node, nodes.Comparison):
+            if node.op == '=':
+                return [Equal(node.path, self.parser._get_value(node.path, node.value))]
+            if node.op in ('>', '>='):
+                return [Range(node.path, self.parser._get_value(node.path, node.value), node.op == '>=', None, False)]
+            if node.op in ('<', '<='):
+                return [Range(node.path, None, False, self.parser._get_value(node.path, node.value), node.op == '<=')]
+            return None
+        if isinstance(node, nodes.In) and not node.negated and isinstance(node.values, list):
+            values = self.parser._get_list(node.path, node.values)
+            try:
+                return [Equal(node.path, value) for value in set(values)]
+            except TypeError:
+                return None
+        if isinstance(node, nodes.Between) and not node.negated:
+            low, high = self.parser._get_list(node.path, [node.low, node.high])
+            interval = Range(node.path, low, True, high, True)
+            # An empty range matches nothing, no anchor is needed to find it
+            return [] if interval.empty() else [interval]
+        if isinstance(node, nodes.BoolOp):
+            children = [self._find_anchors(operand) for operand in node.operands]
+            if node.connector == 'OR':
+                if any(anchors is None for anchors in children):
+                    return None
+                return [anchor for anchors in children for anchor in anchors]
+            children = [anchors for anchors in children if anchors is not None]
+            if not children:
+                return None
+            # Ranges of one field in AND are their intersection
+            ranges = {}
+            others = []
+            for anchors in children:
+                if len(anchors) == 1 and isinstance(anchors[0], Range):
+                    path = anchors[0].path
+                    ranges[path] = _intersect(ranges[path], anchors[0]) if path in ranges else anchors[0]
+                else:
+                    others.append(anchors)
+            if any(interval.empty() for interval in ranges.values()):
+                return []
+            children = others + [[interval] for interval in ranges.values()]
+            # Any operand of AND will do, the fewest equalities narrow the most
+            return min(children, key=_selectivity)
+        return None
+
+    def __len__(self):
+        return len(self._predicates)
+
+    def __contains__(self, query_id):
+        return query_id in self._predicates
+
+
+def _selectivity(anchors):
+    ranges = [anchor for anchor in anchors if isinstance(anchor, Range)]
+    return (bool(ranges), any(anchor.low is None or anchor.high is None for anchor in ranges), len(anchors))
+
+
+def _intersect(first, second):
+    try:
+        low, low_closed = first.low, first.low_closed
+        if low is None or second.low is not None and second.low >= low:
+            if low is not None and second.low == low:
+                low_closed = low_closed and second.low_closed
+            else:
+                low, low_closed = second.low, second.low_closed
+        high, high_closed = first.high, first.high_closed
+        if high is None or second.high is not None and second.high <= high:
+            if high is not None and second.high == high:
+                high_closed = high_closed and second.high_closed
+            else:
+                high, high_closed = second.high, second.high_closed
+    except TypeError:
+        return first
+    return Range(first.path, low, low_closed, high, high_closed)
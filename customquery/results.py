@@ -0,0 +1,175 @@
+"""Cache of query results, invalidated when the data they come from changes.
+
+    >>> results = ResultCache(parser, maxsize=512, ttl=300)
+    >>> results.list("numfield > 1 and related.name = foo")
+    >>> results.count("numfield > 1")
+
+Every model has a data version, bumped by the post_save, post_delete and
+m2m_changed signals. A result is stored under the query, the model and the
+versions of the models the query touches: the parsed model and those reached
+through its paths, like the model of related in related.name. Changing any of
+them makes the next lookup miss, and the stale entry ages out of the cache.
+Queries are compared by their canonical text, so "numfield=1 and foo=bar"
+and "foo = 'bar' AND numfield = 1" share a result.
+
+Signals are not sent by QuerySet.update(), bulk_create(), raw SQL or other
+processes; call bump() with the changed model after those. Versions can be kept
+in a Django cache, shared by all processes, with version_cache.
+
+While a result is computed, other threads asking for the same one wait for it
+instead of running the query as well.
+"""
+import threading
+from django.core.cache import caches
+from django.db.models import signals
+from .cache import LRUCache
+
+_versions = {}
+_versions_lock = threading.Lock()
+_version_caches = set()
+_connected = False
+
+
+def version(model, version_cache=None):
+    """Return the data version of model"""
+    label = model._meta.label_lower
+    if version_cache is not None:
+        return caches[version_cache].get(_version_key(label), 0)
+    return _versions.get(label, 0)
+
+
+def bump(model):
+    """Invalidate the cached results that depend on model"""
+    label = model._meta.label_lower
+    with _versions_lock:
+        _versions[label] = _versions.get(label, 0) + 1
+        aliases = list(_version_caches)
+    for alias in aliases:
+        cache = caches[alias]
+        key = _version_key(label)
+        # incr() fails on a missing key, add() only sets one
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+
+def _version_key(label):
+    return 'customquery:version:%s' % label
+
+
+def _changed(sender, **kwargs):
+    _bump_tables(sender)
+
+
+def _m2m_changed(sender, instance, model, **kwargs):
+    # sender is the through model, the rows of both sides change with it
+    _bump_tables(sender)
+    _bump_tables(type(instance))
+    _bump_tables(model)
+
+
+def _bump_tables(model):
+    # Saving a proxy sends the proxy and saving a child the child, queries on
+    # the concrete model and on the parents read the same rows
+    models = [model, model._meta.concrete_model] + model._meta.get_parent_list()
+    for changed in dict.fromkeys(models):
+        bump(changed)
+
+
+def _connect():
+    global _connected
+    with _versions_lock:
+        if _connected:
+            return
+        _connected = True
+    signals.post_save.connect(_changed, dispatch_uid='customquery.results.post_save')
+    signals.post_delete.connect(_changed, dispatch_uid='customquery.results.post_delete')
+    signals.m2m_changed.connect(_m2m_changed, dispatch_uid='customquery.results.m2m_changed')
+
+
+class ResultCache:
+
+    def __init__(self, parser, maxsize=256, ttl=300, version_cache=None):
+        self.parser = parser
+        self.version_cache = version_cache
+        self._cache = LRUCache(maxsize, ttl)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        if version_cache is not None:
+            with _versions_lock:
+                _version_caches.add(version_cache)
+        _connect()
+
+    def list(self, query, queryset=None):
+        """Return the list of objects matching query"""
+        return list(self.get(query, list, 'list', queryset))
+
+    def count(self, query, queryset=None):
+        return self.get(query, lambda queryset: queryset.count(), 'count', queryset)
+
+    def exists(self, query, queryset=None):
+        return self.get(query, lambda queryset: queryset.exists(), 'exists', queryset)
+
+    def get(self, query, evaluate, name, queryset=None):
+        """Return evaluate(queryset) for the queryset filtered by query,
+        cached under name, which tells different functions apart"""
+
+        key = self.key(query, name, queryset)
+        result = self._cache.get(key, _MISSING)
+        if result is not _MISSING:
+            return result
+        with self._lock(key):
+            # Another thread may have computed it while this one waited
+            result = self._cache.get(key, _MISSING)
+            if result is _MISSING:
+                result = evaluate(self.parser.filter(query, queryset))
+                self._cache.set(key, result)
+        with self._locks_lock:
+            self._locks.pop(key, None)
+        return result
+
+    def key(self, query, name, queryset=None):
+        """Return the cache key of query, changing with the versions of the
+        models it touches"""
+
+        text = self.parser.canonical(query)
+        base = None
+        if queryset is not None:
+            base = (queryset.db, str(queryset.query))
+        models = self.models(query)
+        versions = tuple(version(model, self.version_cache) for model in models)
+        return (name, self.parser._get_model()._meta.label_lower, text, base, versions)
+
+    def models(self, query):
+        """Return the models query touches, the parsed one first"""
+
+        models = [self.parser._get_model()]
+        for relation in self.parser.relations(query):
+            model = self.parser._get_field_info(relation.path).field.related_model
+            if model not in models:
+                models.append(model)
+        for model in list(models):
+            # Changes to a parent table show in the child model
+            for parent in model._meta.get_parent_list():
+                if parent not in models:
+                    models.append(parent)
+        return models
+
+    def _lock(self, key):
+        with self._locks_lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def cache_info(self):
+        return self._cache.info()
+
+    def cache_clear(self):
+        self._cache.clear()
+
+
+_MISSING = object()
+
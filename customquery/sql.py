@@ -0,0 +1,298 @@
+"""Compiles a parsed query straight into a parameterized SQL WHERE clause,
+without building Q objects.
+
+Related fields are checked with IN subqueries instead of joins. Like the
+single join of a Q object, conditions ANDed together through the same to-many
+relation are checked in one subquery, so one related row must match all of
+them, while negations, and NOT BETWEEN bound by bound, get subqueries of their
+own. Where the join also binds an OR inside the AND, or negations and IS NULL
+next to other conditions through the relation, the query raises
+UnsupportedField. NULLs follow the same rules as Q objects: every condition
+is false on NULL, so NOT of a condition is true on NULL.
+"""
+from collections import Counter
+from django.db import connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+from . import exceptions, nodes
+
+OPERATORS = {
+    '=': '=',
+    '!=': '=',
+    '>': '>',
+    '>=': '>=',
+    '<': '<',
+    '<=': '<=',
+}
+
+
+class WhereClause:
+    """SQL condition over the table of the parser's model, with its parameters"""
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = tuple(params)
+
+    def apply(self, queryset):
+        """Return queryset filtered by this clause"""
+        return queryset.extra(where=[self.sql], params=self.params)
+
+    def expression(self):
+        """Return the clause as a boolean expression, for filter() and Q objects"""
+        return RawSQL(self.sql, self.params, output_field=BooleanField())
+
+    def __eq__(self, other):
+        return isinstance(other, WhereClause) and (self.sql, self.params) == (other.sql, other.params)
+
+    def __repr__(self):
+        return '<WhereClause %s %r>' % (self.sql, self.params)
+
+
+class Hop:
+    """outer_column IN (SELECT inner_column FROM table ...)"""
+    __slots__ = ('outer_column', 'outer_null', 'table', 'inner_column', 'inner_null', 'many')
+
+    def __init__(self, outer_column, outer_null, table, inner_column, inner_null, many):
+        self.outer_column = outer_column
+        self.outer_null = outer_null
+        self.table = table
+        self.inner_column = inner_column
+        self.inner_null = inner_null
+        self.many = many
+
+
+class SQLCompiler:
+
+    def __init__(self, parser, using='default'):
+        self.parser = parser
+        self.connection = connections[using]
+        self.quote = self.connection.ops.quote_name
+        self.aliases = 0
+        # Whether the node being compiled is under NOT
+        self.negated = False
+
+    def compile(self, node, params=None):
+        uses = nodes.relation_conditions(node, lambda leaf: self.parser._to_many_prefix(leaf.path))
+        for prefix, kinds in uses.items():
+            if not nodes.shares_row(kinds) and set(kinds) != {nodes.NEGATIVE}:
+                # Checked on the joined row in an order only a join follows
+                raise exceptions.UnsupportedField(prefix)
+        sql, sql_params = self._compile(node, params)
+        return WhereClause(sql, sql_params)
+
+    def _compile(self, node, params):
+        if isinstance(node, nodes.BoolOp):
+            operands = list(_flatten(node.connector, node.operands))
+            if node.connector == 'AND' and not self.negated:
+                parts = self._and(operands, params)
+            else:
+                parts = [self._compile(operand, params) for operand in operands]
+            return (' %s ' % node.connector).join('(%s)' % sql for sql, _ in parts), \
+                [param for _, part_params in parts for param in part_params]
+        if isinstance(node, nodes.Not):
+            node = nodes.fold_not(node)
+            if not isinstance(node, nodes.Not):
+                return self._compile(node, params)
+            # Conditions under NOT are subqueries of their own, as with Q objects
+            negated, self.negated = self.negated, True
+            try:
+                sql, sql_params = self._compile(node.operand, params)
+            finally:
+                self.negated = negated
+            return 'NOT (%s)' % sql, sql_params
+        if isinstance(node, nodes.Between) and (node.negated or self.negated) \
+                and self.parser._to_many_prefix(node.path) is not None:
+            # Each bound of a negated BETWEEN gets its own subquery
+            bounds = nodes.BoolOp('AND', [nodes.Comparison(node.path, '>=', node.low, node.pos),
+                                          nodes.Comparison(node.path, '<=', node.high, node.pos)], node.pos)
+            return self._compile(nodes.Not(bounds, node.pos) if node.negated else bounds, params)
+        if isinstance(node, nodes.Comparison):
+            return self._predicate(node.path, node.op == '!=', self._condition(node, params))
+        if isinstance(node, (nodes.In, nodes.Between)):
+            return self._predicate(node.path, node.negated, self._condition(node, params))
+        if isinstance(node, nodes.IsNull):
+            return self._isnull(node.path, node.isnull)
+        raise exceptions.InvalidQuery()
+
+    def _condition(self, node, params):
+        if isinstance(node, nodes.Comparison):
+            return lambda column, field, null: self._compare(column, field, null, node, params)
+        if isinstance(node, nodes.In):
+            return lambda column, field, null: self._in(column, field, null, node, params)
+        return lambda column, field, null: self._between(column, field, null, node, params)
+
+    def _and(self, operands, params):
+        # Conditions through a to-many relation share the related row, like
+        # with a join, with the other conditions of the AND through it
+        prefixes = [self._bound_prefixes(operand) for operand in operands]
+        counts = Counter(prefix for found in prefixes for prefix in found)
+        groups = {}
+        for operand, found in zip(operands, prefixes):
+            for prefix in found:
+                if counts[prefix] > 1:
+                    if not self._mergeable(operand):
+                        raise exceptions.UnsupportedField(prefix)
+                    groups.setdefault(prefix, []).append(operand)
+        parts = []
+        for operand, found in zip(operands, prefixes):
+            shared = [prefix for prefix in found if counts[prefix] > 1]
+            if not shared:
+                parts.append(self._compile(operand, params))
+            elif shared[0] in groups:
+                # In place of the first condition of the group
+                parts.append(self._group(shared[0], groups.pop(shared[0]), params))
+        return parts
+
+    def _bound_prefixes(self, node):
+        # The to-many relations node checks with the related row of a join
+        if isinstance(node, nodes.BoolOp):
+            return set().union(*[self._bound_prefixes(operand) for operand in node.operands])
+        if isinstance(node, nodes.Not) or self._negated(node):
+            # Only alone with the relation, checked in a subquery of their own
+            return set()
+        prefix = self.parser._to_many_prefix(node.path)
+        return {prefix} if prefix is not None else set()
+
+    def _negated(self, node):
+        if isinstance(node, nodes.Comparison):
+            return node.op == '!='
+        return getattr(node, 'negated', False)
+
+    def _mergeable(self, node):
+        return isinstance(node, (nodes.Comparison, nodes.In, nodes.Between)) and not self._negated(node)
+
+    def _group(self, prefix, operands, params):
+        table = self.quote(self._model()._meta.db_table)
+        shared = []
+        parts = prefix.split('__')
+        for i in range(1, len(parts) + 1):
+            shared.extend(self._hops(self.parser._get_field_info('__'.join(parts[:i])).field, prefix))
+
+        def inner(alias):
+            conditions = []
+            for operand in operands:
+                hops, field = self._resolve_path(operand.path)
+                conditions.append(self._through(alias, hops[len(shared):], field, self._condition(operand, params)))
+            return ' AND '.join('(%s)' % sql for sql, _ in conditions), \
+                [param for _, sql_params in conditions for param in sql_params]
+        return self._nest(table, shared, inner)
+
+    def _predicate(self, path, negated, condition):
+        table = self.quote(self._model()._meta.db_table)
+        hops, field = self._resolve_path(path)
+        sql, sql_params = self._through(table, hops, field, condition)
+        if negated:
+            sql = 'NOT (%s)' % sql
+        return sql, sql_params
+
+    def _through(self, alias, hops, field, condition):
+        return self._nest(alias, hops, lambda inner: condition(
+            '%s.%s' % (inner, self.quote(field.column)), field, field.null))
+
+    def _nest(self, alias, hops, condition):
+        # condition(alias of the last table) inside IN subqueries through hops
+        if not hops:
+            return condition(alias)
+        hop = hops[0]
+        inner = 'U%d' % self.aliases
+        self.aliases += 1
+        outer_column = '%s.%s' % (alias, self.quote(hop.outer_column))
+        inner_column = '%s.%s' % (inner, self.quote(hop.inner_column))
+        sql, sql_params = self._nest(inner, hops[1:], condition)
+        if hop.inner_null:
+            sql = '%s IS NOT NULL AND (%s)' % (inner_column, sql)
+        sql = '%s IN (SELECT %s FROM %s %s WHERE %s)' % (
+            outer_column, inner_column, self.quote(hop.table), inner, sql)
+        if hop.outer_null:
+            sql = '%s IS NOT NULL AND %s' % (outer_column, sql)
+        return sql, sql_params
+
+    def _not_null(self, sql, column, null):
+        if null:
+            return '%s AND %s IS NOT NULL' % (sql, column)
+        return sql
+
+    def _compare(self, column, field, null, node, params):
+        sql = '%s %s %%s' % (column, OPERATORS[node.op])
+        return self._not_null(sql, column, null), [self._value(field, node.path, node.value, params)]
+
+    def _in(self, column, field, null, node, params):
+        values = [self._prepare(field, value)
+                  for value in self.parser._get_list(node.path, node.values, params)]
+        sql = '%s IN (%s)' % (column, ', '.join(['%s'] * len(values)))
+        return self._not_null(sql, column, null), values
+
+    def _between(self, column, field, null, node, params):
+        sql = '%s >= %%s AND %s <= %%s' % (column, column)
+        return self._not_null(sql, column, null), \
+            [self._value(field, node.path, node.low, params), self._value(field, node.path, node.high, params)]
+
+    def _isnull(self, path, isnull):
+        table = self.quote(self._model()._meta.db_table)
+        hops, field = self._resolve_path(path)
+        if not hops:
+            column = '%s.%s' % (table, self.quote(field.column))
+            return '%s IS %sNULL' % (column, '' if isnull else 'NOT '), []
+        # Like a LEFT JOIN, a missing related row counts as NULL
+        sql, sql_params = self._through(table, hops, field, lambda column, field, null:
+                                        ('%s IS NOT NULL' % column, []))
+        if not isnull:
+            return sql, sql_params
+        if not any(hop.many for hop in hops):
+            return 'NOT (%s)' % sql, sql_params
+        missing, _ = self._through(table, hops, field, lambda column, field, null: ('1 = 1', []))
+        null, _ = self._through(table, hops, field, lambda column, field, null: ('%s IS NULL' % column, []))
+        return 'NOT (%s) OR (%s)' % (missing, null), sql_params
+
+    def _value(self, field, path, literal, params):
+        return self._prepare(field, self.parser._get_value(path, literal, params))
+
+    def _prepare(self, field, value):
+        return field.get_db_prep_value(value, self.connection, prepared=False)
+
+    def _model(self):
+        return self.parser._get_model()
+
+    def _resolve_path(self, path):
+        info = self.parser._get_field_info(path)
+        if info.field is None or not info.field.concrete or info.field.many_to_many:
+            raise exceptions.UnsupportedField(path)
+        hops = []
+        parts = path.split('__')
+        for i in range(1, len(parts)):
+            relation = self.parser._get_field_info('__'.join(parts[:i])).field
+            hops.extend(self._hops(relation, path))
+        return hops, info.field
+
+    def _hops(self, field, path):
+        if field is None or not field.is_relation:
+            raise exceptions.UnsupportedField(path)
+        if field.many_to_many:
+            if field.concrete:
+                through = field.remote_field.through
+                through_outer, through_inner = field.m2m_column_name(), field.m2m_reverse_name()
+            else:
+                # Reverse side, the through table is read the other way around
+                through = field.through
+                through_outer, through_inner = field.remote_field.m2m_reverse_name(), field.remote_field.m2m_column_name()
+            target = field.related_model
+            return [
+                Hop(field.model._meta.pk.column, False, through._meta.db_table, through_outer, False, True),
+                Hop(through_inner, False, target._meta.db_table, target._meta.pk.column, False, True),
+            ]
+        if field.concrete:
+            # Forward foreign key or one to one
+            return [Hop(field.column, field.null, field.related_model._meta.db_table,
+                        field.target_field.column, False, False)]
+        # Reverse foreign key or one to one
+        remote = field.remote_field
+        return [Hop(remote.target_field.column, False, field.related_model._meta.db_table,
+                    remote.column, remote.null, not field.one_to_one)]
+
+
+def _flatten(connector, operands):
+    for operand in map(nodes.fold_not, operands):
+        if isinstance(operand, nodes.BoolOp) and operand.connector == connector:
+            yield from _flatten(connector, operand.operands)
+        else:
+            yield operand
@@ -0,0 +1,98 @@
+"""Streaming of large results in keyset order.
+
+Rows are read in chunks of a fixed size, each chunk starting after the last
+row of the previous one instead of at an OFFSET, so every chunk costs the same
+and only one of them is held in memory:
+
+    >>> for obj in stream.keyset(MyModel.objects.filter(q), ordering=['-created', 'pk']):
+    ...     pass
+    >>> stream.write_csv(parser.stream("numberfield > 10", fields=['id', 'name']), f, ['id', 'name'])
+"""
+import csv
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+
+
+def keyset(queryset, ordering=('pk',), chunk_size=1000):
+    """Yield the rows of queryset in the given ordering, one chunk at a time.
+
+    ordering is a list of field paths, with '-' for descending ones. pk is
+    added when missing so the ordering is unique. NULLs come first or last
+    where the database sorts them."""
+
+    ordering = _unique_ordering(ordering)
+    names = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+    queryset = queryset.order_by(*ordering)
+    nulls_largest = connections[queryset.db].features.nulls_order_largest
+    after = None
+    while True:
+        chunk = queryset.filter(after)[:chunk_size] if after is not None else queryset[:chunk_size]
+        rows = list(chunk)
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        after = _after(names, _key(names, rows[-1]), nulls_largest)
+
+
+def write_csv(rows, file, fields, header=True):
+    """Write fields of each row, a dict or an object, as CSV to file"""
+    writer = csv.writer(file)
+    if header:
+        writer.writerow(fields)
+    for row in rows:
+        writer.writerow([_get(row, name) for name in fields])
+
+
+def write_jsonl(rows, file, fields=None):
+    """Write each row as one JSON object per line, with fields of objects or
+    all keys of dicts"""
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    for row in rows:
+        if fields is not None:
+            row = {name: _get(row, name) for name in fields}
+        file.write(encoder.encode(row))
+        file.write('\n')
+
+
+def _unique_ordering(ordering):
+    ordering = list(ordering)
+    if not any(name.lstrip('-') == 'pk' for name in ordering):
+        ordering.append('pk')
+    return ordering
+
+
+def _get(row, name):
+    if isinstance(row, dict):
+        return row[name]
+    for attribute in name.split('__'):
+        row = getattr(row, attribute)
+    return row
+
+
+def _key(names, row):
+    return [_get(row, name) for name, descending in names]
+
+
+def _after(names, key, nulls_largest=False):
+    # (a, b) > (x, y) is a > x OR (a = x AND b > y), where NULL is neither
+    # greater, smaller nor equal, so it is checked apart
+    result = Q()
+    for i, (name, descending) in enumerate(names):
+        nulls_last = nulls_largest != descending
+        if key[i] is None:
+            if nulls_last:
+                # Nothing comes after NULL
+                continue
+            condition = Q(**{name + '__isnull': False})
+        else:
+            condition = Q(**{name + ('__lt' if descending else '__gt'): key[i]})
+            if nulls_last:
+                condition |= Q(**{name + '__isnull': True})
+        for j in range(i):
+            if key[j] is None:
+                condition &= Q(**{names[j][0] + '__isnull': True})
+            else:
+                condition &= Q(**{names[j][0]: key[j]})
+        result |= condition
+    return result
@@ -9,7 +9,7 @@ setup(name = 'django-custom-query',
       author_email = "lhfagundes@gmail.com",
       license = "The MIT License",
       packages = find_packages(),
-      install_requires = ['django', 'sqlparse'],
+      install_requires = ['django'],
       classifiers = [
           'Intended Audience :: Developers',
           'Natural Language :: English',
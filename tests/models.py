@@ -10,3 +10,20 @@ class TestModel(models.Model):
     related = models.ForeignKey(RelatedModel, on_delete=models.CASCADE)
     first_name = models.CharField(max_length=16)
     last_name = models.CharField(max_length=16)
+
+class TypedModel(models.Model):
+    floatfield = models.FloatField(null=True)
+    decimalfield = models.DecimalField(max_digits=8, decimal_places=2, null=True)
+    boolfield = models.BooleanField(default=False)
+    datetimefield = models.DateTimeField(null=True)
+    timefield = models.TimeField(null=True)
+    durationfield = models.DurationField(null=True)
+    uuidfield = models.UUIDField(null=True)
+    related = models.ForeignKey(RelatedModel, null=True, on_delete=models.CASCADE)
+
+class ProxyTestModel(TestModel):
+    class Meta:
+        proxy = True
+
+class ChildModel(RelatedModel):
+    extra = models.IntegerField(default=0)
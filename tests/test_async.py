@@ -0,0 +1,68 @@
+import asyncio
+import time
+from datetime import date
+from django.db.models import Q
+from django.test import TestCase
+from customquery import Parser, exceptions
+from .models import TestModel, RelatedModel
+
+
+class AsyncParseTest(TestCase):
+
+    async def test_aparse(self):
+        parser = Parser(TestModel)
+        self.assertEquals(await parser.aparse('numfield = 1'), Q(numfield=1))
+        self.assertEquals(await parser.aparse('numfield = 1'), Q(numfield=1))
+        self.assertEquals(parser.cache_info().hits, 1)
+        with self.assertRaises(exceptions.FieldDoesNotExist):
+            await parser.aparse('nofield = 1')
+
+    async def test_identical_parses_are_coalesced(self):
+        parser = Parser(TestModel, cache_size=0)
+        parse_tree = parser._parse_tree
+        calls = []
+
+        def slow_parse_tree(query):
+            calls.append(query)
+            time.sleep(0.05)
+            return parse_tree(query)
+        parser._parse_tree = slow_parse_tree
+
+        results = await asyncio.gather(*[parser.aparse('numfield = 1') for _ in range(10)],
+                                       parser.aparse('numfield = 2'))
+        self.assertEquals(results, [Q(numfield=1)] * 10 + [Q(numfield=2)])
+        self.assertEquals(sorted(calls), ['numfield = 1', 'numfield = 2'])
+        # Every caller gets its own copy
+        self.assertEquals(len({id(result) for result in results}), 11)
+        self.assertEquals(parser._pending[asyncio.get_running_loop()], {})
+
+    async def test_cancelled_caller(self):
+        parser = Parser(TestModel, cache_size=0)
+        first = asyncio.ensure_future(parser.aparse('numfield = 1'))
+        second = asyncio.ensure_future(parser.aparse('numfield = 1'))
+        await asyncio.sleep(0)
+        first.cancel()
+        self.assertEquals(await second, Q(numfield=1))
+
+
+class AsyncQuerySetTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        related = RelatedModel.objects.create(name='r')
+        for i in range(5):
+            TestModel.objects.create(charfield='abc'[i % 3], numfield=i, datefield=date(2018, 1, 1), related=related)
+
+    async def test_helpers(self):
+        parser = Parser(TestModel)
+        self.assertEquals(await parser.acount('numfield >= 2'), 3)
+        self.assertTrue(await parser.aexists('charfield = c'))
+        self.assertFalse(await parser.aexists('charfield = d'))
+        numbers = [obj.numfield async for obj in parser.aiterator('numfield < 3', chunk_size=2)]
+        self.assertEquals(sorted(numbers), [0, 1, 2])
+
+    async def test_queryset(self):
+        parser = Parser(TestModel)
+        queryset = TestModel.objects.filter(charfield='a')
+        self.assertEquals(await parser.acount('numfield > 0', queryset), 1)
+        self.assertEquals(await (await parser.afilter('numfield > 0')).acount(), 4)
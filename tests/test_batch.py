@@ -0,0 +1,82 @@
+import pickle
+import threading
+from concurrent import futures
+from django.db.models import Q, Value as V
+from django.db.models.functions import Concat
+from django.test import TestCase
+from customquery import Parser, exceptions
+from .models import TestModel
+
+
+class ParseManyTest(TestCase):
+
+    queries = ['numfield = 1', 'nofield = 1', 'charfield in (a, b)', 'numfield = 1', 'numfield in (1']
+
+    def assertResults(self, results):
+        self.assertEquals([result.query for result in results], self.queries)
+        self.assertEquals(results[0].q, Q(numfield=1))
+        self.assertIsInstance(results[1].error, exceptions.FieldDoesNotExist)
+        self.assertEquals(results[2], (self.queries[2], Q(charfield__in=('a', 'b')), None))
+        self.assertEquals(results[3].q, Q(numfield=1))
+        self.assertIsNot(results[3].q, results[0].q)
+        self.assertIsNone(results[4].q)
+        self.assertIsInstance(results[4].error, exceptions.CustomQueryError)
+
+    def test_parse_many(self):
+        self.assertResults(Parser(TestModel).parse_many(self.queries))
+
+    def test_thread_pool(self):
+        self.assertResults(Parser(TestModel).parse_many(self.queries, executor='thread', workers=2, chunk_size=2))
+        with futures.ThreadPoolExecutor(2) as executor:
+            self.assertResults(Parser(TestModel).parse_many(self.queries, executor=executor))
+
+    def test_process_pool(self):
+        parser = Parser(TestModel.objects.annotate(full_name=Concat('first_name', V(' '), 'last_name')))
+        self.queries = self.queries + ['full_name = "a b"']
+        results = parser.parse_many(self.queries, executor='process', workers=2)
+        self.assertResults(results)
+        self.assertEquals(results[5].q, Q(full_name='a b'))
+
+    def test_unknown_executor(self):
+        self.assertRaises(ValueError, Parser(TestModel).parse_many, self.queries, executor='fiber')
+
+
+class PickleTest(TestCase):
+
+    def test_parser(self):
+        parser = Parser(TestModel.objects.annotate(full_name=Concat('first_name', V(' '), 'last_name')),
+                        cache_size=10, shared_cache='default')
+        parser.parse('numfield = 1')
+        copy = pickle.loads(pickle.dumps(parser))
+        self.assertEquals(copy.parse('full_name = a and datefield = 2018-01-02'),
+                          parser.parse('full_name = a and datefield = 2018-01-02'))
+        self.assertEquals(copy.cache_info().maxsize, 10)
+        self.assertIs(copy.shared_cache, parser.shared_cache)
+
+    def test_errors(self):
+        error = pickle.loads(pickle.dumps(exceptions.QueryTooDeep(5, 12)))
+        self.assertEquals((str(error), error.limit, error.position), (str(exceptions.QueryTooDeep(5, 12)), 5, 12))
+
+
+class ThreadSafetyTest(TestCase):
+
+    def test_shared_parser(self):
+        # A small cache so threads keep evicting each other's entries
+        parser = Parser(TestModel, cache_size=4, relation_depth=0)
+        queries = ['numfield = %d or related.name = r%d' % (i, i) for i in range(50)]
+        expected = [Q(numfield=i) | Q(related__name='r%d' % i) for i in range(50)]
+        failures = []
+
+        def work():
+            for _ in range(5):
+                for query, q in zip(queries, expected):
+                    if parser.parse(query) != q:
+                        failures.append(query)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(failures, [])
+        self.assertEquals(parser.cache_info().currsize, 4)
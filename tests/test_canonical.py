@@ -0,0 +1,77 @@
+from django.test import TestCase
+from customquery import Parser
+from customquery import canonical, grammar
+from .models import TestModel, RelatedModel
+
+
+class CanonicalTest(TestCase):
+
+    def canonical(self, query, strip_literals=False):
+        return canonical.canonicalize(grammar.parse(query), strip_literals)
+
+    def test_variants(self):
+        expected = "charfield = 'foo' AND numfield = 1"
+        for query in ["numfield=1 AND charfield='foo'",
+                      'charfield="foo" and numfield = 1',
+                      '(numfield=1) AND charfield=foo',
+                      '((charfield = foo))  and  (numfield=1)']:
+            self.assertEquals(self.canonical(query), expected)
+
+    def test_quoting(self):
+        self.assertEquals(self.canonical('charfield = "it\'s"'), "charfield = 'it''s'")
+        self.assertEquals(self.canonical("charfield = 'say \"hi\"'"), "charfield = 'say \"hi\"'")
+        self.assertEquals(self.canonical("charfield = '1'"), "charfield = '1'")
+        self.assertEquals(self.canonical("related.name = :name"), "related.name = :name")
+
+    def test_operators(self):
+        self.assertEquals(self.canonical('numfield <> 1'), 'numfield != 1')
+        self.assertEquals(self.canonical('numfield not 1'), 'numfield != 1')
+        self.assertEquals(self.canonical('numfield not in (3, 1, 2)'), 'numfield NOT IN (1, 2, 3)')
+        self.assertEquals(self.canonical('numfield in :values'), 'numfield IN :values')
+        self.assertEquals(self.canonical('numfield between 1 and 2'), 'numfield BETWEEN 1 AND 2')
+        self.assertEquals(self.canonical('numfield is not null'), 'numfield IS NOT NULL')
+
+    def test_parenthesis(self):
+        self.assertEquals(self.canonical('(b = 1 or (a = 1 or c = 1)) and d = 1'),
+                          '(a = 1 OR b = 1 OR c = 1) AND d = 1')
+        self.assertEquals(self.canonical('not (a = 1 and b = 1)'), 'NOT (a = 1 AND b = 1)')
+        self.assertEquals(self.canonical('not (a = 1)'), 'NOT a = 1')
+        self.assertEquals(self.canonical('a = 1 or (b = 1 and c = 1)'), 'a = 1 OR b = 1 AND c = 1')
+
+    def test_strip_literals(self):
+        self.assertEquals(self.canonical('numfield in (1, 2, 3) and charfield = "x"', strip_literals=True),
+                          'charfield = ? AND numfield IN (?)')
+        self.assertEquals(self.canonical('numfield between 1 and :high', strip_literals=True),
+                          'numfield BETWEEN ? AND :high')
+
+    def test_reparse(self):
+        for query in ['not (a = 1 or b in (x, "y z")) and c = "it\'s"', 'a = 1 or b = 1 and not c is null']:
+            text = self.canonical(query)
+            self.assertEquals(self.canonical(text), text)
+
+    def test_parser(self):
+        parser = Parser(TestModel)
+        self.assertEquals(parser.canonical('numfield=1 and charfield=a'), "charfield = 'a' AND numfield = 1")
+        self.assertEquals(parser.fingerprint('numfield=1 and charfield=a'),
+                          parser.fingerprint("charfield = 'a' AND numfield = 1"))
+        self.assertNotEquals(parser.fingerprint('numfield=1'), parser.fingerprint('numfield=2'))
+        self.assertEquals(parser.fingerprint('numfield=1', strip_literals=True),
+                          parser.fingerprint('numfield=2', strip_literals=True))
+
+    def test_variants_keep_their_q(self):
+        parser = Parser(TestModel)
+        uncached = Parser(TestModel, cache_size=0)
+        parser.parse('numfield=1 and charfield=a')
+        query = '(charfield = "a") AND numfield = 1'
+        self.assertEquals(parser.parse(query), uncached.parse(query))
+        self.assertEquals(parser.canonical(query), parser.canonical('numfield=1 and charfield=a'))
+
+    def test_relation_order(self):
+        parser = Parser(RelatedModel)
+        # The negation is checked on the joined row only after the equality
+        self.assertEquals(parser.canonical('testmodel.numfield = 3 and name = r1 and testmodel.numfield != 5'),
+                          "name = 'r1' AND testmodel.numfield = 3 AND testmodel.numfield != 5")
+        self.assertEquals(parser.canonical('testmodel.numfield != 5 and name = r1 and testmodel.numfield = 3'),
+                          "name = 'r1' AND testmodel.numfield != 5 AND testmodel.numfield = 3")
+        self.assertEquals(parser.canonical('testmodel.numfield = 3 and testmodel.charfield = a'),
+                          parser.canonical('testmodel.charfield = a and testmodel.numfield = 3'))
@@ -0,0 +1,75 @@
+import uuid
+from datetime import datetime, time, timedelta, timezone
+from decimal import Decimal
+from django.db.models import Q, fields
+from django.test import TestCase
+from customquery import Parser, converters, exceptions
+from .models import TestModel, TypedModel
+
+
+class ConverterTest(TestCase):
+
+    def setUp(self):
+        self.parser = Parser(TypedModel)
+
+    def test_field_types(self):
+        self.assertEquals(self.parser.parse('floatfield > 1.5'), Q(floatfield__gt=1.5))
+        self.assertEquals(self.parser.parse('decimalfield = "10.25"'), Q(decimalfield=Decimal('10.25')))
+        self.assertEquals(self.parser.parse('boolfield = true'), Q(boolfield=True))
+        self.assertEquals(self.parser.parse('boolfield = 0'), Q(boolfield=False))
+        self.assertEquals(self.parser.parse('timefield < 10:30'), Q(timefield__lt=time(10, 30)))
+        self.assertEquals(self.parser.parse('durationfield > "1 02:00:00"'),
+                          Q(durationfield__gt=timedelta(days=1, hours=2)))
+        value = uuid.UUID('12345678123456781234567812345678')
+        self.assertEquals(self.parser.parse('uuidfield = %s' % value), Q(uuidfield=value))
+        self.assertEquals(self.parser.parse('related = "3"'), Q(related=3))
+
+    def test_datetime(self):
+        self.assertEquals(self.parser.parse('datetimefield > "2018-12-13 10:00:00+00:00"'),
+                          Q(datetimefield__gt=datetime(2018, 12, 13, 10, tzinfo=timezone.utc)))
+        # Dates alone are midnight in the current time zone
+        q = self.parser.parse('datetimefield > 2018-12-13')
+        self.assertEquals(q.children[0][1].replace(tzinfo=None), datetime(2018, 12, 13))
+        self.assertIsNotNone(q.children[0][1].tzinfo)
+
+    def test_lists_and_ranges(self):
+        self.assertEquals(self.parser.parse('floatfield in (1, 2.5, "3")'), Q(floatfield__in=(1.0, 2.5, 3.0)))
+        self.assertEquals(self.parser.parse('decimalfield between 1 and 2.5'),
+                          Q(decimalfield__gte=Decimal(1)) & Q(decimalfield__lte=Decimal('2.5')))
+
+    def test_invalid_value(self):
+        with self.assertRaises(exceptions.InvalidValue) as context:
+            self.parser.parse('floatfield in (1, 2, abc)')
+        self.assertEquals((context.exception.value, context.exception.position), ('abc', 21))
+        self.assertRaises(ValueError, self.parser.parse, 'boolfield = maybe')
+        self.assertRaises(ValueError, self.parser.parse, 'decimalfield = abc')
+        self.assertRaises(ValueError, self.parser.parse, 'uuidfield = abc')
+
+    def test_parameters(self):
+        query = self.parser.compile('floatfield in :values and boolfield = :flag')
+        self.assertEquals(query.bind(values=['1.5', 2], flag='no'),
+                          Q(floatfield__in=(1.5, 2)) & Q(boolfield=False))
+
+    def test_resolved_once_per_path(self):
+        converter = self.parser._get_field_info('floatfield').converter
+        self.parser.parse('floatfield = 1 or floatfield in (2, 3)')
+        self.assertIs(self.parser._get_field_info('floatfield').converter, converter)
+
+    def test_parser_converters(self):
+        def comma_decimal(parser, field):
+            return lambda value: float(value.replace(',', '.'))
+        parser = Parser(TypedModel, converters={fields.FloatField: comma_decimal})
+        self.assertEquals(parser.parse('floatfield = "1,5"'), Q(floatfield=1.5))
+
+    def test_register(self):
+        @converters.register(fields.CharField)
+        def upper(parser, field):
+            return str.upper
+        try:
+            self.assertEquals(Parser(TestModel).parse('charfield = abc'), Q(charfield='ABC'))
+        finally:
+            converters.register(fields.CharField, converters._text)
+
+    def test_annotations_keep_literals(self):
+        parser = Parser(TestModel.objects.annotate(foo=Q(numfield=1)))
+        self.assertEquals(parser.parse('foo = 1'), Q(foo=1))
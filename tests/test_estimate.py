@@ -0,0 +1,54 @@
+from datetime import date
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from customquery import Parser
+from customquery.estimate import Estimate, estimate_count
+from .models import TestModel, RelatedModel, ChildModel
+
+
+class EstimateTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        related = RelatedModel.objects.create(name='r')
+        TestModel.objects.bulk_create([
+            TestModel(charfield='abc'[i % 3], numfield=i % 100, datefield=date(2018, 1, 1), related=related)
+            for i in range(5000)
+        ])
+        # Gaps in the pk range
+        TestModel.objects.filter(pk__range=(1000, 1999)).delete()
+
+    def test_exact_below_threshold(self):
+        parser = Parser(TestModel)
+        self.assertEquals(parser.estimate_count('numfield = 1'), Estimate(40, 0, True, 'exact'))
+        with CaptureQueriesContext(connection) as queries:
+            estimate_count(TestModel.objects.filter(numfield__gt=1), threshold=100)
+        self.assertIn('LIMIT 101', queries[0]['sql'])
+
+    def test_sample(self):
+        parser = Parser(TestModel)
+        for query in ('numfield > 1', 'charfield = a', 'numfield < 50 and charfield != b'):
+            expected = parser.filter(query).count()
+            for seed in range(5):
+                estimate = parser.estimate_count(query, threshold=100, seed=seed, windows=20, sample_fraction=0.1)
+                self.assertEquals((estimate.exact, estimate.method), (False, 'sample'))
+                self.assertLessEqual(abs(estimate.count - expected), estimate.error, (query, seed, estimate))
+                self.assertLess(estimate.error, expected)
+
+    def test_sample_queries(self):
+        # The bounded count, the pk range and the sample itself
+        with self.assertNumQueries(3):
+            estimate_count(TestModel.objects.filter(numfield__gt=1), threshold=100)
+
+    def test_single_window(self):
+        estimate = estimate_count(RelatedModel.objects.all(), threshold=0, windows=1)
+        self.assertEquals(estimate, Estimate(1, 1, False, 'sample'))
+
+    def test_exact_fallback(self):
+        # The pk of a child model is a one to one field, which is not sampled
+        for i in range(3):
+            ChildModel.objects.create(name='c%d' % i)
+        with self.assertNumQueries(2):
+            estimate = estimate_count(ChildModel.objects.all(), threshold=1, planner=False)
+        self.assertEquals(estimate, Estimate(3, 0, True, 'exact'))
@@ -0,0 +1,127 @@
+from unittest import skipIf
+from django.test import TestCase
+from customquery import Parser, evaluator, exceptions
+from customquery.percolator import Percolator
+from .models import TestModel, RelatedModel
+from .test_sql import DifferentialTest
+
+
+class PredicateTest(TestCase):
+    """The evaluator must match the same rows as the Q objects"""
+
+    @classmethod
+    def setUpTestData(cls):
+        DifferentialTest.setUpTestData.__func__(cls)
+
+    def assertSameRows(self, parser, queryset, queries, rows):
+        for query in queries:
+            expected = set(queryset.filter(parser.parse(query)).values_list('pk', flat=True))
+            matches = parser.predicate(query)
+            self.assertEquals({row['pk'] if isinstance(row, dict) else row.pk for row in rows if matches(row)},
+                              expected, query)
+
+    def test_instances(self):
+        objects = list(TestModel.objects.select_related('related'))
+        self.assertSameRows(Parser(TestModel), TestModel.objects.all(), DifferentialTest.queries, objects)
+
+    def test_dicts(self):
+        rows = list(TestModel.objects.values('pk', 'charfield', 'numfield', 'datefield', 'related',
+                                             'related_id', 'related__name'))
+        self.assertSameRows(Parser(TestModel), TestModel.objects.all(), DifferentialTest.queries, rows)
+
+    def test_reverse_relation(self):
+        objects = list(RelatedModel.objects.prefetch_related('testmodel_set'))
+        queries = DifferentialTest.related_queries + DifferentialTest.shared_row_queries + \
+            DifferentialTest.negated_queries + [
+                # A join binds the related row of the OR as well
+                'testmodel.numfield < 3 and (testmodel.numfield > 1 or name = r1)',
+                'testmodel.charfield = c and (testmodel.numfield = 2 or testmodel.numfield > 9)',
+            ]
+        self.assertSameRows(Parser(RelatedModel), RelatedModel.objects.all(), queries, objects)
+        rows = list(RelatedModel.objects.values('pk', 'name', 'testmodel__charfield', 'testmodel__numfield',
+                                                'testmodel__datefield'))
+        # Each dict of values() is one joined row
+        self.assertSameRows(Parser(RelatedModel), RelatedModel.objects.all(), DifferentialTest.shared_row_queries,
+                            rows)
+
+    def test_unsupported_relation_order(self):
+        parser = Parser(RelatedModel)
+        # Django checks a negation after a condition through the relation on the joined row
+        self.assertRaises(exceptions.UnsupportedField, parser.predicate,
+                          'testmodel.numfield = 3 and testmodel.numfield != 5')
+        self.assertRaises(exceptions.UnsupportedField, parser.predicate,
+                          'testmodel.numfield < 3 and testmodel.charfield is null')
+
+    def test_reverse_relation_without_prefetch(self):
+        parser = Parser(RelatedModel)
+        obj = RelatedModel.objects.get(testmodel__numfield=4)
+        matches = parser.predicate('testmodel.numfield = 4')
+        # One query per row and condition, unless prefetched
+        with self.assertNumQueries(1):
+            self.assertTrue(matches(obj))
+        objects = list(RelatedModel.objects.prefetch_related('testmodel_set'))
+        with self.assertNumQueries(0):
+            self.assertEquals(len([obj for obj in objects if matches(obj)]), 1)
+        self.assertFalse(parser.predicate('testmodel.numfield = 500')(obj))
+        percolator = Percolator(parser)
+        percolator.add('four', 'testmodel.numfield = 4')
+        percolator.add('many', 'testmodel.numfield > 100')
+        self.assertEquals(percolator.match(obj), {'four'})
+
+    def test_validation(self):
+        parser = Parser(TestModel)
+        self.assertRaises(exceptions.FieldDoesNotExist, parser.predicate, 'nofield = 1')
+        self.assertRaises(exceptions.InvalidValue, parser.predicate, 'datefield = tomorrow')
+
+    def test_cached(self):
+        parser = Parser(TestModel)
+        self.assertIs(parser.predicate('numfield = 1'), parser.predicate('numfield = 1'))
+
+    def test_templates(self):
+        query = Parser(TestModel).compile('numfield > :min and charfield in :chars')
+        matches = query.predicate(min=2, chars=['a', 'b'])
+        self.assertTrue(matches({'numfield': 3, 'charfield': 'a'}))
+        self.assertFalse(matches({'numfield': 3, 'charfield': 'c'}))
+        self.assertFalse(matches({'numfield': None, 'charfield': 'a'}))
+
+
+@skipIf(evaluator.numpy is None, "numpy is not installed")
+class MaskTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        DifferentialTest.setUpTestData.__func__(cls)
+
+    def columns(self):
+        numpy = evaluator.numpy
+        rows = list(TestModel.objects.order_by('pk').values_list('pk', 'charfield', 'numfield', 'datefield',
+                                                                 'related_id', 'related__name'))
+        pk, charfield, numfield, datefield, related, name = zip(*rows)
+        return numpy.array(pk), {
+            'charfield': numpy.array(charfield),
+            'numfield': numpy.ma.masked_equal(numpy.array([-1 if n is None else n for n in numfield]), -1),
+            'datefield': numpy.array(datefield, dtype='datetime64[D]'),
+            'related_id': numpy.array(related),
+            'related__name': numpy.array(name, dtype=object),
+        }
+
+    def test_same_rows(self):
+        parser = Parser(TestModel)
+        pk, columns = self.columns()
+        for query in DifferentialTest.queries:
+            expected = set(TestModel.objects.filter(parser.parse(query)).values_list('pk', flat=True))
+            self.assertEquals(set(pk[parser.mask(query, columns)].tolist()), expected, query)
+
+    def test_nulls(self):
+        numpy = evaluator.numpy
+        parser = Parser(TestModel)
+        columns = {'numfield': numpy.array([1.0, numpy.nan, 3.0])}
+        self.assertEquals(parser.mask('numfield > 0', columns).tolist(), [True, False, True])
+        self.assertEquals(parser.mask('not numfield > 2', columns).tolist(), [True, True, False])
+        self.assertEquals(parser.mask('numfield is null', columns).tolist(), [False, True, False])
+        columns = {'numfield': numpy.array([1, None, 3], dtype=object)}
+        self.assertEquals(parser.mask('numfield in (1, 2) or numfield between 3 and 4', columns).tolist(),
+                          [True, False, True])
+
+    def test_missing_column(self):
+        self.assertRaises(KeyError, Parser(TestModel).mask, 'numfield = 1', {})
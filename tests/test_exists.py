@@ -0,0 +1,95 @@
+from django.test import TestCase
+from customquery import Parser
+from .models import TestModel, RelatedModel
+from .test_sql import DifferentialTest
+
+
+class ExistsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        DifferentialTest.setUpTestData.__func__(cls)
+        # A related row without any TestModel
+        RelatedModel.objects.create(name='r3')
+
+    queries = DifferentialTest.related_queries + [
+        'testmodel.numfield > 5 or testmodel.charfield = a',
+        'testmodel.numfield > 5 and testmodel.charfield = c',
+        'not (testmodel.numfield > 5 or name = r0)',
+        'testmodel.numfield in (1, 2) or testmodel.numfield between 8 and 9 or testmodel is null',
+        'testmodel is not null and testmodel.datefield < 2018-01-04',
+        'testmodel.related.name = r1',
+        'testmodel.numfield not in (1, 2) and testmodel.numfield not between 3 and 6',
+        # Nested chains of one connector are one chain
+        '(testmodel.numfield < 3) and (testmodel.numfield > 1 and name = r1)',
+        '(testmodel.numfield < 5) and (testmodel.numfield > 3 and name = r1)',
+        '(testmodel.numfield < 4 and (testmodel.charfield = b)) and testmodel.numfield > 1',
+        '(testmodel.numfield = 3 or (testmodel.numfield = 7 or name = r2))',
+        # ORs inside AND share the related row with the other conditions
+        'testmodel.numfield > 6 and (testmodel.charfield = a or name = r0)',
+        'testmodel.numfield > 6 and (testmodel.charfield = c or testmodel.numfield < 8)',
+        '(testmodel.charfield = a or name = r3) and (testmodel.numfield > 8 or name = r3)',
+        '(testmodel.numfield = 1 or testmodel.numfield = 7) and (testmodel.charfield = b and name != r0 '
+        'or testmodel.datefield > 2018-01-10)',
+        'testmodel.numfield is null and (testmodel.charfield = a or name = r1)',
+        '(testmodel.numfield > 3 and (testmodel.charfield = a or name = r1)) or name = r3',
+        # Negations and IS NULL are checked on the joined row
+        'testmodel.numfield is null and testmodel.numfield = 7',
+        'testmodel.numfield = 3 and testmodel.numfield != 5',
+        'testmodel.numfield != 5 and testmodel.numfield = 3',
+        'testmodel.charfield = a or testmodel.numfield != 6',
+        'not (testmodel.numfield = 3 and testmodel.charfield = b)',
+        'testmodel.numfield not between 2 and 3',
+        'testmodel.numfield is not null and not (testmodel.numfield is null or testmodel.numfield not between 3 and 6)',
+        # NOT of a negation is the condition itself
+        'not (testmodel.numfield != 3) and testmodel.charfield = b',
+        'not (testmodel.numfield not between 2 and 3) or name = r3',
+    ]
+
+    def test_same_rows(self):
+        join = Parser(RelatedModel, relation_depth=2)
+        exists = Parser(RelatedModel, relation_depth=2, to_many='exists')
+        for query in self.queries:
+            expected = set(RelatedModel.objects.filter(join.parse(query)).values_list('pk', flat=True))
+            rows = list(RelatedModel.objects.filter(exists.parse(query)).values_list('pk', flat=True))
+            self.assertEquals(sorted(rows), sorted(expected), query)
+
+    def test_rows_are_not_multiplied(self):
+        query = 'testmodel.numfield > 5 or testmodel.charfield = a'
+        joined = RelatedModel.objects.filter(Parser(RelatedModel).parse(query))
+        self.assertEquals(joined.count(), 7)
+        self.assertEquals(joined.distinct().count(), 3)
+        exists = RelatedModel.objects.filter(Parser(RelatedModel, to_many='exists').parse(query))
+        self.assertEquals(exists.count(), 3)
+
+    def test_joined_row_in_subquery(self):
+        query = 'testmodel.numfield = 3 and testmodel.numfield != 5'
+        joined = RelatedModel.objects.filter(Parser(RelatedModel).parse(query))
+        exists = RelatedModel.objects.filter(Parser(RelatedModel, to_many='exists').parse(query))
+        self.assertEquals(exists.count(), joined.distinct().count())
+        self.assertNotIn('JOIN', str(exists.query).split('IN (')[0])
+
+    def test_sql(self):
+        parser = Parser(RelatedModel, to_many='exists')
+        sql = str(RelatedModel.objects.filter(parser.parse(
+            'testmodel.numfield > 5 or testmodel.charfield = a or name = r0')).query)
+        self.assertNotIn('JOIN', sql)
+        # Both conditions on testmodel share one subquery
+        self.assertEquals(sql.count('EXISTS'), 1)
+        self.assertIn('EXISTS(SELECT 1 AS "a" FROM "tests_testmodel" U0 WHERE ', sql)
+        self.assertIn('U0."related_id" = ("tests_relatedmodel"."id")', sql)
+
+        sql = str(RelatedModel.objects.filter(Parser(RelatedModel).parse('testmodel.numfield > 5')).query)
+        self.assertIn('INNER JOIN', sql)
+
+    def test_strategy_per_relation(self):
+        parser = Parser(RelatedModel, to_many_strategies={'testmodel': 'exists'})
+        self.assertIn('EXISTS', str(RelatedModel.objects.filter(parser.parse('testmodel.numfield = 1')).query))
+        parser = Parser(RelatedModel, to_many='exists', to_many_strategies={'testmodel': 'join'})
+        self.assertNotIn('EXISTS', str(RelatedModel.objects.filter(parser.parse('testmodel.numfield = 1')).query))
+        self.assertRaises(ValueError, Parser, RelatedModel, to_many='subquery')
+
+    def test_to_one_relations_are_joined(self):
+        parser = Parser(TestModel, to_many='exists')
+        sql = str(TestModel.objects.filter(parser.parse('related.name = r1')).query)
+        self.assertNotIn('EXISTS', sql)
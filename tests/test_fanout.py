@@ -0,0 +1,79 @@
+from datetime import date
+from unittest import mock
+from django.db import connections
+from django.test import TransactionTestCase
+from customquery import Parser
+from customquery.fanout import FanOut, _OrderKey
+from .models import TestModel, RelatedModel
+
+
+class FanOutTest(TransactionTestCase):
+
+    databases = {'default', 'shard1', 'shard2'}
+
+    def setUp(self):
+        self.numbers = {}
+        for shard, alias in enumerate(['default', 'shard1', 'shard2']):
+            related = RelatedModel.objects.using(alias).create(name='r%d' % shard)
+            self.numbers[alias] = [i for i in range(30) if i % 3 == shard]
+            TestModel.objects.using(alias).bulk_create([
+                TestModel(charfield='abc'[i % 2], numfield=i, datefield=date(2018, 1, 1), related=related)
+                for i in self.numbers[alias]
+            ])
+        self.shards = FanOut(Parser(TestModel), ['default', 'shard1', 'shard2'])
+
+    def test_ordered_merge(self):
+        rows = self.shards.list('numfield >= 5', ordering=['numfield'], chunk_size=2)
+        self.assertEquals([obj.numfield for obj in rows], list(range(5, 30)))
+        self.assertEquals({obj._state.db for obj in rows}, {'default', 'shard1', 'shard2'})
+        rows = self.shards.list('numfield >= 5', ordering=['charfield', '-numfield'])
+        self.assertEquals([obj.numfield for obj in rows],
+                          sorted(range(5, 30), key=lambda i: ('abc'[i % 2], -i)))
+
+    def test_ordered_merge_with_fewer_workers(self):
+        shards = FanOut(Parser(TestModel), ['default', 'shard1'], max_workers=1)
+        rows = shards.list('numfield >= 0', ordering=['numfield'], chunk_size=2)
+        self.assertEquals([obj.numfield for obj in rows], sorted(self.numbers['default'] + self.numbers['shard1']))
+
+    def test_nulls(self):
+        for alias in ['default', 'shard1', 'shard2']:
+            TestModel.objects.using(alias).filter(numfield__lt=3).update(numfield=None)
+        rows = self.shards.list('charfield = a or charfield = b', ordering=['numfield', 'pk'], chunk_size=2)
+        self.assertEquals([obj.numfield for obj in rows], [None] * 3 + list(range(3, 30)))
+        rows = self.shards.list('charfield = a or charfield = b', ordering=['-numfield', 'pk'], chunk_size=2)
+        self.assertEquals([obj.numfield for obj in rows], list(range(29, 2, -1)) + [None] * 3)
+
+    def test_nulls_largest(self):
+        names = [('numfield', False)]
+        self.assertTrue(_OrderKey(names, {'numfield': 1}, True) < _OrderKey(names, {'numfield': None}, True))
+        self.assertFalse(_OrderKey(names, {'numfield': None}, True) < _OrderKey(names, {'numfield': 1}, True))
+        with mock.patch.object(connections['shard1'].features, 'nulls_order_largest', True):
+            with self.assertRaises(ValueError):
+                self.shards.list('numfield > 1', ordering=['numfield'])
+            # Without an ordering NULLs don't matter
+            self.assertEquals(len(self.shards.list('numfield > 1')), 28)
+
+    def test_limit_and_offset(self):
+        rows = self.shards.list('numfield >= 5', ordering=['-numfield'], offset=3, limit=4, chunk_size=1)
+        self.assertEquals([obj.numfield for obj in rows], [26, 25, 24, 23])
+
+    def test_unordered(self):
+        rows = self.shards.list('charfield = a or related.name = r1')
+        expected = [i for i in range(30) if i % 2 == 0 or i % 3 == 1]
+        self.assertEquals(sorted(obj.numfield for obj in rows), expected)
+        self.assertEquals(len(self.shards.list('numfield < 10', limit=4)), 4)
+
+    def test_counts(self):
+        self.assertEquals(self.shards.counts('numfield < 10'), {'default': 4, 'shard1': 3, 'shard2': 3})
+        self.assertEquals(self.shards.count('numfield < 10'), 10)
+
+    def test_stopping_early(self):
+        iterator = self.shards.iterator('numfield >= 0', ordering=['numfield'], chunk_size=1)
+        self.assertEquals(next(iterator).numfield, 0)
+        iterator.close()
+
+    def test_errors(self):
+        shards = FanOut(Parser(TestModel.objects.values('numfield')), ['default', 'shard1'])
+        with self.assertRaises(Exception):
+            # The ordering field is not selected
+            list(shards.iterator('numfield > 1', ordering=['charfield']))
@@ -0,0 +1,85 @@
+from django.test import TestCase
+from customquery import Parser, exceptions, grammar
+from customquery.incremental import IncrementalParser
+from .models import TestModel
+
+
+class IncrementalParserTest(TestCase):
+
+    def setUp(self):
+        self.editor = IncrementalParser(Parser(TestModel))
+
+    def test_valid(self):
+        result = self.editor.update('numfield > 1 and related.name = foo')
+        self.assertEquals(result.diagnostics, [])
+        self.assertEquals(result.node.key(), grammar.parse('numfield > 1 and related.name = foo').key())
+
+    def test_syntax_errors(self):
+        result = self.editor.update('numfield > 1 and')
+        self.assertIsNone(result.node)
+        [diagnostic] = result.diagnostics
+        self.assertEquals((diagnostic.start, diagnostic.end), (16, 16))
+        self.assertEquals(diagnostic.expected, grammar.EXPECT_CONDITION)
+
+        [diagnostic] = self.editor.update('numfield = 1 numfield = 2').diagnostics
+        self.assertEquals((diagnostic.start, diagnostic.end, diagnostic.expected), (13, 21, ('AND', 'OR')))
+        [diagnostic] = self.editor.update('numfield between 1 or 2').diagnostics
+        self.assertEquals((diagnostic.start, diagnostic.end, diagnostic.expected), (19, 21, ('AND',)))
+        [diagnostic] = self.editor.update('(numfield = 1').diagnostics
+        self.assertEquals(diagnostic.expected, (')', 'AND', 'OR'))
+
+    def test_unterminated_string(self):
+        [diagnostic] = self.editor.update('charfield = "foo').diagnostics
+        self.assertIsInstance(diagnostic.error, exceptions.UnterminatedString)
+        self.assertEquals((diagnostic.start, diagnostic.end, diagnostic.expected), (12, 16, ('"',)))
+
+    def test_field_and_value_errors(self):
+        result = self.editor.update('nope = 1 and numfield = x')
+        self.assertEquals([(diagnostic.start, diagnostic.end) for diagnostic in result.diagnostics],
+                          [(0, 4), (24, 25)])
+        self.assertIsInstance(result.diagnostics[0].error, exceptions.FieldDoesNotExist)
+        self.assertIsInstance(result.diagnostics[1].error, exceptions.InvalidValue)
+
+    def test_reuse(self):
+        self.editor.update('numfield > 1 and charfield = foo and related.name = b')
+        result = self.editor.update('numfield > 1 and charfield = foo and related.name = bar')
+        self.assertEquals(result.diagnostics, [])
+        self.assertEquals(self.editor.reused_conditions, 2)
+        self.assertEquals(self.editor.reused_tokens, 10)
+
+        # A value extended in place is not reused
+        self.editor.update('numfield > 1')
+        result = self.editor.update('numfield > 12')
+        self.assertEquals(self.editor.reused_conditions, 0)
+        self.assertEquals(result.node.value.value, '12')
+
+        # Diagnostics of reused conditions are kept
+        self.editor.update('nope = 1')
+        result = self.editor.update('nope = 1 and numfield = 2')
+        self.assertEquals(self.editor.reused_conditions, 1)
+        self.assertEquals(len(result.diagnostics), 1)
+
+    def test_edits_match_full_parse(self):
+        query = 'numfield > 1 and (charfield = "a b" or related.name in (x, y)) and not datefield is null'
+        edits = [query[:end] for end in range(len(query) + 1)]
+        edits += edits[::-1] + [query.replace('1', '10'), query.replace('a b', 'a'), query.replace('null', 'nul'), query]
+        for text in edits:
+            result = self.editor.update(text)
+            try:
+                expected = grammar.parse(text).key()
+            except exceptions.CustomQueryError:
+                expected = None
+            self.assertEquals(result.node.key() if result.node is not None else None, expected, text)
+
+    def test_completions(self):
+        self.assertEquals(self.editor.update('numfield > 1 and rel').completions, ['related', 'related_id'])
+        self.assertIn('related.name', self.editor.update('numfield > 1 and related.').completions)
+        self.assertEquals(self.editor.update('numfield > 1 and related.na').completions, ['related.name'])
+        self.assertIn('numfield', self.editor.update('numfield > 1 or ').completions)
+        self.assertEquals(self.editor.update('numfield > 1 or num ').completions, [])
+        self.assertEquals(self.editor.update('numfield = num').completions, [])
+
+    def test_completions_are_limited_to_allowed_fields(self):
+        editor = IncrementalParser(Parser(TestModel, allowed_fields=['numfield', 'related.name']))
+        self.assertEquals(editor.update('').completions, ['numfield'])
+        self.assertEquals(editor.update('related.').completions, ['related.name'])
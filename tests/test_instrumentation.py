@@ -0,0 +1,89 @@
+import threading
+from django.test import TestCase
+from customquery import Parser, exceptions, instrumentation
+from .models import TestModel, RelatedModel
+from django.db.models import Q
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.records = []
+        instrumentation.query_parsed.connect(self.receive)
+
+    def tearDown(self):
+        instrumentation.query_parsed.disconnect(self.receive)
+
+    def receive(self, sender, parser, record, **kwargs):
+        self.records.append(record)
+
+    def test_disabled_by_default(self):
+        Parser(TestModel).parse('numfield = 1')
+        self.assertEquals(self.records, [])
+
+    def test_record(self):
+        parser = Parser(TestModel, instrument=True)
+        self.assertEquals(parser.parse('numfield in (1, 2, 3) and related.name = foo'),
+                          Q(numfield__in=(1, 2, 3)) & Q(related__name='foo'))
+        record, = self.records
+        self.assertEquals(record.model, 'tests.TestModel')
+        self.assertFalse(record.cached)
+        self.assertEquals((record.predicates, record.in_values, record.relations), (2, 3, 1))
+        for phase in ('tokenize', 'grammar', 'check', 'resolve', 'fields', 'values'):
+            self.assertGreater(record.timings[phase], 0, phase)
+        self.assertLessEqual(sum(record.timings.values()), record.total)
+
+        parser.parse('numfield in (1, 2, 3) and related.name = foo')
+        self.assertTrue(self.records[1].cached)
+
+    def test_errors_are_recorded(self):
+        parser = Parser(TestModel, instrument=True)
+        self.assertRaises(exceptions.FieldDoesNotExist, parser.parse, 'unknown = 1')
+        self.assertIn('FieldDoesNotExist', self.records[0].error)
+        self.assertFalse(self.records[0].cached)
+        self.assertRaises(exceptions.FieldDoesNotExist, parser.parse, 'unknown = 1')
+        self.assertFalse(self.records[1].cached)
+
+    def test_same_query(self):
+        # Falling back to a join must not resolve with the timed EXISTS parser
+        query = 'testmodel.numfield = 3 and testmodel.numfield != 5'
+        expected = Parser(RelatedModel, to_many='exists').parse(query)
+        parsed = Parser(RelatedModel, to_many='exists', instrument=True).parse(query)
+        self.assertEquals(str(parsed.children[0][1].query), str(expected.children[0][1].query))
+
+    def test_collect(self):
+        parser = Parser(TestModel)
+        with instrumentation.collect(slowest=1) as stats:
+            parser.parse('numfield = 1')
+            parser.parse('numfield = 1')
+            parser.parse('numfield in (1, 2)')
+        parser.parse('numfield = 2')
+        data = stats.as_dict()
+        self.assertEquals((data['parses'], data['cached'], data['errors']), (3, 1, 0))
+        self.assertEquals(data['in_values'], 2)
+        self.assertEquals(len(data['slowest']), 1)
+        self.assertEquals(instrumentation.active, 0)
+
+    def test_collect_threads(self):
+        parser = Parser(TestModel)
+        with instrumentation.collect() as stats, instrumentation.collect(all_threads=False) as own:
+            parser.parse('numfield = 1')
+            thread = threading.Thread(target=parser.parse, args=('numfield = 2',))
+            thread.start()
+            thread.join()
+        self.assertEquals(stats.parses, 2)
+        self.assertEquals(own.parses, 1)
+
+    def test_shapes(self):
+        parser = Parser(TestModel)
+        with instrumentation.collect(slowest=5) as stats:
+            parser.parse('numfield = 1 and charfield = a')
+            parser.parse('(charfield = "b") AND numfield = 2')
+            parser.parse('charfield = b and numfield = 2')
+            parser.parse('numfield in (1, 2)')
+        shapes = stats.top_shapes()
+        self.assertEquals(sorted((shape['shape'], shape['parses']) for shape in shapes), [
+            ('charfield = ? AND numfield = ?', 3),
+            ('numfield IN (?)', 1),
+        ])
+        self.assertEquals(stats.as_dict()['shapes'], shapes)
@@ -0,0 +1,67 @@
+import pickle
+from unittest import mock, skipIf
+from django.core.cache import caches
+from django.test import TestCase
+from customquery import Parser, exceptions, grammar, ir
+from .models import TestModel, RelatedModel
+from django.db.models import Q
+
+
+class IRTest(TestCase):
+
+    query = ('numfield = 1 or not (charfield in ("a", b, 3) and numfield not between 1 and :max) '
+             'or related.name is not null or numfield in :ids')
+
+    def test_roundtrip(self):
+        node = grammar.parse(self.query)
+        self.assertEquals(ir.load(ir.dump(node)).key(), node.key())
+        self.assertEquals(ir.from_json(ir.to_json(node)).key(), node.key())
+
+    def test_pickle(self):
+        node = grammar.parse(self.query)
+        self.assertEquals(pickle.loads(pickle.dumps(node)).key(), node.key())
+
+    @skipIf(ir.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        node = grammar.parse(self.query)
+        self.assertEquals(ir.from_msgpack(ir.to_msgpack(node)).key(), node.key())
+
+    def test_version(self):
+        data = ir.dump(grammar.parse('numfield = 1'))
+        data[0] = ir.VERSION + 1
+        self.assertRaises(exceptions.IncompatibleIR, ir.load, data)
+
+
+class SharedCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = caches['default']
+        self.cache.clear()
+
+    def test_shared_between_parsers(self):
+        first = Parser(TestModel, shared_cache=self.cache)
+        self.assertEquals(first.parse('numfield = 1'), Q(numfield=1))
+        second = Parser(TestModel, shared_cache='default')
+        with mock.patch('customquery.lexer.tokenize') as tokenize:
+            self.assertEquals(second.parse('numfield = 1'), Q(numfield=1))
+            self.assertFalse(tokenize.called)
+
+    def test_key_depends_on_model_and_settings(self):
+        keys = {
+            Parser(TestModel, shared_cache=self.cache)._shared_key('id = 1'),
+            Parser(RelatedModel, shared_cache=self.cache)._shared_key('id = 1'),
+            Parser(TestModel, shared_cache=self.cache, date_format='%d/%m/%Y')._shared_key('id = 1'),
+            Parser(TestModel, shared_cache=self.cache, optimize=True)._shared_key('id = 1'),
+            Parser(TestModel.objects.annotate(foo=Q(id=1)), shared_cache=self.cache)._shared_key('id = 1'),
+        }
+        self.assertEquals(len(keys), 5)
+
+    def test_limits_are_checked_on_shared_queries(self):
+        Parser(TestModel, shared_cache=self.cache).parse('numfield in (1, 2, 3)')
+        parser = Parser(TestModel, shared_cache=self.cache, max_in_size=2)
+        self.assertRaises(exceptions.ListTooLong, parser.parse, 'numfield in (1, 2, 3)')
+
+    def test_incompatible_entries_are_ignored(self):
+        parser = Parser(TestModel, shared_cache=self.cache)
+        self.cache.set(parser._shared_key('numfield = 1'), [0, 'old'])
+        self.assertEquals(parser.parse('numfield = 1'), Q(numfield=1))
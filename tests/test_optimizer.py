@@ -0,0 +1,85 @@
+from datetime import date
+from django.test import TestCase
+from customquery import Parser
+from .models import TestModel, RelatedModel
+from django.db.models import Q
+
+
+class OptimizerTest(TestCase):
+    def setUp(self):
+        self.parser = Parser(TestModel, optimize=True)
+
+    def parse(self, query):
+        return self.parser.parse(query)
+
+    def test_flatten(self):
+        self.assertEquals(self.parse('numfield=1 or (charfield=a or (related.name=b or numfield > 5))'),
+                          Q(numfield=1) | Q(charfield='a') | Q(related__name='b') | Q(numfield__gt=5))
+
+    def test_equalities_become_in(self):
+        self.assertEquals(self.parse('numfield=1 or numfield=2 or numfield=3'), Q(numfield__in=(1, 2, 3)))
+        self.assertEquals(self.parse('numfield=1 or charfield=a or numfield IN (2, 1)'),
+                          Q(numfield__in=(1, 2)) | Q(charfield='a'))
+
+    def test_ranges_are_collapsed(self):
+        self.assertEquals(self.parse('numfield > 1 and numfield >= 3 and numfield < 10 and numfield between 0 and 8'),
+                          Q(numfield__gte=3) & Q(numfield__lte=8))
+        self.assertEquals(self.parse('numfield >= 3 and numfield > 3'), Q(numfield__gt=3))
+
+    def test_string_ranges_are_kept(self):
+        self.assertEquals(self.parse('charfield > a and charfield > B'),
+                          Q(charfield__gt='a') & Q(charfield__gt='B'))
+
+    def test_duplicates_are_removed(self):
+        self.assertEquals(self.parse('numfield=1 and (numfield = 1) and charfield=a'),
+                          Q(numfield=1) & Q(charfield='a'))
+
+    def test_double_negation(self):
+        self.assertEquals(self.parse('not not numfield=1'), Q(numfield=1))
+        self.assertEquals(self.parse('not numfield not in (1, 2)'), Q(numfield__in=(1, 2)))
+        self.assertEquals(self.parse('not numfield != 1'), Q(numfield=1))
+
+    def test_parameters_are_left_alone(self):
+        query = self.parser.compile('numfield = :a or numfield = :b')
+        self.assertEquals(query.bind(a=1, b=2), Q(numfield=1) | Q(numfield=2))
+
+    def test_disabled_by_default(self):
+        self.assertEquals(Parser(TestModel).parse('numfield=1 or numfield=2'), Q(numfield=1) | Q(numfield=2))
+
+
+class EquivalenceTest(TestCase):
+
+    queries = [
+        'numfield=1 or numfield=2 or numfield=3',
+        'numfield=1 or (numfield=2 or charfield=b) or numfield in (3, 4)',
+        'numfield > 1 and numfield >= 2 and numfield < 8 and numfield <= 9',
+        'numfield between 2 and 7 and numfield between 4 and 9',
+        'not (numfield > 2 and numfield > 4)',
+        'not not (numfield = 3 or numfield = 5)',
+        'not numfield != 2',
+        'not numfield not in (1, 2)',
+        'not numfield not between 2 and 4',
+        'numfield=1 and numfield=1 or charfield=a or charfield=a',
+        'datefield > 2018-01-03 and datefield >= 2018-01-05',
+        'related.name = r1 or related.name = r2 or numfield is null',
+        'not (related.name = r1 or related.name = r2) and numfield > 1 and numfield > 2',
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        related = [RelatedModel.objects.create(name='r%d' % i) for i in range(3)]
+        for i in range(12):
+            TestModel.objects.create(
+                charfield='abc'[i % 3],
+                numfield=None if i % 5 == 0 else i,
+                datefield=date(2018, 1, i + 1),
+                related=related[i % 3],
+            )
+
+    def test_same_rows(self):
+        plain = Parser(TestModel)
+        optimized = Parser(TestModel, optimize=True)
+        for query in self.queries:
+            expected = set(TestModel.objects.filter(plain.parse(query)).values_list('pk', flat=True))
+            result = set(TestModel.objects.filter(optimized.parse(query)).values_list('pk', flat=True))
+            self.assertEquals(result, expected, query)
@@ -1,9 +1,9 @@
 from datetime import datetime, date
 from django.test import TestCase, tag
 from customquery import Parser, exceptions
-from .models import TestModel
+from .models import TestModel, RelatedModel
 from django.db.models import Q, Value as V
-from django.db.models.functions import Concat
+from django.db.models.functions import Concat, Left, Upper
 
 class BaseTest(TestCase):
     def setUp(self):
@@ -65,6 +65,13 @@ class SingleParserTest(BaseTest):
     def test_is_not_null(self):
         self.assertEquals(self.parse('numfield IS NOT NULL'), Q(numfield__isnull=False))
 
+    def test_equals_null(self):
+        self.assertEquals(self.parse('numfield = NULL'), Q(numfield__isnull=True))
+        self.assertEquals(self.parse('numfield != null'), Q(numfield__isnull=False))
+        self.assertEquals(self.parse('numfield <> NULL'), Q(numfield__isnull=False))
+        self.assertEquals(self.parse('numfield NOT NULL'), Q(numfield__isnull=False))
+        self.assertRaises(exceptions.InvalidQuery, self.parse, 'numfield > NULL')
+
     def test_related_field(self):
         self.assertEquals(self.parse('related__name="foo bar"'), Q(related__name="foo bar"))
 
@@ -80,6 +87,41 @@ class AnnotationTest(BaseTest):
     def test_annotated_field(self):
         self.assertEquals(self.parse('full_name="foo bar"'), Q(full_name="foo bar"))
 
+class AnnotationRegistryTest(TestCase):
+
+    def setUp(self):
+        self.parser = Parser(TestModel, annotations={
+            'full_name': Concat('first_name', V(' '), 'last_name'),
+            'shout': Upper('full_name'),
+            'initial': Left('first_name', 1),
+        })
+        related = RelatedModel.objects.create(name='r')
+        TestModel.objects.create(charfield='a', numfield=1, datefield=date(2018, 1, 1), related=related,
+                                 first_name='foo', last_name='bar')
+        TestModel.objects.create(charfield='b', numfield=2, datefield=date(2018, 1, 1), related=related,
+                                 first_name='baz', last_name='qux')
+
+    def test_only_referenced_annotations_are_applied(self):
+        queryset = self.parser.filter('numfield = 1')
+        self.assertEquals(list(queryset.query.annotations), [])
+        self.assertNotIn('||', str(queryset.query))
+        queryset = self.parser.filter('full_name = "foo bar" or numfield = 2')
+        self.assertEquals(list(queryset.query.annotations), ['full_name'])
+        self.assertEquals(queryset.count(), 2)
+
+    def test_dependencies(self):
+        queryset = self.parser.filter('shout = "BAZ QUX"')
+        self.assertEquals(list(queryset.query.annotations), ['full_name', 'shout'])
+        self.assertEquals([obj.numfield for obj in queryset], [2])
+
+    def test_given_queryset(self):
+        queryset = self.parser.filter('initial = b', TestModel.objects.filter(charfield='b'))
+        self.assertEquals(list(queryset.query.annotations), ['initial'])
+        self.assertEquals(queryset.count(), 1)
+
+    def test_unknown_field(self):
+        self.assertRaises(exceptions.FieldDoesNotExist, self.parser.parse, 'nickname = foo')
+
 class SimpleOperatorTest(BaseTest):
 
     def test_or(self):
@@ -97,6 +139,21 @@ class SimpleOperatorTest(BaseTest):
         self.assertEquals(self.parse('numfield=1 AND charfield="foo"'),
                           Q(numfield=1) & Q(charfield="foo"))
 
+    def test_chains(self):
+        self.assertEquals(self.parse('numfield=1 or numfield=2 or numfield=3'),
+                          Q(numfield=1) | Q(numfield=2) | Q(numfield=3))
+        self.assertEquals(self.parse('numfield=1 and numfield=2 and numfield=3'),
+                          Q(numfield=1) & Q(numfield=2) & Q(numfield=3))
+
+    def test_and_binds_tighter_than_or(self):
+        self.assertEquals(self.parse('numfield=1 or numfield=2 and charfield=foo'),
+                          Q(numfield=1) | (Q(numfield=2) & Q(charfield="foo")))
+
+    def test_not_expression(self):
+        self.assertEquals(self.parse('not numfield=1'), ~Q(numfield=1))
+        self.assertEquals(self.parse('NOT (numfield=1 or charfield=foo)'),
+                          ~(Q(numfield=1) | Q(charfield="foo")))
+
 class ParenthesisTest(BaseTest):
 
     def test_one_parenthesis(self):
@@ -119,6 +176,21 @@ class BetweenTest(BaseTest):
         self.assertEquals(self.parse('charfield between "foo" and "foo bar"'),
                           Q(charfield__gte="foo") & Q(charfield__lte="foo bar"))
 
+    def test_not_between(self):
+        self.assertEquals(self.parse('numfield not between 1 and 5'), ~(Q(numfield__gte=1) & Q(numfield__lte=5)))
+
+class LexerTest(BaseTest):
+
+    def test_escaped_quotes(self):
+        self.assertEquals(self.parse("charfield='it''s'"), Q(charfield="it's"))
+        self.assertEquals(self.parse('charfield="say ""hi"""'), Q(charfield='say "hi"'))
+
+    def test_negative_number(self):
+        self.assertEquals(self.parse("numfield > -3"), Q(numfield__gt=-3))
+
+    def test_keywords_inside_strings(self):
+        self.assertEquals(self.parse("charfield='a and b'"), Q(charfield="a and b"))
+
 class ValidationTest(BaseTest):
 
     def test_field_must_exist_in_model(self):
@@ -141,12 +213,179 @@ class ValidationTest(BaseTest):
     def test_check_unknown_operator(self):
         try:
             parsed = self.parse("numfield ? 10")
-            import ipdb; ipdb.set_trace()
         except exceptions.UnknownOperator as e:
             self.assertEquals(e.operator, "?")
         else:
             self.fail("Operator should be checked")
 
+    def test_closing_parenthesis_must_match(self):
+        self.assertRaises(exceptions.ParenthesisDontMatch, self.parse, "numfield > 10)")
+
+    def test_in_requires_parenthesis(self):
+        self.assertRaises(exceptions.ParenthesisExpected, self.parse, "numfield IN 1, 2")
+
+    def test_malformed_list(self):
+        self.assertRaises(exceptions.MalformedList, self.parse, "numfield IN (1 2)")
+        self.assertRaises(exceptions.MalformedList, self.parse, "numfield IN ()")
+
+    def test_invalid_is_parameter(self):
+        self.assertRaises(exceptions.InvalidIsParameter, self.parse, "numfield IS 1")
+
+    def test_invalid_query(self):
+        self.assertRaises(exceptions.InvalidQuery, self.parse, "")
+        self.assertRaises(exceptions.InvalidQuery, self.parse, "numfield = 1 numfield = 2")
+        self.assertRaises(exceptions.InvalidQuery, self.parse, "charfield = 'foo")
+
+class FieldIndexTest(BaseTest):
+
+    def test_paths_are_indexed_on_construction(self):
+        self.assertIn('numfield', self.parser._fields)
+        self.assertIn('related__name', self.parser._fields)
+        self.assertIn('related_id', self.parser._fields)
+        self.assertNotIn('related__testmodel__numfield', self.parser._fields)
+
+    def test_relation_depth(self):
+        parser = Parser(TestModel, relation_depth=2)
+        self.assertIn('related__testmodel__numfield', parser._fields)
+        self.assertEquals(parser._get_field_info('related__testmodel__numfield').hops, 2)
+
+    def test_deeper_paths_are_resolved_on_demand(self):
+        self.assertEquals(self.parse('related.testmodel.numfield=1'), Q(related__testmodel__numfield=1))
+        self.assertIn('related__testmodel__numfield', self.parser._fields)
+
+    def test_unknown_related_path(self):
+        self.assertRaises(exceptions.FieldDoesNotExist, self.parse, 'related.unknown.name=1')
+        self.assertRaises(exceptions.FieldDoesNotExist, self.parse, 'numfield.name=1')
+
+class CompileTest(BaseTest):
+
+    def test_bind(self):
+        query = self.parser.compile('numfield > :min AND related.name = :name')
+        self.assertEquals(query.parameters, {'min', 'name'})
+        self.assertEquals(query.bind(min=1, name='foo'), Q(numfield__gt=1) & Q(related__name='foo'))
+        self.assertEquals(query.bind(min=5, name='bar'), Q(numfield__gt=5) & Q(related__name='bar'))
+
+    def test_bound_strings_are_converted(self):
+        query = Parser(TestModel, date_format='%d/%m/%Y').compile('datefield = :day')
+        self.assertEquals(query.bind(day='13/12/2018'), Q(datefield=date(2018, 12, 13)))
+        self.assertEquals(query.bind(day=date(2018, 12, 13)), Q(datefield=date(2018, 12, 13)))
+
+    def test_in_and_between_parameters(self):
+        query = self.parser.compile('numfield IN :ids OR numfield IN (:a, 2) OR numfield BETWEEN :a AND :b')
+        self.assertEquals(query.bind(ids=[1, 2], a=3, b=4),
+                          Q(numfield__in=(1, 2)) | Q(numfield__in=(3, 2)) |
+                          (Q(numfield__gte=3) & Q(numfield__lte=4)))
+
+    def test_fields_are_validated_on_compile(self):
+        self.assertRaises(exceptions.FieldDoesNotExist, self.parser.compile, 'unknown = :value')
+
+    def test_missing_parameter(self):
+        query = self.parser.compile('numfield = :value')
+        try:
+            query.bind()
+        except exceptions.MissingParameter as e:
+            self.assertEquals(e.name, 'value')
+        else:
+            self.fail("Missing parameters should be reported")
+        self.assertRaises(exceptions.MissingParameter, self.parse, 'numfield = :value')
+
+class InListTest(BaseTest):
+
+    @classmethod
+    def setUpTestData(cls):
+        related = RelatedModel.objects.create(name='foo')
+        for i in range(10):
+            TestModel.objects.create(numfield=i, datefield=date(2018, 1, i + 1), related=related)
+
+    def test_large_list(self):
+        values = tuple(range(100000))
+        query = 'numfield IN (%s)' % ', '.join(map(str, values))
+        self.assertEquals(self.parse(query), Q(numfield__in=values))
+
+    def test_chunks(self):
+        parser = Parser(TestModel, in_chunk_size=2)
+        self.assertEquals(parser.parse('numfield IN (1, 2, 3, 4, 5)'),
+                          Q(numfield__in=(1, 2)) | Q(numfield__in=(3, 4)) | Q(numfield__in=(5,)))
+        self.assertEquals(parser.parse('numfield IN (1, 2)'), Q(numfield__in=(1, 2)))
+        self.assertEquals(TestModel.objects.filter(parser.parse('numfield IN (1, 2, 3, 4, 5)')).count(), 5)
+
+    def test_values_table(self):
+        parser = Parser(TestModel, in_table_threshold=3)
+        qs = TestModel.objects.filter(parser.parse('numfield IN (1, 2, 3, 4, 5, 50)'))
+        self.assertIn('json_each', str(qs.query))
+        self.assertEquals(sorted(qs.values_list('numfield', flat=True)), [1, 2, 3, 4, 5])
+        qs = TestModel.objects.filter(parser.parse('numfield NOT IN (1, 2, 3, 4, 5, 50)'))
+        self.assertEquals(sorted(qs.values_list('numfield', flat=True)), [0, 6, 7, 8, 9])
+        qs = TestModel.objects.filter(parser.parse('datefield IN (2018-01-01, 2018-01-02, 2018-01-03, 2018-01-04)'))
+        self.assertEquals(qs.count(), 4)
+        self.assertNotIn('json_each', str(TestModel.objects.filter(parser.parse('numfield IN (1, 2)')).query))
+
+class GuardTest(BaseTest):
+
+    def test_depth(self):
+        parser = Parser(TestModel, max_depth=2)
+        self.assertEquals(parser.parse('((numfield=1))'), Q(numfield=1))
+        try:
+            parser.parse('numfield=1 or (not (numfield=2 and (numfield=3)))')
+        except exceptions.QueryTooDeep as e:
+            self.assertEquals(e.position, 19)
+        else:
+            self.fail("Depth should be limited")
+
+    def test_default_depth_avoids_recursion_error(self):
+        self.assertRaises(exceptions.QueryTooDeep, self.parse, '(' * 5000 + 'numfield=1' + ')' * 5000)
+        self.assertRaises(exceptions.QueryTooDeep, self.parse, 'not ' * 5000 + 'numfield=1')
+
+    def test_predicates(self):
+        parser = Parser(TestModel, max_predicates=2)
+        parser.parse('numfield=1 or numfield between 1 and 2')
+        try:
+            parser.parse('numfield=1 or numfield=2 or numfield=3')
+        except exceptions.TooManyPredicates as e:
+            self.assertEquals(e.position, 28)
+        else:
+            self.fail("Number of conditions should be limited")
+
+    def test_in_size(self):
+        parser = Parser(TestModel, max_in_size=2)
+        parser.parse('numfield in (1, 2)')
+        self.assertRaises(exceptions.ListTooLong, parser.parse, 'numfield in (1, 2, 3)')
+        query = parser.compile('numfield in :ids')
+        self.assertRaises(exceptions.ListTooLong, query.bind, ids=[1, 2, 3])
+
+    def test_relations(self):
+        parser = Parser(TestModel, max_relations=1)
+        parser.parse('related.name=foo')
+        try:
+            parser.parse('numfield=1 and related.testmodel.numfield=1')
+        except exceptions.TooManyRelations as e:
+            self.assertEquals((e.field, e.position), ('related__testmodel__numfield', 15))
+        else:
+            self.fail("Relation hops should be limited")
+
+    def test_allowed_fields(self):
+        parser = Parser(TestModel, allowed_fields=['numfield', 'related'])
+        parser.parse('numfield=1 and related.name=foo')
+        try:
+            parser.parse('numfield=1 and charfield=foo')
+        except exceptions.FieldNotAllowed as e:
+            self.assertEquals((e.field, e.position), ('charfield', 15))
+        else:
+            self.fail("Only allowed fields should be accepted")
+
+    def test_denied_fields(self):
+        parser = Parser(TestModel, denied_fields=['related.name'])
+        parser.parse('numfield=1 and related.id=1')
+        self.assertRaises(exceptions.FieldNotAllowed, parser.parse, 'related.name IS NULL')
+
+    def test_require_index(self):
+        parser = Parser(TestModel, require_index='error')
+        parser.parse('id=1 or related=1 or related.id=1')
+        self.assertRaises(exceptions.UnindexedField, parser.parse, 'numfield=1')
+        parser = Parser(TestModel, require_index='warn')
+        with self.assertWarns(exceptions.UnindexedFieldWarning):
+            self.assertEquals(parser.parse('numfield=1'), Q(numfield=1))
+
 class DateFormatTest(TestCase):
 
     def test_date_without_format(self):
@@ -157,3 +396,43 @@ class DateFormatTest(TestCase):
         parser = Parser(TestModel, date_format='%d/%m/%Y')
         self.assertEquals(parser.parse('datefield="13/12/2018"'), Q(datefield=date(2018, 12, 13)))
         self.assertEquals(parser.parse('datefield=13/12/2018'), Q(datefield=date(2018, 12, 13)))
+
+class CacheTest(BaseTest):
+
+    def test_repeated_query_is_cached(self):
+        self.assertEquals(self.parse("numfield=1"), Q(numfield=1))
+        self.assertEquals(self.parse("numfield=1"), Q(numfield=1))
+        info = self.parser.cache_info()
+        self.assertEquals((info.hits, info.misses, info.currsize), (1, 1, 1))
+
+    def test_cached_result_cannot_be_changed(self):
+        first = self.parse("numfield=1")
+        first.add(Q(charfield="foo"), Q.AND)
+        self.assertEquals(self.parse("numfield=1"), Q(numfield=1))
+
+    def test_least_recently_used_is_evicted(self):
+        parser = Parser(TestModel, cache_size=2)
+        parser.parse("numfield=1")
+        parser.parse("numfield=2")
+        parser.parse("numfield=1")
+        parser.parse("numfield=3")
+        self.assertIn("numfield=1", parser._cache)
+        self.assertNotIn("numfield=2", parser._cache)
+        self.assertEquals(parser.cache_info().currsize, 2)
+
+    def test_derived_results_are_cached_apart(self):
+        parser = Parser(TestModel)
+        parser.parse("numfield=1")
+        parser.canonical("numfield=1")
+        parser.parse_sql("numfield=1")
+        parser.predicate("numfield=1")
+        parser.relations("related.name=foo")
+        self.assertEquals(parser.cache_info().currsize, 1)
+        self.assertEquals(parser._derived['sql'].info().currsize, 1)
+        parser.cache_clear()
+        self.assertEquals(parser._derived['sql'].info().currsize, 0)
+
+    def test_cache_can_be_disabled(self):
+        parser = Parser(TestModel, cache_size=0)
+        self.assertEquals(parser.parse("numfield=1"), Q(numfield=1))
+        self.assertEquals(parser.cache_info().currsize, 0)
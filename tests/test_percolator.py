@@ -0,0 +1,138 @@
+import random
+from unittest import mock
+from django.test import TestCase
+from customquery import Parser, exceptions
+from customquery.percolator import Percolator, RangeIndex, Range
+from .models import TestModel, RelatedModel
+from .test_sql import DifferentialTest
+
+
+class PercolatorTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        DifferentialTest.setUpTestData.__func__(cls)
+
+    queries = DifferentialTest.queries + [
+        'numfield >= 5 and charfield = a',
+        'numfield < 3 or numfield > 8',
+        'charfield in (a, b) and numfield between 3 and 9',
+        'datefield <= 2018-01-03 or related.name in (r2, r3)',
+    ]
+
+    def setUp(self):
+        self.parser = Parser(TestModel)
+        self.percolator = Percolator(self.parser)
+        for i, query in enumerate(self.queries):
+            self.percolator.add(i, query)
+
+    def expected(self, obj):
+        return {i for i, query in enumerate(self.queries)
+                if TestModel.objects.filter(self.parser.parse(query), pk=obj.pk).exists()}
+
+    def test_same_matches_as_queries(self):
+        objects = list(TestModel.objects.select_related('related'))
+        results = self.percolator.match_many(objects)
+        for obj, matched in zip(objects, results):
+            self.assertEquals(matched, self.expected(obj))
+
+    def test_match_many_shares_lookups(self):
+        objects = list(TestModel.objects.select_related('related')) * 2
+        lookups = {(path, value) for obj in objects for path in self.percolator._ranges
+                   for value in self.percolator._values(obj, path) if value is not None}
+        with mock.patch.object(RangeIndex, 'find', autospec=True, side_effect=RangeIndex.find) as find:
+            results = self.percolator.match_many(objects)
+            # Once for each distinct value of each field with ranges
+            self.assertEquals(find.call_count, len(lookups))
+            find.reset_mock()
+            self.assertEquals(results, [self.percolator.match(obj) for obj in objects])
+            self.assertGreater(find.call_count, len(lookups))
+
+    def test_reverse_relation(self):
+        parser = Parser(RelatedModel)
+        percolator = Percolator(parser)
+        queries = DifferentialTest.related_queries + DifferentialTest.shared_row_queries + \
+            DifferentialTest.negated_queries
+        for i, query in enumerate(queries):
+            percolator.add(i, query)
+        objects = list(RelatedModel.objects.prefetch_related('testmodel_set'))
+        for obj, matched in zip(objects, percolator.match_many(objects)):
+            expected = {i for i, query in enumerate(queries)
+                        if RelatedModel.objects.filter(parser.parse(query), pk=obj.pk).exists()}
+            self.assertEquals(matched, expected)
+        self.assertRaises(exceptions.UnsupportedField, percolator.add, 'mixed',
+                          'testmodel.numfield = 3 and testmodel.numfield != 5')
+
+    def test_candidates_are_narrowed(self):
+        obj = TestModel.objects.get(numfield=4)
+        candidates = self.percolator.candidates(obj)
+        self.assertNotIn(self.queries.index('numfield=1'), candidates)
+        self.assertLess(len(candidates), len(self.queries))
+        # != and NOT can't be indexed and are always checked
+        self.assertIn(self.queries.index('numfield != 1'), candidates)
+
+    def test_remove(self):
+        obj = TestModel.objects.get(numfield=1)
+        index = self.queries.index('numfield=1')
+        self.assertIn(index, self.percolator.match(obj))
+        self.percolator.remove(index)
+        self.assertNotIn(index, self.percolator.match(obj))
+        self.assertNotIn(index, self.percolator)
+        self.percolator.add('replaced', 'numfield = 2')
+        self.percolator.add('replaced', 'numfield = 1')
+        self.assertIn('replaced', self.percolator.match(obj))
+
+    def test_ranges_in_and_are_intersected(self):
+        percolator = Percolator(Parser(TestModel))
+        percolator.add('range', 'numfield > 2 and numfield <= 5 and numfield != 4')
+        self.assertEquals(percolator.candidates({'numfield': 7}), set())
+        self.assertEquals(percolator.candidates({'numfield': 5}), {'range'})
+        self.assertEquals(percolator.match({'numfield': 4}), set())
+
+    def test_empty_ranges(self):
+        percolator = Percolator(Parser(TestModel))
+        percolator.add('inverted', 'numfield between 10 and 3')
+        percolator.add('disjoint', 'numfield > 5 and numfield < 3')
+        percolator.add('open', 'numfield > 5 and numfield < 5')
+        percolator.add('either', 'numfield between 10 and 3 or numfield = 4')
+        percolator.add('point', 'numfield >= 5 and numfield <= 5')
+        for value in range(12):
+            expected = {'either'} if value == 4 else {'point'} if value == 5 else set()
+            self.assertEquals(percolator.match({'numfield': value}), expected)
+
+    def test_dicts(self):
+        percolator = Percolator(Parser(TestModel))
+        percolator.add('cheap', 'numfield < 10 and charfield = a')
+        percolator.add('any', 'numfield in (1, 20)')
+        self.assertEquals(percolator.match({'numfield': 1, 'charfield': 'a'}), {'cheap', 'any'})
+        self.assertEquals(percolator.match({'numfield': 20, 'charfield': 'a'}), {'any'})
+        self.assertEquals(percolator.match({'numfield': None, 'charfield': 'a'}), set())
+
+
+class RangeIndexTest(TestCase):
+
+    def test_find(self):
+        rng = random.Random(1)
+        ranges = RangeIndex()
+        intervals = {}
+        for i in range(300):
+            low = rng.choice([None, rng.randrange(100)])
+            high = rng.choice([None, (low or 0) + rng.randrange(50)])
+            intervals[i] = Range('numfield', low, rng.random() < 0.5, high, rng.random() < 0.5)
+            ranges.add(i, intervals[i])
+        ranges.remove(7)
+        del intervals[7]
+        for value in range(-5, 160):
+            self.assertEquals(ranges.find(value), {i for i, interval in intervals.items() if interval.contains(value)})
+
+    def test_empty_ranges(self):
+        rng = random.Random(2)
+        ranges = RangeIndex()
+        intervals = {}
+        for i in range(200):
+            low = rng.randrange(50)
+            high = rng.randrange(50)
+            intervals[i] = Range('numfield', low, rng.random() < 0.5, high, rng.random() < 0.5)
+            ranges.add(i, intervals[i])
+        for value in range(-5, 60):
+            self.assertEquals(ranges.find(value), {i for i, interval in intervals.items() if interval.contains(value)})
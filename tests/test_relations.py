@@ -0,0 +1,43 @@
+from datetime import date
+from django.test import TestCase
+from customquery import Parser, Relation
+from .models import TestModel, RelatedModel
+
+
+class RelationsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(3):
+            related = RelatedModel.objects.create(name='r%d' % i)
+            for j in range(2):
+                TestModel.objects.create(charfield='a', numfield=j, datefield=date(2018, 1, 1), related=related)
+
+    def test_relations(self):
+        parser = Parser(TestModel, relation_depth=2)
+        self.assertEquals(parser.relations('numfield = 1'), ())
+        self.assertEquals(parser.relations('related.name = r1 or related = 2'),
+                          (Relation('related', False, 'related'),))
+        self.assertEquals(parser.relations('related.testmodel.numfield > 1'), (
+            Relation('related', False, 'related'),
+            Relation('related__testmodel', True, 'related__testmodel_set'),
+        ))
+        self.assertEquals(Parser(RelatedModel).relations('testmodel.related.name = r1'), (
+            Relation('testmodel', True, 'testmodel_set'),
+            Relation('testmodel__related', True, 'testmodel_set__related'),
+        ))
+
+    def test_select_related(self):
+        parser = Parser(TestModel)
+        with self.assertNumQueries(7):
+            [obj.related.name for obj in parser.filter('related.name != foo')]
+        with self.assertNumQueries(1):
+            [obj.related.name for obj in parser.filter('related.name != foo', load_related=True)]
+
+    def test_prefetch_related(self):
+        parser = Parser(RelatedModel)
+        with self.assertNumQueries(4):
+            [list(obj.testmodel_set.all()) for obj in parser.filter('testmodel.numfield = 1')]
+        with self.assertNumQueries(2):
+            queryset = parser.load_related(RelatedModel.objects.all(), 'testmodel.numfield = 1')
+            self.assertEquals([len(obj.testmodel_set.all()) for obj in queryset], [2, 2, 2])
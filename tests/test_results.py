@@ -0,0 +1,116 @@
+import threading
+import time
+from datetime import date
+from django.test import TestCase
+from customquery import Parser
+from customquery import results
+from customquery.results import ResultCache
+from .models import TestModel, RelatedModel, ProxyTestModel, ChildModel
+
+
+class ResultCacheTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.related = RelatedModel.objects.create(name='foo')
+        for i in range(3):
+            TestModel.objects.create(charfield='a', numfield=i, datefield=date(2018, 1, 1), related=cls.related)
+
+    def test_cached(self):
+        cache = ResultCache(Parser(TestModel))
+        with self.assertNumQueries(1):
+            self.assertEquals(cache.count('numfield > 0'), 2)
+            self.assertEquals(cache.count('numfield  >  0'), 2)
+        with self.assertNumQueries(1):
+            self.assertEquals(len(cache.list('numfield > 0')), 2)
+            self.assertEquals(len(cache.list('numfield > 0')), 2)
+        with self.assertNumQueries(1):
+            cache.count('numfield > 0', TestModel.objects.filter(charfield='b'))
+
+    def test_relation_order(self):
+        TestModel.objects.filter(numfield=1).update(numfield=5)
+        cache = ResultCache(Parser(RelatedModel))
+        # Reordered, the negation is its own subquery and matches no row
+        self.assertEquals(cache.count('testmodel.numfield = 2 and testmodel.numfield != 5'), 1)
+        self.assertEquals(cache.count('testmodel.numfield != 5 and testmodel.numfield = 2'), 0)
+
+    def test_invalidated_by_save(self):
+        cache = ResultCache(Parser(TestModel))
+        self.assertEquals(cache.count('numfield > 0'), 2)
+        TestModel.objects.create(charfield='a', numfield=5, datefield=date(2018, 1, 1), related=self.related)
+        with self.assertNumQueries(1):
+            self.assertEquals(cache.count('numfield > 0'), 3)
+        TestModel.objects.filter(numfield=5).delete()
+        self.assertEquals(cache.count('numfield > 0'), 2)
+
+    def test_invalidated_by_related(self):
+        cache = ResultCache(Parser(TestModel))
+        self.assertEquals(cache.count('related.name = foo'), 3)
+        self.assertEquals(cache.count('numfield > 0'), 2)
+        self.related.name = 'bar'
+        self.related.save()
+        with self.assertNumQueries(1):
+            self.assertEquals(cache.count('related.name = foo'), 0)
+            self.assertEquals(cache.count('numfield > 0'), 2)
+        self.assertEquals(cache.models('related.name = foo'), [TestModel, RelatedModel])
+
+    def test_queryset_parser(self):
+        cache = ResultCache(Parser(TestModel.objects.filter(numfield__gte=1)))
+        self.assertEquals(cache.count('numfield < 2'), 1)
+        self.assertEquals(cache.models('related.name = foo'), [TestModel, RelatedModel])
+
+    def test_invalidated_by_proxy(self):
+        cache = ResultCache(Parser(TestModel))
+        self.assertEquals(cache.count('numfield > 0'), 2)
+        ProxyTestModel.objects.create(charfield='a', numfield=5, datefield=date(2018, 1, 1), related=self.related)
+        self.assertEquals(cache.count('numfield > 0'), 3)
+
+    def test_invalidated_by_child(self):
+        cache = ResultCache(Parser(RelatedModel))
+        self.assertEquals(cache.count('name = child'), 0)
+        ChildModel.objects.create(name='child')
+        self.assertEquals(cache.count('name = child'), 1)
+
+    def test_bump(self):
+        cache = ResultCache(Parser(TestModel))
+        self.assertEquals(cache.count('numfield > 0'), 2)
+        TestModel.objects.filter(numfield=0).update(numfield=4)
+        self.assertEquals(cache.count('numfield > 0'), 2)
+        results.bump(TestModel)
+        self.assertEquals(cache.count('numfield > 0'), 3)
+
+    def test_version_cache(self):
+        cache = ResultCache(Parser(TestModel), version_cache='default')
+        before = results.version(TestModel, 'default')
+        self.assertEquals(cache.count('numfield > 0'), 2)
+        results.bump(TestModel)
+        self.assertEquals(results.version(TestModel, 'default'), before + 1)
+
+    def test_ttl_and_size(self):
+        cache = ResultCache(Parser(TestModel), maxsize=2, ttl=0.05)
+        cache.count('numfield = 0')
+        cache.count('numfield = 1')
+        cache.count('numfield = 2')
+        self.assertEquals(cache.cache_info().currsize, 2)
+        with self.assertNumQueries(1):
+            cache.count('numfield = 2')
+            time.sleep(0.06)
+            cache.count('numfield = 2')
+
+    def test_stampede(self):
+        cache = ResultCache(Parser(TestModel))
+        calls = []
+
+        def evaluate(queryset):
+            calls.append(1)
+            time.sleep(0.05)
+            return 7
+        found = []
+        threads = [threading.Thread(target=lambda: found.append(cache.get('numfield > 0', evaluate, 'slow')))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(found, [7] * 5)
+        self.assertEquals(len(calls), 1)
@@ -0,0 +1,129 @@
+from datetime import date
+from django.test import TestCase
+from customquery import Parser, exceptions
+from .models import TestModel, RelatedModel
+from django.db.models import Value as V
+from django.db.models.functions import Concat
+
+
+class DifferentialTest(TestCase):
+    """The SQL backend must return the same rows as the Q objects"""
+
+    queries = [
+        'numfield=1',
+        'numfield != 1',
+        'numfield NOT 3',
+        'numfield > 2 and numfield <= 7',
+        'numfield < 4 or charfield = b',
+        'not (numfield < 4 or charfield = b)',
+        'numfield in (1, 2, 3, 50)',
+        'numfield not in (1, 2, 3)',
+        'numfield between 2 and 6',
+        'numfield not between 2 and 6',
+        'numfield is null',
+        'numfield is not null',
+        'not numfield > 3',
+        'charfield between a and b',
+        'datefield > 2018-01-04',
+        'datefield in (2018-01-01, 2018-01-05)',
+        'related = 1 or related_id = 2',
+        'related is null',
+        'related.name = r1',
+        'related.name != r1',
+        'not related.name in (r1, r2)',
+        'related.name is null',
+        'related.name is not null',
+        'related.name = r1 and numfield > 3 or related.name = r2',
+    ]
+
+    related_queries = [
+        'testmodel.numfield = 3',
+        'testmodel.numfield > 5',
+        'not testmodel.numfield > 5',
+        'testmodel.charfield = a or name = r3',
+        'testmodel.numfield is null',
+        'testmodel.numfield is not null',
+        'testmodel.charfield != a',
+    ]
+    # One related row must match all of them, like with a join
+    shared_row_queries = [
+        'testmodel.numfield < 3 and testmodel.numfield > 1',
+        'testmodel.numfield < 5 and (testmodel.numfield > 3 and name = r1)',
+        'testmodel.charfield = a and testmodel.numfield in (3, 4) or name = r3',
+        'testmodel.numfield between 2 and 8 and testmodel.datefield < 2018-01-08 and name != r1',
+        'testmodel.numfield <= 2 and testmodel.numfield between 3 and 4',
+        '(testmodel.charfield = a and testmodel.numfield > 2) and testmodel.charfield = b',
+    ]
+    # Negations get subqueries of their own, NOT BETWEEN one per bound
+    negated_queries = [
+        'testmodel.numfield not between 2 and 3',
+        'not testmodel.numfield between 2 and 3',
+        'not (testmodel.numfield = 3 and testmodel.charfield = b)',
+        'testmodel.numfield != 5 and testmodel.charfield != a',
+        'not (testmodel.numfield not between 2 and 3) or name = r3',
+        'not (testmodel.numfield != 3) and testmodel.charfield = b',
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        related = [RelatedModel.objects.create(name='r%d' % i) for i in range(4)]
+        for i in range(12):
+            TestModel.objects.create(
+                charfield='abc'[i % 3],
+                numfield=None if i % 5 == 0 else i,
+                datefield=date(2018, 1, i + 1),
+                related=related[i % 3],
+            )
+
+    def assertSameRows(self, parser, queryset, queries):
+        for query in queries:
+            expected = set(queryset.filter(parser.parse(query)).values_list('pk', flat=True))
+            clause = parser.parse_sql(query)
+            self.assertEquals(set(clause.apply(queryset).values_list('pk', flat=True)), expected, query)
+            self.assertEquals(set(queryset.filter(clause.expression()).values_list('pk', flat=True)), expected, query)
+
+    def test_same_rows(self):
+        self.assertSameRows(Parser(TestModel), TestModel.objects.all(), self.queries)
+
+    def test_reverse_relation(self):
+        self.assertSameRows(Parser(RelatedModel), RelatedModel.objects.all(),
+                            self.related_queries + self.shared_row_queries + self.negated_queries)
+
+    def test_templates(self):
+        query = Parser(TestModel).compile('numfield > :min and related.name in :names')
+        clause = query.bind_sql(min=2, names=['r1', 'r2'])
+        expected = TestModel.objects.filter(query.bind(min=2, names=['r1', 'r2']))
+        self.assertEquals(set(clause.apply(TestModel.objects.all())), set(expected))
+
+
+class SQLTest(TestCase):
+
+    def test_sql(self):
+        clause = Parser(TestModel).parse_sql('numfield > 1 and related.name = foo')
+        self.assertEquals(clause.sql, '("tests_testmodel"."numfield" > %s AND "tests_testmodel"."numfield" IS NOT NULL) AND '
+                                      '("tests_testmodel"."related_id" IN (SELECT U0."id" FROM "tests_relatedmodel" U0 '
+                                      'WHERE U0."name" = %s))')
+        self.assertEquals(clause.params, (1, 'foo'))
+
+    def test_cached(self):
+        parser = Parser(TestModel)
+        self.assertIs(parser.parse_sql('numfield = 1'), parser.parse_sql('numfield = 1'))
+
+    def test_shared_related_row(self):
+        parser = Parser(RelatedModel)
+        clause = parser.parse_sql('testmodel.numfield < 3 and testmodel.numfield > 1')
+        self.assertEquals(clause.sql.count('SELECT'), 1)
+        # A join would also bind the related row of the OR
+        self.assertRaises(exceptions.UnsupportedField, parser.parse_sql,
+                          'testmodel.numfield < 3 and (testmodel.numfield > 1 or name = r1)')
+        self.assertRaises(exceptions.UnsupportedField, parser.parse_sql,
+                          'testmodel.numfield < 3 and testmodel.charfield is null')
+        # Django checks a negation after a condition through the relation on the joined row
+        self.assertRaises(exceptions.UnsupportedField, parser.parse_sql,
+                          'testmodel.numfield = 3 and testmodel.numfield != 5')
+        self.assertRaises(exceptions.UnsupportedField, parser.parse_sql,
+                          'testmodel.numfield between 2 and 8 and testmodel.charfield != c')
+
+    def test_annotations_are_not_supported(self):
+        parser = Parser(TestModel.objects.annotate(full_name=Concat('first_name', V(' '), 'last_name')))
+        self.assertRaises(exceptions.UnsupportedField, parser.parse_sql, 'full_name = foo')
@@ -0,0 +1,54 @@
+import io
+import json
+from datetime import date
+from django.test import TestCase
+from customquery import Parser, stream
+from .models import TestModel, RelatedModel
+
+
+class StreamTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        related = RelatedModel.objects.create(name='r')
+        for i in range(25):
+            TestModel.objects.create(charfield='abc'[i % 3], numfield=i, datefield=date(2018, 1, i % 7 + 1),
+                                     related=related)
+
+    def test_keyset(self):
+        queryset = TestModel.objects.filter(numfield__gte=3)
+        # 22 rows in chunks of 4, the last one is not full
+        with self.assertNumQueries(6):
+            rows = list(stream.keyset(queryset, chunk_size=4))
+        self.assertEquals(rows, list(queryset.order_by('pk')))
+
+    def test_ordering_with_ties(self):
+        queryset = TestModel.objects.all()
+        rows = list(stream.keyset(queryset, ordering=['-datefield', 'charfield'], chunk_size=3))
+        self.assertEquals(rows, list(queryset.order_by('-datefield', 'charfield', 'pk')))
+
+    def test_nulls(self):
+        TestModel.objects.filter(numfield__in=[2, 7, 8, 20]).update(numfield=None)
+        queryset = TestModel.objects.all()
+        for ordering in (['numfield'], ['-numfield'], ['charfield', '-numfield']):
+            rows = list(stream.keyset(queryset, ordering=ordering, chunk_size=3))
+            self.assertEquals(rows, list(queryset.order_by(*ordering + ['pk'])), ordering)
+
+    def test_parser_stream(self):
+        parser = Parser(TestModel)
+        rows = list(parser.stream('numfield < 5', fields=['charfield', 'numfield'], ordering=['-numfield'],
+                                  chunk_size=2))
+        self.assertEquals(rows, [{'charfield': 'abc'[i % 3], 'numfield': i} for i in range(4, -1, -1)])
+        self.assertEquals(len(list(parser.stream('numfield < 5', chunk_size=5))), 5)
+
+    def test_writers(self):
+        parser = Parser(TestModel)
+        output = io.StringIO()
+        stream.write_csv(parser.stream('numfield < 2', fields=['numfield', 'datefield']), output,
+                         ['numfield', 'datefield'])
+        self.assertEquals(output.getvalue().splitlines(), ['numfield,datefield', '0,2018-01-01', '1,2018-01-02'])
+
+        output = io.StringIO()
+        stream.write_jsonl(parser.stream('numfield < 2'), output, ['numfield', 'related__name'])
+        self.assertEquals([json.loads(line) for line in output.getvalue().splitlines()],
+                          [{'numfield': 0, 'related__name': 'r'}, {'numfield': 1, 'related__name': 'r'}])